@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from state import StateChannel
+
+# Tasks that block on hardware: name -> (device, read). read(controller)
+# gives the blocking sensor read, which goes to the executor while the
+# task's own step then runs on the loop with its result; with no read the
+# whole task is the hardware call. Calls to one device never overlap;
+# calls to different devices run side by side.
+BLOCKING_TASKS = {
+    'temperature_acquisition': ('spi', None),
+    'water_level': ('ultrasonic', lambda controller: controller.water_sensor.timed_burst),
+    'load_cell': ('hx711', None)
+}
+
+
+class AsyncControlCore:
+    """Runs a controller's periodic tasks as asyncio coroutines
+
+    Each task is a coroutine that sleeps until its next deadline on the same
+    fixed grid as ControlScheduler, and keeps the same statistics. Steps
+    that only compute run inline on the event loop; the sensor reads of the
+    BLOCKING_TASKS go to a small executor, one worker per device, and must
+    finish within their period, while everything they feed (filters,
+    alerts, stops) stays on the loop. A read that overruns, or is still in
+    flight at stop(), has its interrupt cancelled so the worker comes back
+    straight away with what it has instead of waiting out the sensor
+    timeout.
+
+    Build the controller with own_threads=False so it starts no scheduler
+    thread of its own, then await run().
+    """
+
+    def __init__(self, controller, blocking=None):
+        self.controller = controller
+        self.scheduler = controller.scheduler
+        self.blocking = dict(BLOCKING_TASKS if blocking is None else blocking)
+        self.interrupts = {'water_level': controller.water_sensor.echo_timer}
+        self.timeouts = 0  # hardware calls cut short at their deadline
+
+        self._loop = None
+        self._stopping = None
+        self._executor = None
+        self._devices = {}
+
+    async def run(self):
+        """Run every task until stop() is called or run() is cancelled"""
+        if self.scheduler._thread is not None:
+            raise ValueError("Controller runs its own scheduler thread; "
+                             "construct it with own_threads=False")
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        devices = sorted(set(device for device, read in self.blocking.values()))
+        self._devices = {device: asyncio.Lock() for device in devices}
+        self._executor = ThreadPoolExecutor(max(1, len(devices)),
+                                            thread_name_prefix='control-io')
+        tasks = []
+        try:
+            # One burst up front so the first control step never reads the bus itself
+            if not self.controller.temperatures.count:
+                await self._loop.run_in_executor(self._executor,
+                                                 self.controller.temperatures.sample)
+            tasks = [asyncio.create_task(self._run_periodic(task), name=task.name)
+                     for task in list(self.scheduler.tasks)]
+            await self._stopping.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._executor.shutdown(wait=True)
+            self._loop = None
+
+    def stop(self):
+        """Make run() return; safe to call from any thread"""
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._stopping.set)
+
+    async def _run_periodic(self, task):
+        clock_ns = self.scheduler.clock_ns
+        device, read = self.blocking.get(task.name, (None, None))
+        if read is not None:
+            read = read(self.controller)
+        while True:
+            delay_ns = task.next_deadline_ns - clock_ns()
+            if delay_ns > 0:
+                await asyncio.sleep(delay_ns / 1e9)
+            start_ns = clock_ns()
+            started = time.perf_counter_ns()
+            try:
+                if device is None:
+                    task.callback()
+                elif read is None:
+                    await self._offload(task, device, task.callback)
+                else:
+                    task.callback(await self._offload(task, device, read))
+            except Exception as e:
+                task.failures += 1
+                logging.error("Scheduled task %s failed: %s", task.name, e)
+            self.scheduler.finish_run(task, start_ns, started)
+
+    async def _offload(self, task, device, call):
+        """Run a blocking call on the executor within one period; its result
+
+        On overrun the call is interrupted and its (short) result still
+        returned, e.g. a burst with no echoes, which the step counts as a miss.
+        """
+        async with self._devices[device]:
+            future = self._loop.run_in_executor(self._executor, call)
+            # asyncio.wait rather than wait_for: it never swallows a cancel
+            # that lands as the call completes, so stop() always gets through
+            try:
+                done, pending = await asyncio.wait([future], timeout=task.period_ns / 1e9)
+                if pending:
+                    task.failures += 1
+                    self.timeouts += 1
+                    logging.error("Scheduled task %s missed its %.3f s deadline",
+                                  task.name, task.period_ns / 1e9)
+                    # Keep the device until the worker is back so calls never overlap
+                    self._interrupt(task.name, future)
+                    await asyncio.wait([future])
+            except asyncio.CancelledError:
+                self._interrupt(task.name, future)
+                raise
+            return future.result()
+
+    def _interrupt(self, name, future):
+        """Cut short the hardware call behind future, if it can be"""
+        interrupt = self.interrupts.get(name)
+        if interrupt is None:
+            future.add_done_callback(_consume)
+            return
+        interrupt.cancel()
+
+        def resume(done):
+            interrupt.resume()
+            _consume(done)
+        future.add_done_callback(resume)
+
+    async def snapshots(self):
+        """Each new state snapshot, newest only, for coroutines serving the state"""
+        loop = asyncio.get_running_loop()
+        wake = asyncio.Event()
+        channel = StateChannel(self.controller.state,
+                               lambda: loop.call_soon_threadsafe(wake.set))
+        try:
+            yield channel.take()
+            while True:
+                await wake.wait()
+                wake.clear()
+                yield channel.take()
+        finally:
+            channel.close()
+
+
+def _consume(future):
+    """Retrieve an abandoned call's outcome so asyncio does not warn about it"""
+    if not future.cancelled():
+        future.exception()
@@ -0,0 +1,258 @@
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import threading
+import time
+
+
+class StructuredQueueHandler(logging.Handler):
+    """Hands LogRecords to the writer thread without formatting them
+
+    Messages stay as (template, args) until the writer formats them, and a
+    full queue drops the record instead of blocking the caller.
+    """
+
+    def __init__(self, record_queue):
+        super().__init__()
+        self.queue = record_queue
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RepeatLimiter:
+    """Collapse identical messages repeated within `window` seconds"""
+
+    def __init__(self, window=10.0):
+        self.window = window
+        self.seen = {}  # (level, template, args) -> [first_time, suppressed, last repeat]
+
+    def check(self, record):
+        """Return the record to write, or None if it is a suppressed repeat"""
+        try:
+            key = (record.levelno, record.msg, record.args)
+            hash(key)
+        except TypeError:
+            return record
+
+        entry = self.seen.get(key)
+        if entry is not None and record.created - entry[0] < self.window:
+            entry[1] += 1
+            entry[2] = record
+            return None
+
+        if entry is not None and entry[1]:
+            record.msg = f"{record.msg} (repeated {entry[1]} times)"
+        self.seen[key] = [record.created, 0, None]
+        if len(self.seen) > 1000:
+            self.seen.clear()
+        return record
+
+    def expired(self, now, everything=False):
+        """Summaries of repeats whose window has closed (all of them if everything)
+
+        A message that stops recurring would otherwise never report how
+        often it was suppressed. Each summary is its last repeat.
+        """
+        summaries = []
+        for entry in self.seen.values():
+            if entry[1] and (everything or now - entry[0] >= self.window):
+                record = entry[2]
+                record.msg = f"{record.msg} (repeated {entry[1]} times)"
+                summaries.append(record)
+                entry[1], entry[2] = 0, None
+        return summaries
+
+
+def _gzip_rotator(source, dest):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+class AsyncLogPipeline:
+    """Queue-based logging: callers enqueue, one thread formats and writes
+
+    The writer drains the queue in batches, writes them through a rotating
+    file handler and flushes once per batch; rotated files are gzipped.
+    """
+
+    def __init__(self, path, max_bytes=1024 * 1024, backup_count=5, compress=True,
+                 queue_size=10000, batch_size=200, repeat_window=10.0,
+                 fmt='%(asctime)s - %(levelname)s - %(message)s'):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.handler = StructuredQueueHandler(self.queue)
+        self.batch_size = batch_size
+        self.limiter = RepeatLimiter(repeat_window)
+
+        self.file_handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+        self.file_handler.setFormatter(logging.Formatter(fmt))
+        if compress:
+            self.file_handler.namer = lambda name: name + '.gz'
+            self.file_handler.rotator = _gzip_rotator
+
+        self.written = 0
+        self.suppressed = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Write out everything queued so far, repeat counts included, and stop the writer"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.drain()
+        self._write(self.limiter.expired(time.time(), everything=True))
+        self.file_handler.close()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                first = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                first = None
+            if first is not None:
+                self._write_batch(first)
+            self._write(self.limiter.expired(time.time()))
+
+    def drain(self):
+        """Synchronously write whatever is queued (used by stop and tests)"""
+        while True:
+            try:
+                first = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            self._write_batch(first)
+
+    def _write_batch(self, first):
+        batch = [first]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        records = []
+        for record in batch:
+            record = self.limiter.check(record)
+            if record is None:
+                self.suppressed += 1
+            else:
+                records.append(record)
+        self._write(records)
+
+    def _write(self, records):
+        if not records:
+            return
+        handler = self.file_handler
+        with handler.lock:
+            for record in records:
+                try:
+                    if handler.shouldRollover(record):
+                        handler.doRollover()
+                    if handler.stream is None:
+                        handler.stream = handler._open()
+                    handler.stream.write(handler.format(record) + handler.terminator)
+                    self.written += 1
+                except Exception:
+                    handler.handleError(record)
+            if handler.stream is not None:
+                handler.stream.flush()
+
+
+class BackgroundWriter:
+    """One thread that runs the file writes queued by the control path
+
+    submit() only enqueues, so a slow disk never stalls a control task. A
+    job already waiting is not queued again, so a stalled disk cannot grow
+    the backlog either. Until start() (virtual clock, tests) jobs run
+    inline in submit().
+    """
+
+    def __init__(self, name='file-writer'):
+        self.name = name
+        self.queue = queue.Queue()
+        self.failures = 0
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Run every job queued so far and stop the writer"""
+        if self._thread is not None:
+            self.queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self.drain()
+
+    def submit(self, job):
+        """Queue job() for the writer thread; False if it is already waiting"""
+        if self._thread is None:
+            self._run_job(job)
+            return True
+        with self._lock:
+            if job in self._pending:
+                return False
+            self._pending.add(job)
+        self.queue.put(job)
+        return True
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            self._run_job(job)
+
+    def drain(self):
+        """Synchronously run whatever is queued (used by stop and tests)"""
+        while True:
+            try:
+                job = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if job is not None:
+                self._run_job(job)
+
+    def _run_job(self, job):
+        with self._lock:
+            self._pending.discard(job)
+        try:
+            job()
+        except Exception as e:
+            self.failures += 1
+            logging.error("Background write %s failed: %s", getattr(job, '__name__', job), e)
+
+
+_pipeline = None
+
+
+def setup_logging(path='coffee_machine.log', level=logging.INFO, **kwargs):
+    """Route the root logger through an AsyncLogPipeline (idempotent)"""
+    global _pipeline
+    if _pipeline is None:
+        _pipeline = AsyncLogPipeline(path, **kwargs)
+        _pipeline.start()
+        root = logging.getLogger()
+        root.addHandler(_pipeline.handler)
+        root.setLevel(level)
+    return _pipeline
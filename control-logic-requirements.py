@@ -1,212 +1,815 @@
-import RPi.GPIO as GPIO
-import spidev
+import asyncio
 import time
-import threading
 import tkinter as tk
 from tkinter import ttk, messagebox
 import json
+import os
+import signal
+import sys
+import threading
 from datetime import datetime
 import logging
 
+from async_core import AsyncControlCore
+from async_log import BackgroundWriter, setup_logging
+from daemon import ControlServer, DEFAULT_PORT
+from dosing import GravimetricDoser, DONE
+from forecast import DepletionForecast
+from hal import RPiBackend
+from hx711 import HX711
+from latency import LatencyMonitor, SENSOR_READ, CONTROL, ACTUATOR_WRITE
+from level_filter import LevelKalman, median
+from motion import SCurveProfile, TrapezoidProfile
+from preheat import KeepWarmSchedule, Preheater, READY
+from recipe import RecipePlan, compile_recipe, load_recipes
+from scheduler import ControlScheduler
+from state import MachineState, StatePublisher, StateChannel
+from telemetry import TelemetryRecorder
+from temperature_control import PIDTemperatureController
+from thermal_model import MPCTemperatureController, ThermalModel
+from thermocouple import TemperatureAcquisition
+from throughput import FlowModel, RunMetrics
+from ultrasonic import EchoTimer, speed_of_sound_cm_s
+
 class WaterLevelSensor:
-    def __init__(self, trigger_pin, echo_pin):
+    def __init__(self, trigger_pin, echo_pin, io, burst=3, ping_gap=0.01):
         self.trigger_pin = trigger_pin
         self.echo_pin = echo_pin
+        self.io = io
         
-        GPIO.setup(trigger_pin, GPIO.OUT)
-        GPIO.setup(echo_pin, GPIO.IN)
+        # Echo edges are timestamped from GPIO callbacks instead of polling
+        self.echo_timer = EchoTimer(io, trigger_pin, echo_pin, clock=io.clock_ns)
+        self.max_attempts = 3
+        
+        # Each sample is the median of a short burst of pings, fused by a
+        # Kalman filter that knows how fast the pump is draining the tank
+        self.burst = burst
+        self.ping_gap = ping_gap  # s, lets the previous ping's echoes die away
+        self.filter = LevelKalman()
+        self.missed = 0
+        self.last_sample_ns = None
+        self.max_age = 2.0  # s; an older estimate is discarded, not extrapolated
         
         self.tank_height = 30.0  # cm
+        self.tank_area = 300.0   # cm², so 1 cm of level is 300 mL
         self.min_water_level = 10.0  # 10% of tank height
         
+    def set_air_temperature(self, temp):
+        """Compensate the speed of sound for the air in the tank"""
+        self.echo_timer.speed_of_sound = speed_of_sound_cm_s(temp)
+        
     def measure_distance(self):
         """Measure water level using ultrasonic sensor"""
-        GPIO.output(self.trigger_pin, GPIO.HIGH)
-        time.sleep(0.00001)
-        GPIO.output(self.trigger_pin, GPIO.LOW)
-        
-        start_time = time.time()
-        stop_time = time.time()
+        for _ in range(self.max_attempts):
+            result = self.echo_timer.measure()
+            if result:
+                return result.distance_cm
+            logging.warning("Water level sensor: %s", result)
         
-        while GPIO.input(self.echo_pin) == 0:
-            start_time = time.time()
-            
-        while GPIO.input(self.echo_pin) == 1:
-            stop_time = time.time()
-            
-        time_elapsed = stop_time - start_time
-        distance = (time_elapsed * 34300) / 2  # Speed of sound = 343 m/s
+        raise Exception(f"No echo from water level sensor ({result.reason})")
+    
+    def measure_burst(self):
+        """Median distance of one burst of pings, or None if none echoed"""
+        distances = []
+        for i in range(self.burst):
+            if i:
+                self.io.sleep(self.ping_gap)
+            result = self.echo_timer.measure()
+            if result:
+                distances.append(result.distance_cm)
+        return median(distances) if distances else None
+    
+    def age(self):
+        """Seconds since the filter last took a sample"""
+        if self.last_sample_ns is None:
+            return float('inf')
+        return (self.io.clock_ns() - self.last_sample_ns) / 1e9
+    
+    def timed_burst(self):
+        """(clock ns the burst started, median distance or None); the blocking part"""
+        return self.io.clock_ns(), self.measure_burst()
+    
+    def sample(self, drain_ml_s=0.0, burst=None):
+        """One filter step: predict the drain since the last one, then fuse a burst
         
-        return distance
+        burst is a timed_burst() already taken elsewhere, e.g. off the event
+        loop; without one a burst is taken here.
+        """
+        started_ns, distance = burst if burst is not None else self.timed_burst()
+        if self.last_sample_ns is not None:
+            self.filter.predict((started_ns - self.last_sample_ns) / 1e9,
+                                drain_ml_s / self.tank_area)
+        self.last_sample_ns = started_ns
+        if distance is None:
+            self.missed += 1
+            if self.missed >= self.max_attempts:
+                raise Exception("No echo from water level sensor")
+            return
+        self.missed = 0
+        self.filter.update(self.tank_height - distance)
     
     def get_water_percentage(self):
-        """Get water level as percentage"""
-        distance = self.measure_distance()
-        water_height = self.tank_height - distance
-        percentage = (water_height / self.tank_height) * 100
+        """Get filtered water level as percentage"""
+        if self.age() > self.max_age:
+            # Nobody has been sampling; start over from a fresh burst
+            self.filter.reset()
+            self.last_sample_ns = None
+            self.sample()
+            if not self.filter.initialized:
+                self.filter.update(self.tank_height - self.measure_distance())
+        percentage = (self.filter.height / self.tank_height) * 100
         return max(0, min(100, percentage))
+    
+    def volume_ml(self, percentage):
+        """Tank contents in mL for a level percentage"""
+        return percentage / 100 * self.tank_height * self.tank_area
 
 class PowderLevelSensor:
-    def __init__(self, weight_pin):
+    def __init__(self, weight_pin, clock_pin, io, calibration_path=None):
         self.weight_pin = weight_pin
-        GPIO.setup(weight_pin, GPIO.IN)
+        self.clock_pin = clock_pin
+        # HX711 load cell amplifier: DOUT on weight_pin, SCK on clock_pin
+        self.load_cell = HX711(io, weight_pin, clock_pin, calibration_path=calibration_path)
         self.powder_max = 1000  # grams
         self.min_powder_level = 20.0  # 20% of max
         
+    def get_powder_weight(self):
+        """Filtered powder weight in grams"""
+        return self.load_cell.weight_grams()
+        
     def get_powder_percentage(self):
         """Get powder level as percentage using load cell"""
-        # Simulate load cell reading - replace with actual HX711 code
-        current_weight = 500  # Example weight in grams
+        current_weight = self.get_powder_weight()
         percentage = (current_weight / self.powder_max) * 100
         return max(0, min(100, percentage))
 
 class CirculationValve:
-    def __init__(self, valve_pin):
+    def __init__(self, valve_pin, io):
         self.valve_pin = valve_pin
-        GPIO.setup(valve_pin, GPIO.OUT)
+        self.io = io
+        io.setup(valve_pin, io.OUT)
+        self.circulating = False
         
     def set_circulation(self, circulate):
         """Control circulation valve"""
-        GPIO.output(self.valve_pin, GPIO.HIGH if circulate else GPIO.LOW)
+        self.io.output(self.valve_pin, self.io.HIGH if circulate else self.io.LOW)
+        self.circulating = bool(circulate)
+
+class TemperatureSensor:
+    def __init__(self, acquisition, channel):
+        self.acquisition = acquisition
+        self.channel = channel
+        
+    def read_temp(self):
+        """Filtered thermocouple temperature from the acquisition buffer"""
+        return self.acquisition.read_temp(self.channel)
+
+class MotorController:
+    """H-bridge motor with optional ramp profile and reversal interlock
+    
+    Speeds are signed percent; negative runs the motor in reverse. Without
+    a profile set_speed() applies immediately. With one, set_speed() only
+    sets the target and update(dt) ramps towards it, decelerating through
+    zero and holding both DIR inputs low for reversal_delay seconds before
+    driving the other way.
+    """
+    
+    SOFTWARE_PWM_MAX_HZ = 2000  # RPi.GPIO PWM jitter swamps anything faster
+    
+    def __init__(self, pwm_pin, dir1_pin, dir2_pin, io, frequency=1000,
+                 profile=None, reversal_delay=0.2):
+        self.pwm_pin = pwm_pin
+        self.dir1_pin = dir1_pin
+        self.dir2_pin = dir2_pin
+        self.io = io
+        self.profile = profile
+        self.reversal_delay = reversal_delay
+        
+        for pin in (dir1_pin, dir2_pin):
+            io.setup(pin, io.OUT)
+            io.output(pin, io.LOW)
+        
+        # A hardware PWM pin must stay in its ALT function; only the software
+        # fallback drives it as a plain GPIO output
+        self.pwm = io.hardware_pwm(pwm_pin, frequency)
+        self.hardware_timed = self.pwm is not None
+        if not self.hardware_timed:
+            io.setup(pwm_pin, io.OUT)
+            io.output(pwm_pin, io.LOW)
+            if frequency > self.SOFTWARE_PWM_MAX_HZ:
+                logging.warning("No hardware PWM on GPIO %s; using %s Hz software PWM",
+                                pwm_pin, self.SOFTWARE_PWM_MAX_HZ)
+                frequency = self.SOFTWARE_PWM_MAX_HZ
+            self.pwm = io.PWM(pwm_pin, frequency)
+        self.frequency = frequency
+        self.pwm.start(0)
+        
+        self.speed = 0
+        self.target = 0
+        self.direction = 0       # direction the bridge is driving: 1, -1 or 0
+        self.last_direction = 0  # last non-zero direction, for the reversal delay
+        self.stopped_for = 0.0
+        
+    def _drive(self, speed):
+        direction = (speed > 0) - (speed < 0)
+        if direction != self.direction:
+            # Break before make: never both DIR inputs high, even for an instant
+            self.io.output(self.dir1_pin, self.io.LOW)
+            self.io.output(self.dir2_pin, self.io.LOW)
+            if direction > 0:
+                self.io.output(self.dir1_pin, self.io.HIGH)
+            elif direction < 0:
+                self.io.output(self.dir2_pin, self.io.HIGH)
+            self.direction = direction
+            if direction:
+                self.last_direction = direction
+        self.pwm.ChangeDutyCycle(abs(speed))
+        self.speed = speed
+        
+    def set_speed(self, speed):
+        """Run at speed percent, negative for reverse (0 stops the motor)"""
+        self.target = max(-100, min(100, speed))
+        if self.profile is None:
+            self._drive(self.target)
+        
+    def set_frequency(self, frequency):
+        self.pwm.ChangeFrequency(frequency)
+        self.frequency = frequency
+        
+    def update(self, dt):
+        """Advance the ramp by dt seconds; call at a fixed rate"""
+        if self.profile is None:
+            return
+        
+        target = self.target
+        if target and self.speed and (target > 0) != (self.speed > 0):
+            target = 0  # decelerate through zero before reversing
+        
+        if self.speed == 0:
+            self.stopped_for += dt
+            reversing = target and self.last_direction and (target > 0) != (self.last_direction > 0)
+            if reversing and self.stopped_for < self.reversal_delay:
+                return
+        else:
+            self.stopped_for = 0.0
+        
+        speed = self.profile.step(self.speed, target, dt)
+        if speed != self.speed:
+            self._drive(speed)
+        
+    def stop(self):
+        """Cut the drive immediately, without ramping"""
+        self.target = 0
+        if self.profile is not None:
+            self.profile.reset()
+        self._drive(0)
+
+class HeaterController:
+    def __init__(self, heater_pin, io):
+        self.heater_pin = heater_pin
+        io.setup(heater_pin, io.OUT)
+        # Slow PWM on the SSR; zero-cross switching makes faster rates pointless
+        self.pwm = io.PWM(heater_pin, 1)
+        self.pwm.start(0)
+        self.power = 0
+        
+    def set_power(self, power):
+        """Set heater power in percent"""
+        power = max(0, min(100, power))
+        self.pwm.ChangeDutyCycle(power)
+        self.power = power
 
 class CoffeeMachineController:
-    def __init__(self):
-        # GPIO Setup
-        GPIO.setmode(GPIO.BCM)
+    def __init__(self, io=None, telemetry_path=None, load_cell_calibration=None,
+                 thermal_model=None, own_threads=True, metrics_path=None):
+        # I/O backend: real Raspberry Pi hardware unless a simulator is given
+        self.io = io if io is not None else RPiBackend()
+        self.io.setmode(self.io.BCM)
         
         # Temperature control parameters
         self.TEMP_MIN = 45.0
         self.TEMP_MAX = 60.0
         self.INITIAL_HEATER_POWER = 70  # Start at 70% power
         self.INITIAL_FLOW_RATE = 50     # Start at 50% flow
+        self.PREHEAT_FLOW_RATE = 10     # Pump speed while warming up on circulation
+        self.READY_MARGIN = 1.0         # °C below target that counts as ready
+        
+        # Control task periods in seconds
+        self.TEMP_CONTROL_PERIOD = 1.0
+        self.LEVEL_MONITOR_PERIOD = 5.0
+        self.TEMP_SAMPLE_RATE = 10.0  # Hz, both thermocouples per burst
+        self.LOAD_CELL_RATE = 80.0    # Hz, HX711 with RATE pin high
+        self.WATER_SAMPLE_RATE = 5.0  # Hz, one ping burst each
+        self.DOSING_PERIOD = 0.2
+        self.MOTOR_RAMP_PERIOD = 0.05
+        self.TELEMETRY_FLUSH_PERIOD = 10.0
+        self.METRICS_EXPORT_PERIOD = 15.0
+        
+        # Resource levels (%) that force a stop, and how far ahead to warn
+        self.WATER_STOP_LEVEL = 5.0
+        self.POWDER_STOP_LEVEL = 10.0
+        self.FORECAST_WINDOW = 300.0  # s of level history fitted
+        self.REFILL_WARNING = 600.0   # s before a forced stop
+        
+        # Plant parameters used by the temperature controller
+        self.PUMP_MAX_FLOW = 20.0    # mL/s at 100% pump speed
+        self.HEATER_WATTS = 2000.0
+        self.POWDER_MAX_FEED = 2.0   # g/s at 100% powder motor speed
+        self.MOTOR_PWM_FREQUENCY = 1000  # Hz
+        self.target_temp = (self.TEMP_MIN + self.TEMP_MAX) / 2
+        if isinstance(thermal_model, str):
+            thermal_model = ThermalModel.load(thermal_model)
+        if thermal_model is not None:
+            # Plan heater power ahead of scheduled flow changes
+            self.temp_controller = MPCTemperatureController(
+                thermal_model, self.TEMP_MIN, self.TEMP_MAX, self.INITIAL_FLOW_RATE,
+                flow_forecast=self.upcoming_flows)
+        else:
+            self.temp_controller = PIDTemperatureController(
+                self.TEMP_MIN, self.TEMP_MAX, self.INITIAL_FLOW_RATE,
+                heater_watts=self.HEATER_WATTS)
+        self.flow_plan = []  # (controller time s, pump speed %) changes still to come
+        
+        # Warm-up before the first cup, and optional idle holding temperatures
+        self.preheater = Preheater(self.PREHEAT_FLOW_RATE, self.READY_MARGIN)
+        self.keep_warm = KeepWarmSchedule()
+        self.keeping_warm = False
+        
+        # Recipes are compiled once on load; the running plan is stepped by elapsed time
+        self.recipes = {}
+        self.plan = None
+        self.stage = None
+        self.plan_started = None  # controller time the boiler became ready, None before
+        self.doser = GravimetricDoser(self.POWDER_MAX_FEED)
+        
+        # Flow estimate calibrated on tank level, and per-run throughput
+        self.flow_model = FlowModel(self.PUMP_MAX_FLOW)
+        self.metrics = RunMetrics(heater_watts=self.HEATER_WATTS)
+        self.batch_ml = None  # water volume that completes the batch, if the recipe sets one
+        
+        # Consumption-rate forecasts of when each resource forces a stop
+        self.water_forecast = DepletionForecast(self.WATER_STOP_LEVEL, self.FORECAST_WINDOW)
+        self.powder_forecast = DepletionForecast(self.POWDER_STOP_LEVEL, self.FORECAST_WINDOW)
         
         # Initialize sensors and actuators
-        self.temp_in = TemperatureSensor(0, 0)    # SPI0.0
-        self.temp_out = TemperatureSensor(0, 1)   # SPI0.1
-        self.water_sensor = WaterLevelSensor(16, 17)  # Trigger, Echo
-        self.powder_sensor = PowderLevelSensor(27)    # Weight sensor
-        self.circulation_valve = CirculationValve(22)  # Valve control
+        self.temperatures = TemperatureAcquisition(self.io, [(0, 0), (0, 1)], window=5)
+        self.temp_in = TemperatureSensor(self.temperatures, 0)    # SPI0.0
+        self.temp_out = TemperatureSensor(self.temperatures, 1)   # SPI0.1
+        self.water_sensor = WaterLevelSensor(16, 17, self.io)  # Trigger, Echo
+        self.powder_sensor = PowderLevelSensor(27, 5, self.io,  # HX711 DOUT, SCK
+                                               load_cell_calibration)
+        self.circulation_valve = CirculationValve(22, self.io)  # Valve control
         
         # Initialize motors
-        self.pump_motor = MotorController(18, 23, 24)  # PWM, DIR1, DIR2
-        self.powder_motor = MotorController(19, 25, 26)  # PWM, DIR1, DIR2
+        # The peristaltic pump gets a jerk-limited ramp so it neither stalls nor
+        # surges; the auger ramps hard so the dosing loop stays responsive
+        self.pump_motor = MotorController(18, 23, 24, self.io,  # PWM, DIR1, DIR2
+                                          self.MOTOR_PWM_FREQUENCY,
+                                          SCurveProfile(max_accel=50.0, jerk=200.0))
+        self.powder_motor = MotorController(19, 25, 26, self.io,  # PWM, DIR1, DIR2
+                                            self.MOTOR_PWM_FREQUENCY,
+                                            TrapezoidProfile(accel=200.0))
         
         # Initialize heater
-        self.heater = HeaterController(12)
-        
-        # System state
-        self.system_state = {
-            'water_level': 100.0,
-            'powder_level': 100.0,
-            'current_temp': 20.0,
-            'is_circulating': False,
-            'heater_power': self.INITIAL_HEATER_POWER,
-            'flow_rate': self.INITIAL_FLOW_RATE
-        }
-        
-        # Alerts state
-        self.alerts = {
-            'low_water': False,
-            'low_powder': False,
-            'temp_out_of_range': False
-        }
+        self.heater = HeaterController(12, self.io)
         
         # Control flags
         self.running = False
         self.emergency_stop = False
         
-        # Setup logging
-        logging.basicConfig(filename='coffee_machine.log',
-                          level=logging.INFO,
-                          format='%(asctime)s - %(levelname)s - %(message)s')
+        # System state and alerts, published as immutable snapshots
+        self.state = StatePublisher(MachineState(
+            running=False,
+            emergency_stop=False,
+            water_level=100.0,
+            powder_level=100.0,
+            current_temp=20.0,
+            inlet_temp=20.0,
+            is_circulating=False,
+            heater_power=self.INITIAL_HEATER_POWER,
+            flow_rate=self.INITIAL_FLOW_RATE,
+            powder_feed_rate=0.0,
+            powder_dispensed=0.0,
+            flow_ml_s=0.0,
+            dispensed_ml=0.0,
+            water_time_to_empty=None,
+            powder_time_to_empty=None,
+            batch_will_finish=None,
+            recipe=None,
+            stage=None,
+            preheating=False,
+            ready=False,
+            time_to_ready=None,
+            low_water=False,
+            low_powder=False,
+            temp_out_of_range=False,
+            refill_soon=False
+        ), self.io.clock_ns)
+        
+        # Setup logging: records are queued here and written by a background thread
+        self.log_pipeline = setup_logging('coffee_machine.log', level=logging.INFO)
+        
+        # High-rate binary history, flushed to telemetry_path if given
+        self.telemetry = TelemetryRecorder(path=telemetry_path)
+        
+        # File writes (telemetry, metrics) are queued here so they never block a control task
+        self.writer = BackgroundWriter()
         
-        # Start control threads
+        # Latency and jitter of every task and phase, written to metrics_path if given
+        self.latency = LatencyMonitor()
+        self.metrics_path = metrics_path
+        
+        # Start control tasks; without own_threads a FleetSupervisor or AsyncControlCore runs them
+        self.own_threads = own_threads
+        self.scheduler = ControlScheduler(self.io.clock_ns, self.io.sleep, self.latency)
         self.start_control_loops()
 
-    def temperature_control_loop(self):
-        """Temperature control with circulation logic"""
-        while not self.emergency_stop:
-            if self.running:
-                try:
-                    # Read temperatures
-                    temp_out = self.temp_out.read_temp()
-                    self.system_state['current_temp'] = temp_out
+    @property
+    def system_state(self):
+        """Read-only dict view of the latest snapshot"""
+        return self.state.current.state_dict()
+
+    @property
+    def alerts(self):
+        """Read-only dict view of the latest snapshot's alerts"""
+        return self.state.current.alerts_dict()
+
+    def publish_state(self, **changes):
+        """Publish one consistent snapshot including the control flags"""
+        return self.state.publish(running=self.running,
+                                  emergency_stop=self.emergency_stop, **changes)
+
+    def temperature_control_step(self):
+        """One tick of temperature control with circulation logic
+        
+        Runs the preheat until the boiler reaches the band, normal control
+        while running, and keep-warm while idle.
+        """
+        if self.emergency_stop:
+            return
+        keep_warm = None
+        if not self.running and not self.preheater.active:
+            keep_warm = self.keep_warm_target()
+            if keep_warm is None:
+                if self.keeping_warm:
+                    self.keeping_warm = False
+                    self.shutdown_outputs()
+                return
+        
+        try:
+            # Read temperatures
+            with self.latency.span('temperature_control', SENSOR_READ):
+                temp_in = self.temp_in.read_temp()
+                temp_out = self.temp_out.read_temp()
+            now = self.io.clock_ns() / 1e9
+            
+            with self.latency.span('temperature_control', CONTROL):
+                if self.preheater.active:
+                    command = self.preheater.update(now, temp_out)
+                    if not self.preheater.active:
+                        self.on_ready(now)
+                
+                if self.running and not self.preheater.active:
+                    # Apply any flow change that has come due
+                    while self.flow_plan and self.flow_plan[0][0] <= now:
+                        self.temp_controller.flow_rate = self.flow_plan.pop(0)[1]
                     
                     # Temperature control logic
-                    if temp_out < self.TEMP_MIN:
-                        # Increase heater power
-                        new_power = self.system_state['heater_power'] + 5
-                        self.heater.set_power(min(new_power, 100))
-                        self.system_state['heater_power'] = new_power
-                        # Reduce flow rate to allow more heating
-                        new_flow = self.system_state['flow_rate'] - 5
-                        self.pump_motor.set_speed(max(new_flow, 30))
-                        self.system_state['flow_rate'] = new_flow
-                        # Activate circulation
-                        self.circulation_valve.set_circulation(True)
-                        self.system_state['is_circulating'] = True
-                        
-                    elif temp_out > self.TEMP_MAX:
-                        # Decrease heater power
-                        new_power = self.system_state['heater_power'] - 5
-                        self.heater.set_power(max(new_power, 0))
-                        self.system_state['heater_power'] = new_power
-                        # Increase flow rate to cool down
-                        new_flow = self.system_state['flow_rate'] + 5
-                        self.pump_motor.set_speed(min(new_flow, 100))
-                        self.system_state['flow_rate'] = new_flow
-                        # Activate circulation
-                        self.circulation_valve.set_circulation(True)
-                        self.system_state['is_circulating'] = True
-                        
-                    else:
-                        # Temperature in range
-                        self.circulation_valve.set_circulation(False)
-                        self.system_state['is_circulating'] = False
-                    
-                    # Update temperature alert
-                    self.alerts['temp_out_of_range'] = not (self.TEMP_MIN <= temp_out <= self.TEMP_MAX)
-                    
-                    logging.info(f"Temp: {temp_out:.1f}°C, Power: {self.system_state['heater_power']}%, "
-                               f"Flow: {self.system_state['flow_rate']}%, Circulating: {self.system_state['is_circulating']}")
-                    
-                except Exception as e:
-                    logging.error(f"Temperature control error: {str(e)}")
-                    self.emergency_stop = True
-                    
-            time.sleep(1.0)
+                    flow_ml_s = self.flow_model.flow_ml_s(self.pump_motor.speed)
+                    command = self.temp_controller.update(self.target_temp, temp_in, temp_out,
+                                                          flow_ml_s, self.TEMP_CONTROL_PERIOD)
+                elif keep_warm is not None:
+                    self.keeping_warm = True
+                    command = self.preheater.keep_warm(keep_warm, temp_out,
+                                                       self.TEMP_CONTROL_PERIOD)
+            
+            with self.latency.span('temperature_control', ACTUATOR_WRITE):
+                self.heater.set_power(command.heater_power)
+                self.pump_motor.set_speed(command.flow_rate)
+                self.circulation_valve.set_circulation(command.circulate)
+            
+            # Publish readings, outputs and the temperature alert together
+            state = self.publish_state(
+                current_temp=temp_out,
+                inlet_temp=temp_in,
+                heater_power=self.heater.power,
+                flow_rate=self.pump_motor.speed,
+                flow_ml_s=self.flow_model.flow_ml_s(self.pump_motor.speed, command.circulate),
+                dispensed_ml=self.metrics.dispensed_ml,
+                is_circulating=command.circulate,
+                preheating=self.preheater.active,
+                ready=not self.preheater.active and
+                    self.preheater.is_hot(temp_out, self.target_temp),
+                time_to_ready=self.preheater.time_to_ready(temp_out),
+                temp_out_of_range=not (self.TEMP_MIN <= temp_out <= self.TEMP_MAX)
+            )
+            
+            # Lazy %-style args: formatting happens on the log writer thread
+            logging.info("Temp: %.1f°C, Power: %.1f%%, Flow: %s%%, Circulating: %s",
+                         temp_out, state.heater_power, state.flow_rate, state.is_circulating)
+            
+        except Exception as e:
+            logging.error("Temperature control error: %s", e)
+            self.emergency_stop = True
+            self.publish_state()
+
+    def keep_warm_target(self):
+        """Idle holding temperature, None to let the boiler cool
+        
+        After a preheat that was not followed by a start the boiler is held
+        at the target; otherwise the keep-warm schedule applies.
+        """
+        if self.preheater.phase == READY:
+            return self.target_temp
+        return self.keep_warm.target(self.time_of_day())
+
+    def time_of_day(self):
+        """Local wall-clock seconds after midnight, for the keep-warm schedule"""
+        now = datetime.now()
+        return now.hour * 3600 + now.minute * 60 + now.second
+
+    def set_keep_warm(self, periods):
+        """Idle holding temperatures: [('HH:MM', 'HH:MM', temp), ...]"""
+        self.keep_warm = KeepWarmSchedule(periods)
+
+    def preheat(self, target_temp=None):
+        """Warm the boiler up ahead of a start, e.g. at power-on
+        
+        Raises ValueError for a target_temp that is not a number within
+        TEMP_MIN..TEMP_MAX; the API reports it as a bad request.
+        """
+        if target_temp is not None:
+            if isinstance(target_temp, bool) or not isinstance(target_temp, (int, float)):
+                raise ValueError("target_temp must be a number")
+            if not self.TEMP_MIN <= target_temp <= self.TEMP_MAX:
+                raise ValueError(f"target_temp must be between {self.TEMP_MIN} and {self.TEMP_MAX}")
+        if self.emergency_stop:
+            return
+        if target_temp is not None:
+            self.target_temp = float(target_temp)
+        temp_out = self.temp_out.read_temp()
+        if self.preheater.start(self.io.clock_ns() / 1e9, temp_out, self.target_temp):
+            logging.info("Preheating from %.1f°C to %.1f°C", temp_out, self.target_temp)
+            self.apply_preheat()
+
+    def apply_preheat(self):
+        command = self.preheater.update(self.io.clock_ns() / 1e9, self.temp_out.read_temp())
+        self.heater.set_power(command.heater_power)
+        self.pump_motor.set_speed(command.flow_rate)
+        self.circulation_valve.set_circulation(command.circulate)
+        self.publish_state(heater_power=self.heater.power, flow_rate=self.pump_motor.speed,
+                           is_circulating=True, preheating=True, ready=False)
+
+    def on_ready(self, now):
+        """Hand over from preheat to normal control"""
+        logging.info("Ready after %.1f s of preheat", now - self.preheater.started)
+        if not self.running:
+            return
+        self.metrics.ready(now)
+        self.temp_controller.reset()
+        self.circulation_valve.set_circulation(False)
+        self.start_plan(now)
 
-    def level_monitoring_loop(self):
-        """Monitor water and powder levels"""
-        while not self.emergency_stop:
+    def water_level_step(self, burst=None):
+        """One ping burst into the water level filter (see WaterLevelSensor.sample)"""
+        if self.emergency_stop:
+            return
+        
+        try:
+            air_temp = self.temperatures.latest_temp(0)  # tank water sets the air temperature
+            if air_temp is not None:
+                self.water_sensor.set_air_temperature(air_temp)
+            drain = self.flow_model.flow_ml_s(self.pump_motor.speed,
+                                              self.circulation_valve.circulating)
+            with self.latency.span('water_level', SENSOR_READ):
+                self.water_sensor.sample(drain, burst)
+            
+        except Exception as e:
+            logging.error("Water level sensor error: %s", e)
             if self.running:
-                try:
-                    # Check water level
-                    water_level = self.water_sensor.get_water_percentage()
-                    self.system_state['water_level'] = water_level
-                    self.alerts['low_water'] = water_level < 10.0
-                    
-                    # Check powder level
-                    powder_level = self.powder_sensor.get_powder_percentage()
-                    self.system_state['powder_level'] = powder_level
-                    self.alerts['low_powder'] = powder_level < 20.0
-                    
-                    # Log levels
-                    logging.info(f"Water Level: {water_level:.1f}%, Powder Level: {powder_level:.1f}%")
-                    
-                    # Stop process if levels are critically low
-                    if water_level < 5.0 or powder_level < 10.0:
-                        logging.error("Critical resource level - stopping process")
-                        self.stop_process()
-                        
-                except Exception as e:
-                    logging.error(f"Level monitoring error: {str(e)}")
-                    self.emergency_stop = True
-                    
-            time.sleep(5.0)
+                self.emergency_stop = True
+                self.publish_state()
+
+    def level_monitoring_step(self):
+        """One check of water and powder levels"""
+        if self.emergency_stop or not self.running:
+            return
+        
+        try:
+            # Check water level
+            water_level = self.water_sensor.get_water_percentage()
+            self.flow_model.calibrate(self.water_sensor.volume_ml(water_level))
+            
+            # Check powder level
+            powder_level = self.powder_sensor.get_powder_percentage()
+            
+            forecast = self.forecast_depletion(water_level, powder_level)
+            
+            self.publish_state(
+                water_level=water_level,
+                powder_level=powder_level,
+                low_water=water_level < 10.0,
+                low_powder=powder_level < 20.0,
+                **forecast
+            )
+            
+            # Log levels
+            logging.info("Water Level: %.1f%%, Powder Level: %.1f%%", water_level, powder_level)
+            if forecast['refill_soon']:
+                logging.warning("Refill soon: water %s s, powder %s s to stop, batch finishes: %s",
+                                forecast['water_time_to_empty'], forecast['powder_time_to_empty'],
+                                forecast['batch_will_finish'])
+            
+            # Stop process if levels are critically low
+            if water_level < self.WATER_STOP_LEVEL or powder_level < self.POWDER_STOP_LEVEL:
+                logging.error("Critical resource level - stopping process")
+                self.stop_process()
+                
+        except Exception as e:
+            logging.error("Level monitoring error: %s", e)
+            self.emergency_stop = True
+            self.publish_state()
+
+    def powder_dosing_step(self):
+        """One tick of gravimetric powder dosing"""
+        if self.emergency_stop or not self.running or not self.doser.active:
+            return
+        
+        try:
+            with self.latency.span('powder_dosing', SENSOR_READ):
+                weight = self.powder_sensor.get_powder_weight()
+            with self.latency.span('powder_dosing', CONTROL):
+                command = self.doser.update(self.io.clock_ns() / 1e9, weight, self.DOSING_PERIOD)
+            with self.latency.span('powder_dosing', ACTUATOR_WRITE):
+                self.powder_motor.set_speed(command.motor_speed)
+            self.metrics.powder_g = command.dispensed
+            self.publish_state(powder_feed_rate=command.feed_rate,
+                               powder_dispensed=command.dispensed)
+            
+            if command.phase == DONE:
+                logging.info("Powder dose complete: %.1f g", command.dispensed)
+                
+        except Exception as e:
+            logging.error("Powder dosing error: %s", e)
+            self.emergency_stop = True
+            self.publish_state()
+
+    def schedule_flow(self, delay, speed):
+        """Change the pump speed delay seconds from now"""
+        when = self.io.clock_ns() / 1e9 + delay
+        self.flow_plan = sorted(self.flow_plan + [(when, speed)])
+
+    def upcoming_flows(self, steps, dt):
+        """Fresh-water flow (mL/s) expected for each of the next steps"""
+        now = self.io.clock_ns() / 1e9
+        speed = self.temp_controller.flow_rate
+        plan = list(self.flow_plan)
+        flows = []
+        for k in range(steps):
+            while plan and plan[0][0] <= now + k * dt:
+                speed = plan.pop(0)[1]
+            flows.append(self.flow_model.flow_ml_s(speed))
+        return flows
+
+    def forecast_depletion(self, water_level, powder_level):
+        """Time-to-stop per resource and whether the batch will finish first
+        
+        Fits the levels recorded in telemetry since the run started, plus
+        the readings just taken.
+        """
+        now = self.io.clock_ns() / 1e9
+        count = int(self.FORECAST_WINDOW * self.TEMP_SAMPLE_RATE)
+        start = self.metrics.started
+        history = zip(self.telemetry.recent('time', count),
+                      self.telemetry.recent('water_level', count),
+                      self.telemetry.recent('powder_level', count))
+        # One point per second is plenty for a straight-line fit
+        points = [p for p in history if p[0] >= start][::int(self.TEMP_SAMPLE_RATE)]
+        points.append((now, water_level, powder_level))
+        times, water, powder = zip(*points)
+        
+        water_left = self.water_forecast.update(times, water)
+        powder_left = self.powder_forecast.update(times, powder)
+        
+        known = [t for t in (water_left, powder_left) if t is not None]
+        time_to_stop = min(known) if known else None
+        remaining = self.batch_remaining_s()
+        if remaining is None or not (self.water_forecast.known and self.powder_forecast.known):
+            will_finish = None
+        else:
+            will_finish = time_to_stop is None or remaining <= time_to_stop
+        refill_soon = will_finish is False or \
+            (time_to_stop is not None and time_to_stop < self.REFILL_WARNING)
+        
+        return {
+            'water_time_to_empty': water_left,
+            'powder_time_to_empty': powder_left,
+            'batch_will_finish': will_finish,
+            'refill_soon': refill_soon
+        }
+
+    def batch_remaining_s(self):
+        """Seconds until the batch targets are met, None without a target"""
+        remaining = []
+        if self.doser.active and self.doser.total_grams is not None:
+            rate = self.doser.feed_rate or self.doser.rate_g_s
+            remaining.append(max(0.0, self.doser.total_grams - self.doser.dispensed) / rate)
+        if self.batch_ml is not None:
+            flow = self.flow_model.flow_ml_s(self.pump_motor.speed)
+            if flow > 0:
+                remaining.append(max(0.0, self.batch_ml - self.metrics.dispensed_ml) / flow)
+        return max(remaining) if remaining else None
+
+    def throughput_step(self):
+        """Integrate estimated flow and heater on-time for the run metrics"""
+        if self.emergency_stop or not self.running:
+            return
+        dt = 1.0 / self.TEMP_SAMPLE_RATE
+        drawn = self.flow_model.integrate(self.pump_motor.speed,
+                                          self.circulation_valve.circulating, dt)
+        self.metrics.add(dt, drawn, self.heater.power)
+        
+        if self.batch_ml is not None and self.metrics.dispensed_ml >= self.batch_ml:
+            logging.info("Batch complete: %.0f mL", self.metrics.dispensed_ml)
+            self.stop_process()
+
+    def motor_ramp_step(self):
+        """Advance both motor ramps by one period"""
+        self.pump_motor.update(self.MOTOR_RAMP_PERIOD)
+        self.powder_motor.update(self.MOTOR_RAMP_PERIOD)
+
+    def start_dosing(self, rate_g_s, total_grams=None):
+        """Start powder dosing at rate_g_s, stopping after total_grams if given"""
+        if rate_g_s <= 0:
+            self.doser.stop()
+            self.powder_motor.set_speed(0)
+            self.publish_state(powder_feed_rate=0.0)
+            return
+        
+        command = self.doser.start(self.io.clock_ns() / 1e9,
+                                   self.powder_sensor.get_powder_weight(),
+                                   rate_g_s, total_grams)
+        self.powder_motor.set_speed(command.motor_speed)
+
+    def load_recipes(self, path):
+        """Compile the recipes in a JSON file, replacing the loaded set
+        
+        Compilation happens here, off the control path; a bad file leaves
+        the current recipes in place.
+        """
+        self.recipes = load_recipes(path, self.target_temp, self.INITIAL_FLOW_RATE,
+                                    self.POWDER_MAX_FEED, (self.TEMP_MIN, self.TEMP_MAX),
+                                    self.TEMP_CONTROL_PERIOD)
+        logging.info("Loaded recipes from %s: %s", path, ", ".join(self.recipes))
+
+    def compile_recipe(self, recipe):
+        """RecipePlan for a plan, a loaded recipe's name or a recipe dict"""
+        if isinstance(recipe, RecipePlan):
+            return recipe
+        if isinstance(recipe, str):
+            if recipe not in self.recipes:
+                raise Exception(f"Unknown recipe: {recipe}")
+            return self.recipes[recipe]
+        return compile_recipe(recipe, self.target_temp, self.INITIAL_FLOW_RATE,
+                              self.POWDER_MAX_FEED, (self.TEMP_MIN, self.TEMP_MAX),
+                              self.TEMP_CONTROL_PERIOD)
+
+    def start_plan(self, now):
+        """Run the plan's stages from now; later flow changes go in the flow plan"""
+        self.plan_started = now
+        self.stage = None
+        self.flow_plan = []
+        for stage in self.plan.stages[1:]:
+            self.schedule_flow(stage.start, stage.flow_rate)
+        self.recipe_step()
+
+    def apply_stage(self, stage):
+        """Setpoints for a new stage"""
+        self.target_temp = stage.target_temp
+        self.temp_controller.flow_rate = stage.flow_rate
+        self.pump_motor.set_speed(stage.flow_rate)
+        self.start_dosing(stage.powder_g_s, stage.powder_grams)
+        self.publish_state(stage=stage.kind, flow_rate=self.pump_motor.speed)
+        logging.info("Recipe %s: %s stage at %.1f°C, flow %.0f%%, powder %.2f g/s",
+                     self.plan.name, stage.kind, stage.target_temp, stage.flow_rate,
+                     stage.powder_g_s)
+
+    def recipe_step(self):
+        """Advance the running plan to the stage for the elapsed time"""
+        if self.emergency_stop or not self.running or self.plan_started is None:
+            return
+        stage = self.plan.stage_at(self.io.clock_ns() / 1e9 - self.plan_started)
+        if stage is None:
+            logging.info("Recipe %s complete", self.plan.name)
+            self.stop_process()
+        elif stage is not self.stage:
+            self.stage = stage
+            self.apply_stage(stage)
 
     def start_process(self, recipe):
-        """Start processing with given recipe"""
+        """Start processing with a recipe dict, a loaded recipe's name or a RecipePlan"""
+        # A bad recipe is refused before anything is touched
+        plan = self.compile_recipe(recipe)
         try:
             # Check initial conditions
             water_level = self.water_sensor.get_water_percentage()
@@ -218,25 +821,183 @@ class CoffeeMachineController:
                 raise Exception("Powder level too low to start")
             
             # Initialize system
-            self.heater.set_power(self.INITIAL_HEATER_POWER)
-            self.pump_motor.set_speed(self.INITIAL_FLOW_RATE)
-            self.circulation_valve.set_circulation(False)
-            
+            self.plan = plan
+            self.plan_started = None
+            self.target_temp = plan.preheat_temp
+            self.temp_controller.reset()
+            self.temp_controller.flow_rate = plan.stages[0].flow_rate
+            self.flow_plan = []
+            self.batch_ml = plan.batch_ml
+            now = self.io.clock_ns() / 1e9
+            self.metrics.start(now)
+            self.keeping_warm = False
             self.running = True
-            logging.info(f"Starting process with recipe: {recipe}")
+            
+            if self.preheater.start(now, self.temp_out.read_temp(), self.target_temp):
+                # Cold boiler: heat on circulation first, the plan starts once ready
+                self.apply_preheat()
+            else:
+                self.metrics.ready(now)
+                self.heater.set_power(self.INITIAL_HEATER_POWER)
+                self.circulation_valve.set_circulation(False)
+                self.start_plan(now)
+            
+            self.publish_state(
+                recipe=plan.name,
+                water_level=water_level,
+                powder_level=powder_level,
+                powder_feed_rate=0.0,
+                powder_dispensed=0.0,
+                dispensed_ml=0.0,
+                water_time_to_empty=None,
+                powder_time_to_empty=None,
+                batch_will_finish=None,
+                refill_soon=False,
+                heater_power=self.heater.power,
+                flow_rate=self.pump_motor.speed,
+                is_circulating=self.circulation_valve.circulating
+            )
+            logging.info("Starting process with recipe: %s", plan)
             
         except Exception as e:
-            logging.error(f"Error starting process: {str(e)}")
+            logging.error("Error starting process: %s", e)
+            self.running = False
             self.emergency_stop = True
+            self.publish_state()
             raise
 
+    def shutdown_outputs(self):
+        """Turn off heater, motors and circulation"""
+        self.heater.set_power(0)
+        self.pump_motor.stop()
+        self.doser.stop()
+        self.powder_motor.stop()
+        self.circulation_valve.set_circulation(False)
+        self.publish_state(heater_power=0, flow_rate=0, flow_ml_s=0.0, powder_feed_rate=0.0,
+                           is_circulating=False, preheating=False, ready=False,
+                           time_to_ready=None)
+
+    def stop_process(self):
+        """Normal shutdown of the running process"""
+        self.running = False
+        self.preheater.stop()
+        self.plan_started = None
+        self.shutdown_outputs()
+        self.metrics.stop(self.io.clock_ns() / 1e9)
+        logging.info("Process stopped")
+        logging.info("Run summary: %s", self.run_summary())
+
+    def run_summary(self):
+        """Throughput of the current or last run"""
+        return self.metrics.summary(self.io.clock_ns() / 1e9)
+
+    def emergency_stop_process(self):
+        """Immediately stop everything and halt the control loops"""
+        self.emergency_stop = True
+        self.running = False
+        self.preheater.stop()
+        self.shutdown_outputs()
+        self.scheduler.stop()
+        self.flush_telemetry()  # keep the lead-up for post-mortem analysis
+        logging.critical("Emergency stop activated")
+
+    def latency_report(self):
+        """Latency histograms and overrun counters of every control task"""
+        return self.latency.snapshot(self.scheduler.stats())
+
+    def export_metrics(self):
+        """Have the writer thread rewrite metrics_path with the latest latencies"""
+        self.writer.submit(self.write_metrics)
+    
+    def write_metrics(self):
+        self.latency.write(self.metrics_path, self.scheduler.stats())
+
+    def flush_telemetry(self):
+        """Have the writer thread append unflushed telemetry to the capture"""
+        self.writer.submit(self.telemetry.flush)
+    
+    def record_telemetry(self):
+        """Append the latest raw temperatures and published state to history"""
+        if not self.temperatures.count:
+            return
+        state = self.state.current
+        self.telemetry.record(
+            self.io.clock_ns() / 1e9,
+            self.temperatures.latest_temp(0),
+            self.temperatures.latest_temp(1),
+            state.heater_power,
+            state.flow_rate,
+            state.water_level,
+            state.powder_level,
+            state.is_circulating
+        )
+
+    def start_control_loops(self):
+        """Schedule temperature control and level monitoring
+
+        On real hardware the scheduler runs on its own thread unless a
+        FleetSupervisor or AsyncControlCore drives it (own_threads=False);
+        on a virtual clock the caller drives it with scheduler.run_for().
+        """
+        # Added first so a fresh burst precedes a control tick on the same deadline
+        self.scheduler.add_task('temperature_acquisition', 1.0 / self.TEMP_SAMPLE_RATE,
+                                self.temperatures.sample)
+        self.scheduler.add_task('recipe', self.TEMP_CONTROL_PERIOD, self.recipe_step)
+        self.scheduler.add_task('temperature_control', self.TEMP_CONTROL_PERIOD,
+                                self.temperature_control_step)
+        self.scheduler.add_task('water_level', 1.0 / self.WATER_SAMPLE_RATE,
+                                self.water_level_step)
+        self.scheduler.add_task('level_monitoring', self.LEVEL_MONITOR_PERIOD,
+                                self.level_monitoring_step)
+        self.scheduler.add_task('powder_dosing', self.DOSING_PERIOD,
+                                self.powder_dosing_step)
+        self.scheduler.add_task('throughput', 1.0 / self.TEMP_SAMPLE_RATE,
+                                self.throughput_step)
+        self.scheduler.add_task('motor_ramp', self.MOTOR_RAMP_PERIOD,
+                                self.motor_ramp_step)
+        self.scheduler.add_task('telemetry', 1.0 / self.TEMP_SAMPLE_RATE,
+                                self.record_telemetry)
+        if self.telemetry.path:
+            self.scheduler.add_task('telemetry_flush', self.TELEMETRY_FLUSH_PERIOD,
+                                    self.flush_telemetry, phase=self.TELEMETRY_FLUSH_PERIOD)
+        if self.metrics_path:
+            self.scheduler.add_task('metrics_export', self.METRICS_EXPORT_PERIOD,
+                                    self.export_metrics, phase=self.METRICS_EXPORT_PERIOD)
+        if self.io.realtime and (self.telemetry.path or self.metrics_path):
+            self.writer.start()
+        if self.io.realtime and self.own_threads:
+            # The HX711 paces itself; poll it on its own thread
+            self.powder_sensor.load_cell.start()
+            self.scheduler.start()
+        elif self.io.realtime:
+            # Supervised: the load cell becomes one more task on the shared pool
+            self.scheduler.add_task('load_cell', 1.0 / self.LOAD_CELL_RATE,
+                                    self.powder_sensor.load_cell.sample)
+        else:
+            # Simulated conversions are instant; 10 Hz keeps the filter window
+            # well ahead of the level check without bit-banging every 12.5 ms
+            self.scheduler.add_task('load_cell', 1.0 / min(self.LOAD_CELL_RATE, 10.0),
+                                    self.powder_sensor.load_cell.sample)
+
 class GUI(tk.Tk):
-    def __init__(self, controller):
+    def __init__(self, controller, max_refresh_hz=10.0):
         super().__init__()
         
         self.controller = controller
         self.title("Coffee Machine Control")
         
+        # Display refresh is driven by state changes, capped at max_refresh_hz
+        self.min_refresh_interval = 1.0 / max_refresh_hz
+        self.last_refresh = 0.0
+        self.refresh_scheduled = None
+        self.rendered = {}
+        self.alert_shown = False
+        
+        # Tk is not thread-safe: the control thread only sets this flag and
+        # the Tk thread polls it, twice per refresh interval
+        self.state_changed = threading.Event()
+        self.poll_interval_ms = max(1, int(self.min_refresh_interval * 500))
+        
         # Create frames
         self.status_frame = ttk.LabelFrame(self, text="System Status")
         self.status_frame.grid(row=0, column=0, padx=5, pady=5, sticky="nsew")
@@ -245,7 +1006,10 @@ class GUI(tk.Tk):
         self.control_frame.grid(row=1, column=0, padx=5, pady=5, sticky="nsew")
         
         self.setup_gui()
-        self.update_timer = self.after(1000, self.update_status)
+        
+        self.state_channel = StateChannel(controller.state, self.state_changed.set)
+        self.after_idle(self.update_status)
+        self.after(self.poll_interval_ms, self.poll_state_changed)
 
     def setup_gui(self):
         # Status indicators
@@ -261,6 +1025,22 @@ class GUI(tk.Tk):
         self.powder_label = ttk.Label(self.status_frame, text="--%")
         self.powder_label.grid(row=2, column=1, sticky="w")
         
+        ttk.Label(self.status_frame, text="Powder Feed:").grid(row=3, column=0, sticky="w")
+        self.feed_label = ttk.Label(self.status_frame, text="-.-- g/s")
+        self.feed_label.grid(row=3, column=1, sticky="w")
+        
+        ttk.Label(self.status_frame, text="Flow:").grid(row=4, column=0, sticky="w")
+        self.flow_label = ttk.Label(self.status_frame, text="-.- mL/s")
+        self.flow_label.grid(row=4, column=1, sticky="w")
+        
+        ttk.Label(self.status_frame, text="Refill In:").grid(row=5, column=0, sticky="w")
+        self.refill_label = ttk.Label(self.status_frame, text="--:--")
+        self.refill_label.grid(row=5, column=1, sticky="w")
+        
+        ttk.Label(self.status_frame, text="Boiler:").grid(row=6, column=0, sticky="w")
+        self.ready_label = ttk.Label(self.status_frame, text="Cold")
+        self.ready_label.grid(row=6, column=1, sticky="w")
+        
         # Control buttons
         ttk.Button(self.control_frame, text="Start", 
                   command=self.start_process).grid(row=0, column=0, padx=5)
@@ -268,50 +1048,104 @@ class GUI(tk.Tk):
                   command=self.stop_process).grid(row=0, column=1, padx=5)
         ttk.Button(self.control_frame, text="Emergency Stop", 
                   command=self.emergency_stop).grid(row=0, column=2, padx=5)
+        ttk.Button(self.control_frame, text="Preheat", 
+                  command=self.controller.preheat).grid(row=0, column=3, padx=5)
+        
+        ttk.Label(self.control_frame, text="Recipe:").grid(row=1, column=0, sticky="w")
+        self.recipe_choice = ttk.Combobox(self.control_frame, state="readonly",
+                                          values=["Default"] + list(self.controller.recipes))
+        self.recipe_choice.current(0)
+        self.recipe_choice.grid(row=1, column=1, columnspan=3, sticky="we", padx=5)
+
+    def poll_state_changed(self):
+        """On the Tk thread: refresh if the control thread flagged a new snapshot"""
+        if self.state_changed.is_set():
+            self.state_changed.clear()
+            self.on_state_changed()
+        self.after(self.poll_interval_ms, self.poll_state_changed)
+
+    def on_state_changed(self):
+        """Refresh now, or once the refresh interval has passed"""
+        if self.refresh_scheduled is not None:
+            return
+        wait = self.last_refresh + self.min_refresh_interval - time.monotonic()
+        if wait > 0:
+            self.refresh_scheduled = self.after(int(wait * 1000) + 1, self.update_status)
+        else:
+            self.update_status()
+
+    def set_label(self, label, text, alert):
+        """Reconfigure a label only when what it shows has changed"""
+        shown = (text, alert)
+        if self.rendered.get(label) != shown:
+            label.config(text=text, foreground="red" if alert else "black")
+            self.rendered[label] = shown
 
     def update_status(self):
         """Update status display"""
-        if self.controller.running:
-            # Update temperature
-            self.temp_label.config(
-                text=f"{self.controller.system_state['current_temp']:.1f}°C",
-                foreground="red" if self.controller.alerts['temp_out_of_range'] else "black"
-            )
-            
-            # Update water level
-            self.water_label.config(
-                text=f"{self.controller.system_state['water_level']:.1f}%",
-                foreground="red" if self.controller.alerts['low_water'] else "black"
-            )
-            
-            # Update powder level
-            self.powder_label.config(
-                text=f"{self.controller.system_state['powder_level']:.1f}%",
-                foreground="red" if self.controller.alerts['low_powder'] else "black"
-            )
-            
-            # Check for alerts
-            alerts = []
-            if self.controller.alerts['low_water']:
-                alerts.append("Low Water Level!")
-            if self.controller.alerts['low_powder']:
-                alerts.append("Low Powder Level!")
-            if self.controller.alerts['temp_out_of_range']:
-                alerts.append("Temperature Out of Range!")
-            
-            if alerts and not hasattr(self, 'alert_shown'):
-                self.alert_shown = True
-                messagebox.showwarning("System Alerts", "\n".join(alerts))
+        self.refresh_scheduled = None
+        self.last_refresh = time.monotonic()
         
-        self.update_timer = self.after(1000, self.update_status)
+        # One snapshot per refresh so all labels agree with each other
+        state = self.state_channel.take()
+        
+        self.set_label(self.temp_label, f"{state.current_temp:.1f}°C", state.temp_out_of_range)
+        self.set_label(self.water_label, f"{state.water_level:.1f}%", state.low_water)
+        self.set_label(self.powder_label, f"{state.powder_level:.1f}%", state.low_powder)
+        self.set_label(self.feed_label,
+                       f"{state.powder_feed_rate:.2f} g/s ({state.powder_dispensed:.1f} g)", False)
+        self.set_label(self.flow_label,
+                       f"{state.flow_ml_s:.1f} mL/s ({state.dispensed_ml:.0f} mL)", False)
+        self.set_label(self.refill_label, self.format_refill(state), state.refill_soon)
+        self.set_label(self.ready_label, self.format_ready(state), False)
+        
+        # Check for alerts
+        alerts = []
+        if state.low_water:
+            alerts.append("Low Water Level!")
+        if state.low_powder:
+            alerts.append("Low Powder Level!")
+        if state.temp_out_of_range:
+            alerts.append("Temperature Out of Range!")
+        if state.refill_soon:
+            alerts.append("Refill Soon - Batch Will Not Finish!" if state.batch_will_finish is False
+                          else "Refill Soon!")
+        
+        # A cold boiler is expected while preheating
+        if alerts and state.running and not state.preheating and not self.alert_shown:
+            self.alert_shown = True
+            messagebox.showwarning("System Alerts", "\n".join(alerts))
+
+    def format_refill(self, state):
+        """Time until the first resource forces a stop, as mm:ss"""
+        known = [t for t in (state.water_time_to_empty, state.powder_time_to_empty)
+                 if t is not None]
+        if not known:
+            return "--:--"
+        minutes, seconds = divmod(int(min(known)), 60)
+        text = f"{minutes}:{seconds:02d}"
+        if state.batch_will_finish is not None:
+            text += " (batch finishes)" if state.batch_will_finish else " (batch won't finish)"
+        return text
+
+    def format_ready(self, state):
+        if state.ready:
+            return "Ready"
+        if state.preheating:
+            if state.time_to_ready is None:
+                return "Preheating"
+            return f"Preheating ({int(state.time_to_ready)} s)"
+        return "Cold"
 
     def start_process(self):
         try:
-            recipe = {
-                'target_temp': 52.5,  # Middle of range 45-60
-                'flow_rate': self.controller.INITIAL_FLOW_RATE,
-                'powder_rate': 50.0
-            }
+            recipe = self.recipe_choice.get()
+            if recipe not in self.controller.recipes:
+                recipe = {
+                    'target_temp': 52.5,  # Middle of range 45-60
+                    'flow_rate': self.controller.INITIAL_FLOW_RATE,
+                    'powder_rate': 50.0
+                }
             self.controller.start_process(recipe)
             self.alert_shown = False
         except Exception as e:
@@ -325,10 +1159,62 @@ class GUI(tk.Tk):
         self.quit()
 
 if __name__ == "__main__":
+    # --headless serves the local API instead of opening the Tk window:
+    #   --api-port 8765 (localhost) or --api-socket /run/coffee_machine.sock
+    # and with --async runs the control tasks as coroutines on the main thread.
+    # --metrics-file coffee_machine.prom rewrites control-loop latency every 15 s.
+    # Commands need the API token from COFFEE_MACHINE_TOKEN, or else a random one
+    # written to --api-token-file (coffee_machine.token, owner-only) for the UI
+    headless = '--headless' in sys.argv
+    use_asyncio = headless and '--async' in sys.argv
+    metrics_path = sys.argv[sys.argv.index('--metrics-file') + 1] \
+        if '--metrics-file' in sys.argv else None
+    # The controller attaches to this same pipeline; stopping it writes out what is queued
+    log_pipeline = setup_logging('coffee_machine.log', level=logging.INFO)
+    io = RPiBackend()
     try:
-        controller = CoffeeMachineController()
-        gui = GUI(controller)
-        gui.mainloop()
+        controller = CoffeeMachineController(io, telemetry_path='coffee_machine.tlm',
+                                             load_cell_calibration='load_cell_calibration.json',
+                                             thermal_model=('thermal_model.json'
+                                                            if os.path.exists('thermal_model.json')
+                                                            else None),
+                                             own_threads=not use_asyncio,
+                                             metrics_path=metrics_path)
+        if os.path.exists('config.json'):
+            controller.load_recipes('config.json')
+        if headless:
+            port = int(sys.argv[sys.argv.index('--api-port') + 1]) \
+                if '--api-port' in sys.argv else DEFAULT_PORT
+            unix_path = sys.argv[sys.argv.index('--api-socket') + 1] \
+                if '--api-socket' in sys.argv else None
+            token_path = sys.argv[sys.argv.index('--api-token-file') + 1] \
+                if '--api-token-file' in sys.argv else 'coffee_machine.token'
+            server = ControlServer(controller, port=port, unix_path=unix_path,
+                                   token=os.environ.get('COFFEE_MACHINE_TOKEN'))
+            server.write_token(token_path)
+            logging.info("Serving controller API on %s", server.address)
+            # systemd stops services with SIGTERM; shut the outputs down like Ctrl-C
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            try:
+                if use_asyncio:
+                    server.start()
+                    asyncio.run(AsyncControlCore(controller).run())
+                else:
+                    server.serve_forever()
+            except (KeyboardInterrupt, SystemExit):
+                pass
+            if use_asyncio:
+                server.stop()
+            controller.stop_process()
+            controller.scheduler.stop()
+            controller.flush_telemetry()
+            controller.writer.stop()
+            io.cleanup()
+        else:
+            gui = GUI(controller)
+            gui.mainloop()
     except Exception as e:
-        logging.critical(f"System crash: {str(e)}")
-        GPIO.cleanup()
+        logging.exception("System crash: %s", e)
+        io.cleanup()
+    finally:
+        log_pipeline.stop()
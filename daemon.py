@@ -0,0 +1,346 @@
+import hmac
+import json
+import logging
+import os
+import secrets
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from state import StateChannel
+from stream import StreamClient, STREAM_FIELDS, TEXT, BINARY, CLOSE, PING, PONG, \
+    MAX_CLIENT_PAYLOAD, FrameError, websocket_accept, encode_ws_frame, read_ws_frame
+
+DEFAULT_PORT = 8765
+KEEPALIVE_INTERVAL = 15.0  # s between SSE comments on an idle stream
+DEFAULT_STREAM_RATE = 10.0  # frames/s per WebSocket client unless it asks for less
+
+# Every POST and the /stream upgrade must carry the per-launch API token. Page
+# scripts cannot set headers on a WebSocket, so there it may instead be offered
+# as a subprotocol alongside WEBSOCKET_PROTOCOL.
+TOKEN_HEADER = 'X-Coffee-Machine-Token'
+WEBSOCKET_PROTOCOL = 'coffee-machine'
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    """JSON requests against the controller, plus a server-sent event stream
+
+    GET  /state            latest snapshot
+    GET  /summary          throughput of the current or last run
+    GET  /recipes          loaded recipes and their stages
+    GET  /latency          control-loop latency histograms and overrun counters
+    GET  /metrics          the same in Prometheus text format
+    GET  /events           text/event-stream of snapshots as they change
+    GET  /stream           WebSocket of changed fields only; ?rate=Hz&format=binary
+    POST /start            body is a recipe, or {"recipe": name} for a loaded one
+    POST /stop, /emergency-stop
+    POST /preheat          optional {"target_temp": °C}
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def api(self):
+        return self.server.api
+
+    def log_message(self, fmt, *args):
+        logging.debug("API %s " + fmt, self.client_address, *args)
+
+    def do_OPTIONS(self):
+        # CORS preflight from the Electron page (file:// sends Origin: null)
+        self.send_response(204)
+        self.send_cors_headers()
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', f'Content-Type, {TOKEN_HEADER}')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/events':
+            self.stream_events()
+            return
+        if url.path == '/stream':
+            self.stream_websocket(parse_qs(url.query))
+            return
+        if url.path == '/metrics':
+            controller = self.api.controller
+            self.send_text(200, controller.latency.to_prometheus(controller.scheduler.stats()),
+                           'text/plain; version=0.0.4')
+            return
+        routes = {
+            '/state': lambda body: self.api.controller.state.current.as_dict(),
+            '/summary': lambda body: self.api.controller.run_summary(),
+            '/recipes': lambda body: {name: [stage._asdict() for stage in plan.stages]
+                                      for name, plan in self.api.controller.recipes.items()},
+            '/latency': lambda body: self.api.controller.latency_report()
+        }
+        self.dispatch(routes)
+
+    def do_POST(self):
+        controller = self.api.controller
+        routes = {
+            '/start': lambda body: controller.start_process(
+                body['recipe'] if set(body) == {'recipe'} else body),
+            '/stop': lambda body: controller.stop_process(),
+            '/emergency-stop': lambda body: controller.emergency_stop_process(),
+            '/preheat': self.preheat
+        }
+        self.dispatch(routes, mutating=True)
+
+    def dispatch(self, routes, mutating=False):
+        try:
+            # Always consume the body so the connection stays usable after an error
+            body = self.read_json()
+            if self.path not in routes:
+                raise ApiError(404, f"No such endpoint: {self.path}")
+            if mutating and not self.origin_allowed():
+                raise ApiError(403, "Origin not allowed")
+            if mutating and not self.token_valid(self.headers.get(TOKEN_HEADER)):
+                raise ApiError(401, "Missing or wrong API token")
+            result = routes[self.path](body)
+            if mutating:
+                result = self.api.controller.state.current.as_dict()
+            self.send_json(200, result)
+        except ApiError as e:
+            self.send_json(e.status, {'error': str(e)})
+        except Exception as e:
+            logging.error("API %s %s failed: %s", self.command, self.path, e)
+            self.send_json(409, {'error': str(e)})
+
+    def origin_allowed(self):
+        origin = self.headers.get('Origin')
+        return origin is None or origin in self.api.allowed_origins
+
+    def token_valid(self, token):
+        return token is not None and hmac.compare_digest(token.encode(), self.api.token.encode())
+
+    def preheat(self, body):
+        """Preheat to the body's target_temp, if any; the controller validates it"""
+        unknown = set(body) - {'target_temp'}
+        if unknown:
+            raise ApiError(400, f"Unknown keys {sorted(unknown)}")
+        try:
+            self.api.controller.preheat(body.get('target_temp'))
+        except ValueError as e:
+            raise ApiError(400, str(e))
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        try:
+            body = json.loads(self.rfile.read(length))
+        except ValueError as e:
+            raise ApiError(400, f"Bad JSON: {e}")
+        if not isinstance(body, dict):
+            raise ApiError(400, "Expected a JSON object")
+        return body
+
+    def send_cors_headers(self):
+        origin = self.headers.get('Origin')
+        if origin is not None and origin in self.api.allowed_origins:
+            self.send_header('Access-Control-Allow-Origin', origin)
+
+    def send_json(self, status, payload):
+        self.send_text(status, json.dumps(payload), 'application/json')
+
+    def send_text(self, status, text, content_type):
+        body = text.encode()
+        self.send_response(status)
+        self.send_cors_headers()
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream_events(self):
+        """Push each new snapshot until the client goes away
+
+        The stream reads through its own StateChannel, so the control thread
+        only sets an event; a slow client just sees fewer, newer snapshots.
+        """
+        wake = threading.Event()
+        channel = StateChannel(self.api.controller.state, wake.set)
+        self.send_response(200)
+        self.send_cors_headers()
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.close_connection = True
+        try:
+            wake.set()  # send the current snapshot straight away
+            while not self.api.stopping.is_set():
+                if not wake.wait(KEEPALIVE_INTERVAL):
+                    self.wfile.write(b': keepalive\n\n')
+                    self.wfile.flush()
+                    continue
+                wake.clear()
+                snapshot = channel.take()
+                self.wfile.write(b'data: ' + json.dumps(snapshot.as_dict()).encode() + b'\n\n')
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            channel.close()
+
+    def stream_websocket(self, query):
+        """Delta-encoded telemetry over a WebSocket until either side closes
+
+        A reader thread answers pings and notices the close; this thread
+        sends frames. Sending blocks on a slow client while its StreamClient
+        keeps only the newest snapshot, so memory stays flat.
+        """
+        key = self.headers.get('Sec-WebSocket-Key')
+        if self.headers.get('Upgrade', '').lower() != 'websocket' or not key:
+            self.send_json(400, {'error': "Expected a WebSocket upgrade"})
+            return
+        if not self.origin_allowed():
+            self.send_json(403, {'error': "Origin not allowed"})
+            return
+        protocols = [p.strip() for p in self.headers.get('Sec-WebSocket-Protocol', '').split(',')]
+        if not self.token_valid(self.headers.get(TOKEN_HEADER)) and \
+                not any(self.token_valid(p) for p in protocols):
+            self.send_json(401, {'error': "Missing or wrong API token"})
+            return
+        try:
+            rate = float(query.get('rate', [DEFAULT_STREAM_RATE])[0])
+        except ValueError:
+            self.send_json(400, {'error': "rate must be a number"})
+            return
+        rate = min(rate, self.api.max_stream_rate) if rate > 0 else self.api.max_stream_rate
+        binary = query.get('format', ['json'])[0] == 'binary'
+
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', websocket_accept(key))
+        if WEBSOCKET_PROTOCOL in protocols:
+            self.send_header('Sec-WebSocket-Protocol', WEBSOCKET_PROTOCOL)
+        self.end_headers()
+        self.close_connection = True
+
+        client = StreamClient(self.api.controller.state, rate, binary)
+        send_lock = threading.Lock()
+
+        def send(opcode, payload):
+            with send_lock:
+                self.wfile.write(encode_ws_frame(opcode, payload))
+                self.wfile.flush()
+
+        def receive():
+            try:
+                while not client.closed.is_set():
+                    opcode, payload = read_ws_frame(self.rfile.read, MAX_CLIENT_PAYLOAD,
+                                                    require_mask=True)
+                    if opcode == PING:
+                        send(PONG, payload)
+                    elif opcode == CLOSE:
+                        send(CLOSE, payload[:2])
+                        break
+            except FrameError as e:
+                logging.warning("Closing stream: %s", e)
+                try:
+                    send(CLOSE, e.code.to_bytes(2, 'big'))
+                except OSError:
+                    pass
+            except (OSError, EOFError):
+                pass  # connection dropped mid-frame
+            finally:
+                client.close()
+
+        reader = threading.Thread(target=receive, name="api-stream-reader", daemon=True)
+        reader.start()
+        try:
+            if binary:
+                # Field names once, so binary frames can carry indexes only
+                send(TEXT, json.dumps({'fields': STREAM_FIELDS}))
+            while not client.closed.is_set() and not self.api.stopping.is_set():
+                frame = client.next_frame(KEEPALIVE_INTERVAL)
+                if frame is not None:
+                    send(BINARY if binary else TEXT, frame)
+        except OSError:
+            pass
+        finally:
+            client.close()
+            logging.debug("Stream closed after %d frames, %d snapshots dropped",
+                          client.frames_sent, client.dropped)
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)  # stale socket from a previous run
+        self.socket.bind(self.server_address)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+    def get_request(self):
+        request, _ = self.socket.accept()
+        return request, ('unix', 0)
+
+
+class ControlServer:
+    """Local API so a UI process can drive a headless controller
+
+    Listens on localhost TCP (port 0 picks a free one) or, with unix_path,
+    on a Unix socket. Handlers run on their own threads and never touch
+    the control loop beyond the controller's public methods. Commands need
+    `token` (random per launch unless given) in the X-Coffee-Machine-Token
+    header; the Origin check alone lets any file:// or sandboxed page in.
+    """
+
+    def __init__(self, controller, host='127.0.0.1', port=DEFAULT_PORT, unix_path=None,
+                 allowed_origins=('null',), max_stream_rate=20.0, token=None):
+        self.controller = controller
+        self.token = token or secrets.token_urlsafe(32)
+        self.allowed_origins = set(allowed_origins)
+        self.max_stream_rate = max_stream_rate  # cap on any one client's frame rate
+        self.stopping = threading.Event()
+        if unix_path:
+            self.httpd = UnixHTTPServer(unix_path, ApiHandler)
+        else:
+            self.httpd = ThreadingHTTPServer((host, port), ApiHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.api = self
+        self.unix_path = unix_path
+        self._thread = None
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def write_token(self, path):
+        """Save the token where only this user can read it, for the UI to pick up"""
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.token)
+
+    def start(self):
+        """Serve on a background thread"""
+        self._thread = threading.Thread(target=self.httpd.serve_forever,
+                                        name="api-server", daemon=True)
+        self._thread.start()
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.stopping.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.unix_path and os.path.exists(self.unix_path):
+            os.unlink(self.unix_path)
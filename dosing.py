@@ -0,0 +1,136 @@
+from array import array
+from collections import namedtuple
+
+from temperature_control import PIDController, clamp
+
+# Dosing phases
+IDLE = 'idle'
+COARSE = 'coarse'
+FINE = 'fine'
+DONE = 'done'
+
+# What the doser asks the powder motor to do this tick
+DosingCommand = namedtuple('DosingCommand', ['motor_speed', 'phase', 'feed_rate', 'dispensed'])
+
+
+class FeedRateEstimator:
+    """Loss-in-weight feed rate (g/s) from timestamped hopper weights
+
+    The rate is the least-squares slope of weight against time over the
+    last `window` seconds, which differentiates the load cell without
+    amplifying its noise the way a two-point difference would.
+    """
+
+    def __init__(self, window=2.0, capacity=64):
+        self.window = window
+        self.capacity = capacity
+        self.times = array('d', [0.0] * capacity)
+        self.weights = array('d', [0.0] * capacity)
+        self.reset()
+
+    def reset(self):
+        self.index = 0
+        self.count = 0
+
+    def add(self, t, grams):
+        self.times[self.index] = t
+        self.weights[self.index] = grams
+        self.index = (self.index + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def rate(self):
+        """Feed rate in g/s (positive while the hopper empties), None until known"""
+        if self.count < 3:
+            return None
+        newest = self.times[(self.index - 1) % self.capacity]
+        points = [(self.times[i], self.weights[i]) for i in range(self.count)
+                  if newest - self.times[i] <= self.window]
+        if len(points) < 3:
+            return None
+
+        n = len(points)
+        mean_t = sum(t for t, _ in points) / n
+        mean_w = sum(w for _, w in points) / n
+        var_t = sum((t - mean_t) ** 2 for t, _ in points)
+        if var_t == 0:
+            return None
+        slope = sum((t - mean_t) * (w - mean_w) for t, w in points) / var_t
+        return -slope
+
+
+class GravimetricDoser:
+    """Closed-loop powder dosing on measured loss-in-weight
+
+    A PI loop trims the motor speed around a feed-forward of
+    rate / max_feed_g_s so the measured feed rate tracks the target. With
+    a batch total it runs a coarse phase at the full rate, drops to
+    `fine_fraction` of it for the last `fine_grams`, and stops early by
+    the powder still in flight (feed rate times `preact` seconds).
+    """
+
+    def __init__(self, max_feed_g_s, fine_grams=10.0, fine_fraction=0.25, preact=0.5,
+                 kp=20.0, ki=10.0, estimator=None):
+        self.max_feed_g_s = max_feed_g_s
+        self.fine_grams = fine_grams
+        self.fine_fraction = fine_fraction
+        self.preact = preact
+        self.pid = PIDController(kp, ki, 0.0)
+        self.estimator = estimator or FeedRateEstimator()
+        self.phase = IDLE
+        self.rate_g_s = 0.0
+        self.total_grams = None
+        self.start_weight = 0.0
+        self.dispensed = 0.0
+        self.feed_rate = 0.0
+
+    @property
+    def active(self):
+        return self.phase in (COARSE, FINE)
+
+    def start(self, t, weight, rate_g_s, total_grams=None):
+        """Begin dosing at rate_g_s, optionally stopping after total_grams"""
+        if rate_g_s <= 0:
+            raise ValueError("Powder feed rate must be positive")
+        self.rate_g_s = rate_g_s
+        self.total_grams = total_grams
+        self.start_weight = weight
+        self.dispensed = 0.0
+        self.feed_rate = 0.0
+        self.pid.reset()
+        self.estimator.reset()
+        self.estimator.add(t, weight)
+        self.phase = COARSE
+        return DosingCommand(self.feed_forward(rate_g_s), self.phase, 0.0, 0.0)
+
+    def stop(self):
+        self.phase = IDLE
+
+    def feed_forward(self, rate_g_s):
+        return clamp(rate_g_s / self.max_feed_g_s * 100, 0, 100)
+
+    def update(self, t, weight, dt):
+        if not self.active:
+            return DosingCommand(0.0, self.phase, self.feed_rate, self.dispensed)
+
+        self.estimator.add(t, weight)
+        self.dispensed = max(0.0, self.start_weight - weight)
+        rate = self.estimator.rate()
+        if rate is not None:
+            self.feed_rate = rate
+
+        target = self.rate_g_s
+        if self.total_grams is not None:
+            remaining = self.total_grams - self.dispensed
+            if remaining <= self.feed_rate * self.preact:
+                # The motor stops here, so report the feed as stopped too
+                self.phase = DONE
+                self.feed_rate = 0.0
+                return DosingCommand(0.0, self.phase, 0.0, self.dispensed)
+            if remaining <= self.fine_grams:
+                self.phase = FINE
+                target = self.rate_g_s * self.fine_fraction
+
+        # Feed-forward alone until the estimator has enough history
+        measured = target if rate is None else rate
+        speed = self.pid.update(target, measured, dt, self.feed_forward(target))
+        return DosingCommand(speed, self.phase, self.feed_rate, self.dispensed)
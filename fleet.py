@@ -0,0 +1,230 @@
+import contextvars
+import heapq
+import itertools
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# Name of the machine whose tasks the current thread is running
+current_machine = contextvars.ContextVar('current_machine', default=None)
+
+
+class MachineLogFilter(logging.Filter):
+    """Prefix records logged while a supervised machine runs with its name"""
+
+    def filter(self, record):
+        name = current_machine.get()
+        if name is not None and not getattr(record, 'machine', None):
+            record.machine = name
+            record.msg = f"[{name.replace('%', '%%')}] {record.msg}"
+        return True
+
+
+class Machine:
+    """One supervised controller and its fault record"""
+
+    def __init__(self, name, controller):
+        self.name = name
+        self.controller = controller
+        self.fault = None         # reason it was quarantined
+        self.strikes = 0          # consecutive passes with failing tasks
+        self.failures_seen = 0
+        self.passes = 0
+
+    def status(self):
+        controller = self.controller
+        return {
+            'running': controller.running,
+            'emergency_stop': controller.emergency_stop,
+            'fault': self.fault,
+            'passes': self.passes,
+            'task_failures': controller.scheduler.failures()
+        }
+
+
+class FleetSupervisor:
+    """Runs many controllers' control tasks on one shared worker pool
+
+    Each controller keeps its own ControlScheduler for deadlines and
+    statistics but no threads of its own (build it with own_threads=False).
+    In real time a dispatcher hands whichever machine is due next to a
+    pool of `workers` threads; a machine is never given to two workers at
+    once, so its tasks stay serialised. A machine whose tasks raise on
+    `max_strikes` passes in a row, or whose pass escapes with an
+    exception, is emergency-stopped and dropped from the rotation without
+    disturbing the others.
+    """
+
+    def __init__(self, workers=4, max_strikes=3, clock_ns=time.monotonic_ns):
+        self.workers = workers
+        self.max_strikes = max_strikes
+        self.clock_ns = clock_ns
+        self.machines = {}
+
+        self._pool = None
+        self._dispatcher = None
+        self._heap = []           # (due ns on clock_ns, sequence, machine)
+        self._sequence = itertools.count()
+        self._wakeup = threading.Condition()
+        self._stop_event = threading.Event()
+
+        root = logging.getLogger()
+        if not any(isinstance(f, MachineLogFilter) for f in root.filters):
+            root.addFilter(MachineLogFilter())
+
+    def add(self, name, controller):
+        if name in self.machines:
+            raise ValueError(f"Machine {name} already supervised")
+        if controller.scheduler._thread is not None:
+            raise ValueError(f"Machine {name} runs its own scheduler thread; "
+                             "construct it with own_threads=False")
+        machine = Machine(name, controller)
+        self.machines[name] = machine
+        if self._pool is not None:
+            self._schedule(machine)
+        return machine
+
+    def remove(self, name):
+        """Stop supervising a machine; it leaves the rotation after any pass in progress"""
+        return self.machines.pop(name)
+
+    def run_pass(self, machine, run):
+        """Run one machine's due work with its faults contained"""
+        if machine.fault is not None:
+            return
+        token = current_machine.set(machine.name)
+        try:
+            run()
+        except Exception as e:
+            self.quarantine(machine, f"pass failed: {e}")
+            return
+        finally:
+            current_machine.reset(token)
+        machine.passes += 1
+
+        failures = machine.controller.scheduler.failures()
+        if failures > machine.failures_seen:
+            machine.strikes += 1
+        else:
+            machine.strikes = 0
+        machine.failures_seen = failures
+        if machine.strikes >= self.max_strikes:
+            self.quarantine(machine, f"tasks failing on {machine.strikes} passes in a row")
+
+    def quarantine(self, machine, reason):
+        machine.fault = reason
+        token = current_machine.set(machine.name)
+        try:
+            logging.critical("Machine quarantined: %s", reason)
+            machine.controller.emergency_stop_process()
+        except Exception as e:
+            logging.error("Emergency stop of quarantined machine failed: %s", e)
+        finally:
+            current_machine.reset(token)
+
+    # Virtual clocks
+
+    def run_for(self, seconds, step=1.0):
+        """Advance every simulated machine by seconds, in lockstep steps
+
+        Each step runs every healthy machine's scheduler.run_for(step) on the
+        pool, so a slow or failing machine only delays the step it is in.
+        """
+        with ThreadPoolExecutor(self.workers, thread_name_prefix='fleet') as pool:
+            elapsed = 0.0
+            while elapsed < seconds - 1e-9:
+                dt = min(step, seconds - elapsed)
+                wait([pool.submit(self.run_pass, machine,
+                                  lambda m=machine: m.controller.scheduler.run_for(dt))
+                      for machine in list(self.machines.values()) if machine.fault is None])
+                elapsed += dt
+
+    # Real time
+
+    def start(self):
+        """Dispatch due machines to the worker pool until stop()"""
+        self._stop_event.clear()
+        self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix='fleet')
+        for machine in self.machines.values():
+            self._schedule(machine)
+        self._dispatcher = threading.Thread(target=self._dispatch, name="fleet-dispatcher",
+                                            daemon=True)
+        self._dispatcher.start()
+
+    def stop(self):
+        self._stop_event.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        if self._dispatcher is not None:
+            self._dispatcher.join()
+            self._dispatcher = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        self._heap = []
+
+    def _schedule(self, machine):
+        """Queue the machine for its controller's next deadline"""
+        controller = machine.controller
+        deadline = controller.scheduler.next_deadline_ns()
+        if deadline is None or machine.fault is not None or \
+                self.machines.get(machine.name) is not machine:
+            return
+        delay = max(0, deadline - controller.io.clock_ns())
+        with self._wakeup:
+            heapq.heappush(self._heap, (self.clock_ns() + delay, next(self._sequence), machine))
+            self._wakeup.notify()
+
+    def _dispatch(self):
+        while not self._stop_event.is_set():
+            with self._wakeup:
+                if not self._heap:
+                    self._wakeup.wait(0.1)
+                    continue
+                wait_ns = self._heap[0][0] - self.clock_ns()
+                if wait_ns > 0:
+                    self._wakeup.wait(wait_ns / 1e9)
+                    continue
+                _, _, machine = heapq.heappop(self._heap)
+            try:
+                self._pool.submit(self._tick, machine)
+            except RuntimeError:
+                return  # pool shut down under us
+
+    def _tick(self, machine):
+        self.run_pass(machine, machine.controller.scheduler.run_pending)
+        if not self._stop_event.is_set():
+            self._schedule(machine)
+
+    def status(self):
+        return {name: machine.status() for name, machine in self.machines.items()}
+
+
+if __name__ == "__main__":
+    # Load test: fleet.py [COUNT] [SECONDS] [WORKERS] simulated machines on a virtual clock
+    from coffee_machine_control import CoffeeMachineController
+    from simulator import SimulatedBackend
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 60.0
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+
+    supervisor = FleetSupervisor(workers)
+    for i in range(count):
+        io = SimulatedBackend()
+        io.model.outlet_temp = 52.5
+        controller = CoffeeMachineController(io, own_threads=False)
+        controller.start_process({'target_temp': 52.5, 'powder_rate': 50})
+        supervisor.add(f"sim-{i}", controller)
+
+    started = time.perf_counter()
+    supervisor.run_for(seconds)
+    wall = time.perf_counter() - started
+    worst = max(task['max_lateness_ms'] for machine in supervisor.machines.values()
+                for task in machine.controller.scheduler.stats().values())
+    faulted = sum(1 for m in supervisor.machines.values() if m.fault)
+    print(f"{count} machines x {seconds:.0f} s simulated in {wall:.1f} s wall "
+          f"({count * seconds / wall:.0f} machine-seconds/s), "
+          f"worst task lateness {worst:.1f} ms, {faulted} quarantined")
@@ -0,0 +1,48 @@
+def linear_fit(times, values):
+    """Least-squares (slope, intercept) of values against times, or None"""
+    n = len(times)
+    if n < 2:
+        return None
+    mean_t = sum(times) / n
+    mean_v = sum(values) / n
+    var_t = sum((t - mean_t) ** 2 for t in times)
+    if var_t == 0:
+        return None
+    slope = sum((t - mean_t) * (v - mean_v) for t, v in zip(times, values)) / var_t
+    return slope, mean_v - slope * mean_t
+
+
+class DepletionForecast:
+    """Time until a resource level falls to the level that stops the process
+
+    Fits a straight line to the level history of the last `window`
+    seconds; the consumption rate is its slope. No forecast is made from
+    less than `min_span` seconds of history or while the level is not
+    falling.
+    """
+
+    def __init__(self, stop_level, window=300.0, min_span=30.0):
+        self.stop_level = stop_level
+        self.window = window
+        self.min_span = min_span
+        self.rate = 0.0            # %/s consumed
+        self.time_to_stop = None   # s, None when not depleting
+        self.known = False         # enough history to say either way
+
+    def update(self, times, levels):
+        newest = times[-1] if len(times) else None
+        points = [(t, v) for t, v in zip(times, levels) if newest - t <= self.window]
+        self.rate = 0.0
+        self.time_to_stop = None
+        self.known = bool(points) and points[-1][0] - points[0][0] >= self.min_span
+        if not self.known:
+            return None
+
+        fit = linear_fit([t for t, _ in points], [v for _, v in points])
+        if fit is None or fit[0] >= 0:
+            return None
+        slope, intercept = fit
+        self.rate = -slope
+        level_now = slope * newest + intercept
+        self.time_to_stop = max(0.0, (level_now - self.stop_level) / self.rate)
+        return self.time_to_stop
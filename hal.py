@@ -0,0 +1,239 @@
+import logging
+import os
+import time
+
+# BCM pins that can carry one of the two hardware PWM channels
+HARDWARE_PWM_CHANNELS = {12: 0, 18: 0, 13: 1, 19: 1}
+
+
+class IOBackend:
+    """I/O interface used by the sensor, actuator and controller classes
+
+    Method names follow RPi.GPIO so call sites read the same as before;
+    SPI devices and the clock are reached through the backend as well so a
+    simulator can substitute all three together.
+    """
+
+    BCM = 11
+    IN = 1
+    OUT = 0
+    HIGH = 1
+    LOW = 0
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    # False when time only advances through sleep() (simulation)
+    realtime = True
+
+    def setmode(self, mode):
+        raise NotImplementedError
+
+    def setwarnings(self, flag):
+        raise NotImplementedError
+
+    def setup(self, pin, direction):
+        raise NotImplementedError
+
+    def output(self, pin, value):
+        raise NotImplementedError
+
+    def input(self, pin):
+        raise NotImplementedError
+
+    def PWM(self, pin, frequency):
+        """Return an object with start/ChangeDutyCycle/ChangeFrequency/stop"""
+        raise NotImplementedError
+
+    def hardware_pwm(self, pin, frequency):
+        """Hardware-timed PWM with the same interface as PWM(), or None"""
+        return None
+
+    def add_event_detect(self, pin, edge, callback=None):
+        raise NotImplementedError
+
+    def remove_event_detect(self, pin):
+        raise NotImplementedError
+
+    def spi(self, bus, device):
+        """Return an opened SPI device with readbytes()/xfer2()/close()"""
+        raise NotImplementedError
+
+    def clock_ns(self):
+        """Monotonic time in nanoseconds"""
+        raise NotImplementedError
+
+    def sleep(self, seconds):
+        raise NotImplementedError
+
+    def cleanup(self):
+        raise NotImplementedError
+
+
+class SysfsPWM:
+    """Kernel PWM channel (dtoverlay=pwm-2chan) behind the RPi.GPIO PWM interface
+
+    The PWM peripheral generates the waveform, so duty and frequency stay
+    exact whatever the Python threads are doing.
+    """
+
+    def __init__(self, channel, frequency, chip='/sys/class/pwm/pwmchip0'):
+        self.path = os.path.join(chip, f'pwm{channel}')
+        if not os.path.isdir(self.path):
+            self._write(os.path.join(chip, 'export'), channel)
+        self.period_ns = 0
+        self.duty = 0.0
+        self.ChangeFrequency(frequency)
+
+    def _write(self, path, value):
+        with open(path, 'w') as f:
+            f.write(str(value))
+
+    def _set(self, name, value):
+        self._write(os.path.join(self.path, name), value)
+
+    def start(self, duty):
+        self.ChangeDutyCycle(duty)
+        self._set('enable', 1)
+
+    def ChangeDutyCycle(self, duty):
+        self.duty = max(0.0, min(100.0, duty))
+        self._set('duty_cycle', int(self.period_ns * self.duty / 100))
+
+    def ChangeFrequency(self, frequency):
+        # The duty cycle may never exceed the period, so clear it first
+        self._set('duty_cycle', 0)
+        self.period_ns = int(1e9 / frequency)
+        self._set('period', self.period_ns)
+        self.ChangeDutyCycle(self.duty)
+
+    def stop(self):
+        self._set('duty_cycle', 0)
+        self._set('enable', 0)
+
+
+class PigpioPWM:
+    """Hardware PWM through the pigpio daemon, for kernels without the overlay"""
+
+    def __init__(self, pi, pin, frequency):
+        self.pi = pi
+        self.pin = pin
+        self.frequency = frequency
+        self.duty = 0.0
+        self.running = False
+
+    def _apply(self):
+        duty = int(self.duty * 10000) if self.running else 0  # pigpio uses 0..1000000
+        self.pi.hardware_PWM(self.pin, int(self.frequency), duty)
+
+    def start(self, duty):
+        self.running = True
+        self.ChangeDutyCycle(duty)
+
+    def ChangeDutyCycle(self, duty):
+        self.duty = max(0.0, min(100.0, duty))
+        self._apply()
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+        self._apply()
+
+    def stop(self):
+        self.running = False
+        self._apply()
+
+
+class RPiBackend(IOBackend):
+    """Real hardware: RPi.GPIO for pins and spidev for the MAX31855s"""
+
+    def __init__(self, spi_speed_hz=5000000):
+        # Imported here so the rest of the code base loads off-Pi
+        import RPi.GPIO as GPIO
+        import spidev
+
+        self._gpio = GPIO
+        self._spidev = spidev
+        self.spi_speed_hz = spi_speed_hz
+        self._pwm_channels = set()
+        self._pigpio = None
+
+        self.BCM = GPIO.BCM
+        self.IN = GPIO.IN
+        self.OUT = GPIO.OUT
+        self.HIGH = GPIO.HIGH
+        self.LOW = GPIO.LOW
+        self.RISING = GPIO.RISING
+        self.FALLING = GPIO.FALLING
+        self.BOTH = GPIO.BOTH
+
+    def setmode(self, mode):
+        self._gpio.setmode(mode)
+
+    def setwarnings(self, flag):
+        self._gpio.setwarnings(flag)
+
+    def setup(self, pin, direction):
+        self._gpio.setup(pin, direction)
+
+    def output(self, pin, value):
+        self._gpio.output(pin, value)
+
+    def input(self, pin):
+        return self._gpio.input(pin)
+
+    def PWM(self, pin, frequency):
+        return self._gpio.PWM(pin, frequency)
+
+    def hardware_pwm(self, pin, frequency):
+        """Kernel PWM if the overlay is loaded, else pigpio, else None"""
+        channel = HARDWARE_PWM_CHANNELS.get(pin)
+        if channel is None or channel in self._pwm_channels:
+            return None
+
+        pwm = None
+        if os.path.isdir('/sys/class/pwm/pwmchip0'):
+            try:
+                pwm = SysfsPWM(channel, frequency)
+            except OSError as e:
+                logging.warning("Kernel PWM unavailable on GPIO %s: %s", pin, e)
+        if pwm is None:
+            pwm = self._pigpio_pwm(pin, frequency)
+        if pwm is not None:
+            self._pwm_channels.add(channel)
+        return pwm
+
+    def _pigpio_pwm(self, pin, frequency):
+        if self._pigpio is None:
+            try:
+                import pigpio
+            except ImportError:
+                return None
+            pi = pigpio.pi()
+            if not pi.connected:
+                return None
+            self._pigpio = pi
+        return PigpioPWM(self._pigpio, pin, frequency)
+
+    def add_event_detect(self, pin, edge, callback=None):
+        self._gpio.add_event_detect(pin, edge, callback=callback)
+
+    def remove_event_detect(self, pin):
+        self._gpio.remove_event_detect(pin)
+
+    def spi(self, bus, device):
+        spi = self._spidev.SpiDev()
+        spi.open(bus, device)
+        spi.max_speed_hz = self.spi_speed_hz
+        spi.mode = 0
+        return spi
+
+    def clock_ns(self):
+        return time.perf_counter_ns()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def cleanup(self):
+        if self._pigpio is not None:
+            self._pigpio.stop()
+        self._gpio.cleanup()
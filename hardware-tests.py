@@ -1,14 +1,21 @@
-import RPi.GPIO as GPIO
-import spidev
-import time
+import json
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+from hal import RPiBackend
+from hx711 import HX711
+from level_filter import median
+from thermocouple import decode_max31855, describe_faults
+from ultrasonic import EchoTimer
+
 class HardwareTest:
-    def __init__(self):
+    def __init__(self, io=None):
         # Initialize GPIO
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setwarnings(False)
+        self.io = io if io is not None else RPiBackend()
+        self.io.setmode(self.io.BCM)
+        self.io.setwarnings(False)
         
         # Pin Definitions
         self.PINS = {
@@ -21,249 +28,388 @@ class HardwareTest:
             'HEATER': 12,
             'WATER_TRIGGER': 16,
             'WATER_ECHO': 17,
-            'VALVE': 22
+            'VALVE': 22,
+            'POWDER_WEIGHT': 27,
+            'POWDER_CLOCK': 5
         }
         
-        # Setup GPIO pins
+        # Setup GPIO pins; the motor PWM pins are left alone until we know
+        # whether hardware PWM (which needs their ALT function) is available
+        self.MOTOR_PWM_PINS = (self.PINS['PUMP_PWM'], self.PINS['POWDER_PWM'])
         for pin in self.PINS.values():
-            GPIO.setup(pin, GPIO.OUT)
-            GPIO.output(pin, GPIO.LOW)
-        GPIO.setup(self.PINS['WATER_ECHO'], GPIO.IN)
+            if pin in self.MOTOR_PWM_PINS:
+                continue
+            self.io.setup(pin, self.io.OUT)
+            self.io.output(pin, self.io.LOW)
+        self.io.setup(self.PINS['WATER_ECHO'], self.io.IN)
+        self.io.setup(self.PINS['POWDER_WEIGHT'], self.io.IN)
+        
+        # Initialize SPI for temperature sensors (SPI0.0 inlet, SPI0.1 outlet)
+        self.spi = [self.io.spi(0, 0), self.io.spi(0, 1)]
+        
+        # Tests that share hardware run in the same lane; lanes run concurrently.
+        # The heater response is only meaningful in still water, so that test
+        # runs on its own once the pump and valve lanes have finished.
+        self.LANES = [
+            [("Temperature Sensors", self.test_temperature_sensors)],
+            [("Pump Motor", self.test_pump_motor)],
+            [("Load Cell", self.test_load_cell),
+             ("Powder Motor", self.test_powder_motor)],
+            [("Water Level Sensor", self.test_water_level_sensor),
+             ("Circulation Valve", self.test_circulation_valve)]
+        ]
+        self.SOLO = [("Heater Control", self.test_heater_control)]
+        
+        self._local = threading.local()
+        self._print_lock = threading.Lock()
+
+    def say(self, message=""):
+        """Print, or buffer until the test finishes when running in parallel"""
+        lines = getattr(self._local, 'lines', None)
+        if lines is None:
+            print(message)
+        else:
+            lines.append(message)
+
+    def step(self, name, **measurements):
+        """Record a timed step of the current test"""
+        now = self.io.clock_ns()
+        steps = self._local.steps
+        since = self._local.last_step_ns
+        self._local.last_step_ns = now
+        steps.append(dict(name=name, at_s=round((now - self._local.start_ns) / 1e9, 6),
+                          latency_ms=round((now - since) / 1e6, 3), **measurements))
+
+    def timed(self, name, function, *args):
+        """Call function and record how long it blocked"""
+        start = self.io.clock_ns()
+        result = function(*args)
+        self._local.last_step_ns = start
+        self.step(name)
+        return result
+
+    def run_test(self, name, test, buffered):
+        """Run one test, returning its report entry"""
+        self._local.lines = [] if buffered else None
+        self._local.steps = []
+        self._local.start_ns = self._local.last_step_ns = self.io.clock_ns()
+        try:
+            passed = test()
+        except Exception as e:
+            self.say(f"✗ {name} error: {str(e)}")
+            passed = False
+        duration = (self.io.clock_ns() - self._local.start_ns) / 1e9
         
-        # Initialize SPI for temperature sensors
-        self.spi = spidev.SpiDev()
-        self.spi.open(0, 0)  # SPI0
-        self.spi.max_speed_hz = 5000000
-        self.spi.mode = 0
+        if buffered:
+            with self._print_lock:
+                print("\n".join(self._local.lines))
+        return {'passed': bool(passed), 'duration_s': round(duration, 3),
+                'steps': self._local.steps}
+
+    def run_lane(self, lane, buffered):
+        return [(name, self.run_test(name, test, buffered)) for name, test in lane]
 
     def test_temperature_sensors(self):
         """Test both temperature sensors"""
-        print("\n=== Testing Temperature Sensors ===")
+        self.say("\n=== Testing Temperature Sensors ===")
         
         try:
             # Test Sensor 1
-            print("Testing Temperature Sensor 1 (Inlet)...")
-            self.spi.chip_select = 0
-            raw = self.spi.readbytes(4)
-            temp1 = ((raw[0] << 8) | raw[1]) >> 2
-            temp1 = temp1 * 0.25
-            print(f"Sensor 1 Reading: {temp1:.1f}°C")
+            self.say("Testing Temperature Sensor 1 (Inlet)...")
+            temp1, cj1, faults1 = decode_max31855(self.timed("inlet SPI read", self.spi[0].readbytes, 4))
+            self.say(f"Sensor 1 Reading: {temp1:.1f}°C (cold junction {cj1:.1f}°C)")
             
             # Test Sensor 2
-            print("Testing Temperature Sensor 2 (Outlet)...")
-            self.spi.chip_select = 1
-            raw = self.spi.readbytes(4)
-            temp2 = ((raw[0] << 8) | raw[1]) >> 2
-            temp2 = temp2 * 0.25
-            print(f"Sensor 2 Reading: {temp2:.1f}°C")
-            
-            if -10 < temp1 < 100 and -10 < temp2 < 100:
-                print("✓ Temperature sensors working")
+            self.say("Testing Temperature Sensor 2 (Outlet)...")
+            temp2, cj2, faults2 = decode_max31855(self.timed("outlet SPI read", self.spi[1].readbytes, 4))
+            self.say(f"Sensor 2 Reading: {temp2:.1f}°C (cold junction {cj2:.1f}°C)")
+            
+            if faults1 or faults2:
+                self.say(f"✗ Thermocouple fault: inlet [{describe_faults(faults1)}], "
+                      f"outlet [{describe_faults(faults2)}]")
+                return False
+            elif -10 < temp1 < 100 and -10 < temp2 < 100:
+                self.say("✓ Temperature sensors working")
                 return True
             else:
-                print("✗ Temperature readings out of range")
+                self.say("✗ Temperature readings out of range")
                 return False
                 
         except Exception as e:
-            print(f"✗ Temperature sensor error: {str(e)}")
+            self.say(f"✗ Temperature sensor error: {str(e)}")
             return False
 
+    def motor_pwm(self, pin, frequency=1000):
+        """Hardware PWM on pin if available, else software PWM on a GPIO output"""
+        pwm = self.io.hardware_pwm(pin, frequency)
+        if pwm is not None:
+            self.say("Using hardware PWM")
+            return pwm
+        self.say("Using software PWM")
+        self.io.setup(pin, self.io.OUT)
+        self.io.output(pin, self.io.LOW)
+        return self.io.PWM(pin, frequency)
+
     def test_pump_motor(self):
         """Test pump motor control"""
-        print("\n=== Testing Pump Motor ===")
+        self.say("\n=== Testing Pump Motor ===")
         
         try:
-            # Setup PWM
-            pump_pwm = GPIO.PWM(self.PINS['PUMP_PWM'], 1000)
+            # Setup PWM, hardware-timed when the PWM overlay or pigpio is available
+            pump_pwm = self.motor_pwm(self.PINS['PUMP_PWM'])
             pump_pwm.start(0)
             
             # Test forward direction
-            print("Testing forward direction...")
-            GPIO.output(self.PINS['PUMP_DIR1'], GPIO.HIGH)
-            GPIO.output(self.PINS['PUMP_DIR2'], GPIO.LOW)
+            self.say("Testing forward direction...")
+            self.io.output(self.PINS['PUMP_DIR1'], self.io.HIGH)
+            self.io.output(self.PINS['PUMP_DIR2'], self.io.LOW)
             
             # Gradually increase speed
             for duty in range(0, 101, 20):
-                pump_pwm.ChangeDutyCycle(duty)
-                print(f"Speed: {duty}%")
-                time.sleep(1)
+                self.timed(f"forward {duty}%", pump_pwm.ChangeDutyCycle, duty)
+                self.say(f"Speed: {duty}%")
+                self.io.sleep(1)
             
             # Stop
-            pump_pwm.ChangeDutyCycle(0)
-            time.sleep(1)
+            self.timed("stop", pump_pwm.ChangeDutyCycle, 0)
+            self.io.sleep(1)
             
             # Test reverse direction
-            print("\nTesting reverse direction...")
-            GPIO.output(self.PINS['PUMP_DIR1'], GPIO.LOW)
-            GPIO.output(self.PINS['PUMP_DIR2'], GPIO.HIGH)
+            self.say("\nTesting reverse direction...")
+            self.io.output(self.PINS['PUMP_DIR1'], self.io.LOW)
+            self.io.output(self.PINS['PUMP_DIR2'], self.io.HIGH)
             
             # Gradually increase speed
             for duty in range(0, 101, 20):
-                pump_pwm.ChangeDutyCycle(duty)
-                print(f"Speed: {duty}%")
-                time.sleep(1)
+                self.timed(f"reverse {duty}%", pump_pwm.ChangeDutyCycle, duty)
+                self.say(f"Speed: {duty}%")
+                self.io.sleep(1)
             
             # Stop
-            pump_pwm.ChangeDutyCycle(0)
+            self.timed("stop", pump_pwm.ChangeDutyCycle, 0)
             pump_pwm.stop()
             
-            print("✓ Pump motor test complete")
+            self.say("✓ Pump motor test complete")
             return True
             
         except Exception as e:
-            print(f"✗ Pump motor error: {str(e)}")
+            self.say(f"✗ Pump motor error: {str(e)}")
             return False
 
     def test_powder_motor(self):
         """Test powder dispensing motor"""
-        print("\n=== Testing Powder Motor ===")
+        self.say("\n=== Testing Powder Motor ===")
         
         try:
             # Setup PWM
-            powder_pwm = GPIO.PWM(self.PINS['POWDER_PWM'], 1000)
+            powder_pwm = self.motor_pwm(self.PINS['POWDER_PWM'])
             powder_pwm.start(0)
             
             # Test operation
-            print("Testing powder dispenser...")
-            GPIO.output(self.PINS['POWDER_DIR1'], GPIO.HIGH)
-            GPIO.output(self.PINS['POWDER_DIR2'], GPIO.LOW)
+            self.say("Testing powder dispenser...")
+            self.io.output(self.PINS['POWDER_DIR1'], self.io.HIGH)
+            self.io.output(self.PINS['POWDER_DIR2'], self.io.LOW)
             
             # Run at different speeds
             speeds = [20, 50, 80]
             for speed in speeds:
-                print(f"Running at {speed}% speed")
-                powder_pwm.ChangeDutyCycle(speed)
-                time.sleep(2)
+                self.say(f"Running at {speed}% speed")
+                self.timed(f"speed {speed}%", powder_pwm.ChangeDutyCycle, speed)
+                self.io.sleep(2)
             
             # Stop
             powder_pwm.ChangeDutyCycle(0)
             powder_pwm.stop()
             
-            print("✓ Powder motor test complete")
+            self.say("✓ Powder motor test complete")
             return True
             
         except Exception as e:
-            print(f"✗ Powder motor error: {str(e)}")
+            self.say(f"✗ Powder motor error: {str(e)}")
+            return False
+
+    def test_load_cell(self):
+        """Test HX711 load cell readings"""
+        self.say("\n=== Testing Load Cell ===")
+        
+        try:
+            load_cell = HX711(self.io, self.PINS['POWDER_WEIGHT'], self.PINS['POWDER_CLOCK'],
+                              calibration_path='load_cell_calibration.json')
+            readings = []
+            for _ in range(200):
+                if len(readings) == 10:
+                    break
+                if load_cell.is_ready():
+                    readings.append(self.timed("conversion", load_cell.read_raw))
+                else:
+                    self.io.sleep(0.0125)  # one conversion period at 80 SPS
+            
+            if len(readings) < 10:
+                self.say("✗ HX711 not responding (DOUT never went low)")
+                return False
+            
+            spread = max(readings) - min(readings)
+            weight = (sum(readings) / len(readings) - load_cell.offset) / load_cell.scale
+            self.say(f"Raw counts: {min(readings)}..{max(readings)} (spread {spread})")
+            self.say(f"Weight on scale: {weight:.1f} g")
+            self.step("summary", spread_counts=spread, weight_g=round(weight, 1))
+            
+            if any(abs(r) >= 0x7FFFFF for r in readings):
+                self.say("✗ Load cell saturated - check wiring")
+                return False
+            stable = spread < 0.02 * 0x7FFFFF
+            if stable:
+                self.say("✓ Load cell working")
+            else:
+                self.say("✗ Load cell readings unstable")
+            return stable
+            
+        except Exception as e:
+            self.say(f"✗ Load cell error: {str(e)}")
             return False
 
     def test_heater_control(self):
         """Test heater SSR control"""
-        print("\n=== Testing Heater Control ===")
+        self.say("\n=== Testing Heater Control ===")
         
         try:
+            # Pump coasting (both bridge inputs low) and valve closed: no flow
+            for pin in ('PUMP_DIR1', 'PUMP_DIR2', 'VALVE'):
+                self.io.output(self.PINS[pin], self.io.LOW)
+            
             # Setup PWM for heater
-            heater_pwm = GPIO.PWM(self.PINS['HEATER'], 1)
+            heater_pwm = self.io.PWM(self.PINS['HEATER'], 1)
             heater_pwm.start(0)
             
-            print("Testing heater power levels...")
+            self.say("Testing heater power levels...")
             powers = [0, 25, 50, 75, 100]
             
             for power in powers:
-                print(f"Setting heater to {power}%")
+                self.say(f"Setting heater to {power}%")
+                start_temp, _, _ = decode_max31855(self.spi[1].readbytes(4))  # Outlet sensor
                 heater_pwm.ChangeDutyCycle(power)
-                time.sleep(3)
                 
-                # Read temperature to verify heating
-                self.spi.chip_select = 1  # Outlet temperature sensor
-                raw = self.spi.readbytes(4)
-                temp = ((raw[0] << 8) | raw[1]) >> 2
-                temp = temp * 0.25
-                print(f"Current temperature: {temp:.1f}°C")
+                # Sample through the 3 s stage to time the first 0.5°C rise
+                response_s = None
+                for tick in range(1, 31):
+                    self.io.sleep(0.1)
+                    temp, _, _ = decode_max31855(self.spi[1].readbytes(4))
+                    if response_s is None and temp >= start_temp + 0.5:
+                        response_s = tick * 0.1
+                
+                self.say(f"Current temperature: {temp:.1f}°C")
+                self.step(f"heater {power}%", temp=temp,
+                          response_s=None if response_s is None else round(response_s, 1))
             
             # Turn off heater
             heater_pwm.ChangeDutyCycle(0)
             heater_pwm.stop()
             
-            print("✓ Heater control test complete")
+            self.say("✓ Heater control test complete")
             return True
             
         except Exception as e:
-            print(f"✗ Heater control error: {str(e)}")
+            self.say(f"✗ Heater control error: {str(e)}")
             return False
 
     def test_water_level_sensor(self):
         """Test water level sensor"""
-        print("\n=== Testing Water Level Sensor ===")
+        self.say("\n=== Testing Water Level Sensor ===")
         
         try:
-            print("Measuring water level...")
+            self.say("Measuring water level...")
             
             # Take multiple readings
+            echo_timer = EchoTimer(self.io, self.PINS['WATER_TRIGGER'], self.PINS['WATER_ECHO'],
+                                   clock=self.io.clock_ns)
             readings = []
-            for _ in range(5):
-                GPIO.output(self.PINS['WATER_TRIGGER'], GPIO.HIGH)
-                time.sleep(0.00001)
-                GPIO.output(self.PINS['WATER_TRIGGER'], GPIO.LOW)
-                
-                while GPIO.input(self.PINS['WATER_ECHO']) == 0:
-                    pulse_start = time.time()
-                
-                while GPIO.input(self.PINS['WATER_ECHO']) == 1:
-                    pulse_end = time.time()
-                
-                pulse_duration = pulse_end - pulse_start
-                distance = pulse_duration * 17150  # Speed of sound = 34300 cm/s
-                readings.append(distance)
-                time.sleep(0.1)
+            try:
+                for _ in range(5):
+                    result = self.timed("echo", echo_timer.measure)
+                    if not result:
+                        self.say(f"✗ {result}")
+                        return False
+                    readings.append(result.distance_cm)
+                    self._local.steps[-1]['distance_cm'] = round(result.distance_cm, 2)
+                    self.io.sleep(0.06)  # HC-SR04 needs 60 ms between pings
+            finally:
+                echo_timer.close()
             
-            # Calculate average
-            avg_distance = sum(readings) / len(readings)
-            print(f"Average distance to water surface: {avg_distance:.1f} cm")
+            # Median, so one splash or multipath echo cannot skew the result
+            distance = median(readings)
+            self.say(f"Median distance to water surface: {distance:.1f} cm "
+                     f"(spread {max(readings) - min(readings):.1f} cm)")
             
-            if 0 < avg_distance < 100:  # Reasonable range for tank
-                print("✓ Water level sensor working")
+            if 0 < distance < 100:  # Reasonable range for tank
+                self.say("✓ Water level sensor working")
                 return True
             else:
-                print("✗ Water level reading out of range")
+                self.say("✗ Water level reading out of range")
                 return False
                 
         except Exception as e:
-            print(f"✗ Water level sensor error: {str(e)}")
+            self.say(f"✗ Water level sensor error: {str(e)}")
             return False
 
     def test_circulation_valve(self):
         """Test circulation valve operation"""
-        print("\n=== Testing Circulation Valve ===")
+        self.say("\n=== Testing Circulation Valve ===")
         
         try:
-            print("Testing valve operation...")
+            self.say("Testing valve operation...")
             
             # Open valve
-            print("Opening valve...")
-            GPIO.output(self.PINS['VALVE'], GPIO.HIGH)
-            time.sleep(2)
+            self.say("Opening valve...")
+            self.timed("open", self.io.output, self.PINS['VALVE'], self.io.HIGH)
+            self.io.sleep(2)
             
             # Close valve
-            print("Closing valve...")
-            GPIO.output(self.PINS['VALVE'], GPIO.LOW)
-            time.sleep(2)
+            self.say("Closing valve...")
+            self.timed("close", self.io.output, self.PINS['VALVE'], self.io.LOW)
+            self.io.sleep(2)
             
-            print("✓ Valve operation test complete")
+            self.say("✓ Valve operation test complete")
             return True
             
         except Exception as e:
-            print(f"✗ Valve operation error: {str(e)}")
+            self.say(f"✗ Valve operation error: {str(e)}")
             return False
 
-    def run_all_tests(self):
-        """Run all hardware tests"""
+    def run_all_tests(self, parallel=None, report_path=None):
+        """Run all hardware tests and return a machine-readable report
+
+        Lanes run concurrently on real hardware. On a virtual clock they run
+        one after another, since concurrent sleeps would all advance the
+        same simulated time. The SOLO tests always run last, one at a time.
+        """
+        if parallel is None:
+            parallel = self.io.realtime
+        
         print("Starting Hardware Tests...")
-        print(f"Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+        started = datetime.now()
+        print(f"Time: {started.strftime('%Y-%m-%d %H:%M:%S')}")
         print("=" * 50)
         
-        results = {
-            "Temperature Sensors": self.test_temperature_sensors(),
-            "Pump Motor": self.test_pump_motor(),
-            "Powder Motor": self.test_powder_motor(),
-            "Heater Control": self.test_heater_control(),
-            "Water Level Sensor": self.test_water_level_sensor(),
-            "Circulation Valve": self.test_circulation_valve()
-        }
+        start_ns = self.io.clock_ns()
+        if parallel:
+            with ThreadPoolExecutor(max_workers=len(self.LANES)) as pool:
+                lanes = list(pool.map(lambda lane: self.run_lane(lane, True), self.LANES))
+        else:
+            lanes = [self.run_lane(lane, False) for lane in self.LANES]
+        lanes.append(self.run_lane(self.SOLO, False))
+        duration = (self.io.clock_ns() - start_ns) / 1e9
+        
+        # Report in the original test order
+        tests = dict(entry for lane in lanes for entry in lane)
+        order = ["Temperature Sensors", "Pump Motor", "Load Cell", "Powder Motor",
+                 "Heater Control", "Water Level Sensor", "Circulation Valve"]
+        results = {test: tests[test]['passed'] for test in order}
         
         print("\n=== Test Results Summary ===")
         for test, passed in results.items():
             status = "✓ PASS" if passed else "✗ FAIL"
-            print(f"{test}: {status}")
+            print(f"{test}: {status} ({tests[test]['duration_s']:.1f}s)")
+        print(f"Total time: {duration:.1f}s ({'parallel' if parallel else 'serial'})")
         
         # Overall result
         if all(results.values()):
@@ -271,16 +417,41 @@ class HardwareTest:
         else:
             print("\nSome tests failed. Please check the results above.")
         
+        report = {
+            'started': started.isoformat(timespec='seconds'),
+            'parallel': parallel,
+            'duration_s': round(duration, 3),
+            'passed': all(results.values()),
+            'tests': {test: tests[test] for test in order}
+        }
+        if report_path:
+            with open(report_path, 'w') as f:
+                json.dump(report, f, indent=2)
+            print(f"Report written to {report_path}")
+        
         # Cleanup
-        GPIO.cleanup()
+        self.io.cleanup()
+        return report
 
 if __name__ == "__main__":
+    # --simulate runs the suite against the in-process machine model
+    if '--simulate' in sys.argv:
+        from simulator import SimulatedBackend
+        io = SimulatedBackend()
+    else:
+        io = RPiBackend()
+    # --report FILE writes the JSON report; --serial disables lane parallelism
+    report_path = None
+    if '--report' in sys.argv:
+        report_path = sys.argv[sys.argv.index('--report') + 1]
+    parallel = False if '--serial' in sys.argv else None
     try:
-        tester = HardwareTest()
-        tester.run_all_tests()
+        tester = HardwareTest(io)
+        report = tester.run_all_tests(parallel=parallel, report_path=report_path)
+        sys.exit(0 if report['passed'] else 1)
     except KeyboardInterrupt:
         print("\nTests interrupted by user")
-        GPIO.cleanup()
+        io.cleanup()
     except Exception as e:
         print(f"\nTest suite error: {str(e)}")
-        GPIO.cleanup()
+        io.cleanup()
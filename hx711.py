@@ -0,0 +1,240 @@
+import json
+import logging
+import os
+import threading
+import time
+from array import array
+
+# Extra clock pulses after the 24 data bits select the next conversion
+GAIN_PULSES = {128: 1, 64: 3, 32: 2}  # 128/64 on channel A, 32 on channel B
+
+DEFAULT_SCALE = 420.0  # counts per gram at gain 128 for our 5 kg cell
+
+
+def decode_24bit(value):
+    """24-bit two's complement to a signed int"""
+    return value - 0x1000000 if value & 0x800000 else value
+
+
+class HX711:
+    """Bit-banged HX711 load-cell ADC with tare, calibration and filtering
+
+    Samples go into a fixed ring buffer; weight_grams() returns the mean of
+    the buffered samples that lie within `reject` MADs of their median, so
+    a knock on the hopper does not show up as a weight change.
+    """
+
+    def __init__(self, io, data_pin, clock_pin, gain=128, window=16, reject=3.0,
+                 calibration_path=None):
+        if gain not in GAIN_PULSES:
+            raise ValueError(f"HX711 gain must be one of {sorted(GAIN_PULSES)}")
+        self.io = io
+        self.data_pin = data_pin
+        self.clock_pin = clock_pin
+        self.gain = gain
+        self.reject = reject
+        self.calibration_path = calibration_path
+
+        io.setup(data_pin, io.IN)
+        io.setup(clock_pin, io.OUT)
+        io.output(clock_pin, io.LOW)
+
+        self.offset = 0.0
+        self.scale = DEFAULT_SCALE
+        self.load_calibration()
+
+        self.window = window
+        self.samples = array('l', [0] * window)
+        self.index = 0
+        self.count = 0
+        self.total = 0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    # Acquisition
+
+    def is_ready(self):
+        """DOUT goes low when a conversion is waiting"""
+        return self.io.input(self.data_pin) == self.io.LOW
+
+    def read_raw(self):
+        """Clock out one 24-bit conversion
+
+        SCK must not stay high for more than 60 us or the chip powers down,
+        so nothing but the pin writes happens inside the loop.
+        """
+        output = self.io.output
+        read = self.io.input
+        pin = self.clock_pin
+        high, low = self.io.HIGH, self.io.LOW
+
+        value = 0
+        for _ in range(24):
+            output(pin, high)
+            output(pin, low)
+            value = (value << 1) | (1 if read(self.data_pin) else 0)
+        for _ in range(GAIN_PULSES[self.gain]):
+            output(pin, high)
+            output(pin, low)
+        return decode_24bit(value)
+
+    def sample(self):
+        """Read one conversion into the buffer if one is ready"""
+        if not self.is_ready():
+            return False
+        raw = self.read_raw()
+        with self._lock:
+            self.samples[self.index] = raw
+            self.index = (self.index + 1) % self.window
+            self.count = min(self.count + 1, self.window)
+            self.total += 1
+        return True
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            if not self.sample():
+                # 80 SPS means a new conversion every 12.5 ms
+                self._stop_event.wait(0.001)
+
+    def start(self):
+        """Sample continuously on a background thread"""
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="hx711-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    # Filtering
+
+    def filtered_raw(self):
+        """Outlier-rejecting mean of the buffered raw counts"""
+        if not self.count:
+            if not self.sample():
+                raise Exception("HX711 not ready")
+        with self._lock:
+            values = sorted(self.samples[:self.count])
+
+        median = values[len(values) // 2]
+        deviations = sorted(abs(v - median) for v in values)
+        mad = deviations[len(deviations) // 2]
+        limit = self.reject * mad
+        kept = [v for v in values if abs(v - median) <= limit]
+        return sum(kept) / len(kept)
+
+    def weight_grams(self):
+        return (self.filtered_raw() - self.offset) / self.scale
+
+    def collect(self, n, wait=None):
+        """Mean of n fresh conversions (for tare and calibration)"""
+        wait = wait or time.sleep
+        readings = []
+        while len(readings) < n:
+            if self.is_ready():
+                readings.append(self.read_raw())
+            else:
+                wait(0.001)
+        return sum(readings) / n
+
+    # Calibration
+
+    def tare(self, n=20, wait=None):
+        """Zero the scale on whatever is currently on it"""
+        self.offset = self.collect(n, wait)
+        self.save_calibration()
+
+    def calibrate(self, known_grams, n=20, wait=None):
+        """Second calibration point: known_grams placed on the tared scale"""
+        raw = self.collect(n, wait)
+        self.calibrate_two_point(self.offset, 0.0, raw, known_grams)
+
+    def calibrate_two_point(self, raw_a, grams_a, raw_b, grams_b):
+        if grams_a == grams_b or raw_a == raw_b:
+            raise ValueError("Calibration points must differ")
+        self.scale = (raw_b - raw_a) / (grams_b - grams_a)
+        self.offset = raw_a - grams_a * self.scale
+        self.save_calibration()
+
+    def load_calibration(self):
+        if not self.calibration_path or not os.path.exists(self.calibration_path):
+            return
+        try:
+            with open(self.calibration_path) as f:
+                data = json.load(f)
+            self.offset = float(data['offset'])
+            self.scale = float(data['scale'])
+        except (ValueError, KeyError) as e:
+            logging.error("Ignoring bad load cell calibration %s: %s", self.calibration_path, e)
+
+    def save_calibration(self):
+        if not self.calibration_path:
+            return
+        tmp = self.calibration_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'offset': self.offset, 'scale': self.scale, 'gain': self.gain}, f)
+        os.replace(tmp, self.calibration_path)
+
+
+class HX711Emulator:
+    """Pin-level behaviour of an HX711 for off-Pi use
+
+    counts() supplies the next conversion; the emulator shifts it out MSB
+    first on rising SCK edges, exactly as the driver expects.
+    """
+
+    def __init__(self, counts):
+        self.counts = counts
+        self.value = None    # conversion being shifted out, None when idle
+        self.pulses = 0
+        self.dout = 0        # 0 = conversion ready
+        self.last_gain_pulses = None
+
+    def clock(self, level):
+        if not level:
+            return
+        if self.value is None:
+            self.value = int(self.counts()) & 0xFFFFFF
+            self.pulses = 0
+        self.pulses += 1
+        if self.pulses <= 24:
+            self.dout = (self.value >> (24 - self.pulses)) & 1
+        else:
+            self.dout = 1  # gain pulses; DOUT stays high until the next conversion
+
+    def data(self):
+        if self.value is not None and self.pulses >= 25:
+            # Conversion finished; the next one is ready immediately
+            self.last_gain_pulses = self.pulses - 24
+            self.value = None
+            self.dout = 0
+        return self.dout
+
+
+class FakeHX711GPIO:
+    """Stand-in for the GPIO calls HX711 makes, backed by HX711Emulator"""
+
+    IN = 1
+    OUT = 0
+    HIGH = 1
+    LOW = 0
+
+    def __init__(self, data_pin, clock_pin, counts):
+        self.data_pin = data_pin
+        self.clock_pin = clock_pin
+        self.emulator = HX711Emulator(counts)
+
+    def setup(self, pin, direction):
+        pass
+
+    def output(self, pin, value):
+        if pin == self.clock_pin:
+            self.emulator.clock(value)
+
+    def input(self, pin):
+        if pin == self.data_pin:
+            return self.emulator.data()
+        return self.LOW
@@ -0,0 +1,250 @@
+import json
+import os
+import sys
+import threading
+import time
+from array import array
+
+# Log-linear buckets: exact below SUB_BUCKETS µs, then SUB_BUCKETS / 2 per
+# power of two, so every value is kept to within 1/128 (two significant digits)
+SUB_BUCKET_BITS = 8
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+HALF_BUCKETS = SUB_BUCKETS // 2
+
+# Span phases inside a control step; the scheduler adds 'duration' and 'lateness'
+SENSOR_READ = 'sensor_read'
+CONTROL = 'control'
+ACTUATOR_WRITE = 'actuator_write'
+
+PERCENTILES = (50.0, 90.0, 99.0, 99.9)
+
+# Upper bounds in seconds of the Prometheus histogram buckets
+PROMETHEUS_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                      0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class LatencyHistogram:
+    """HDR-style histogram of durations, recorded in microseconds
+
+    Counts live in one preallocated array, so record() is a bit_length and
+    an increment whatever the value; anything above `highest_us` lands in
+    the top bucket, though max still reports it exactly.
+    """
+
+    def __init__(self, highest_us=10_000_000):
+        self.highest_us = highest_us
+        self.counts = array('Q', bytes(8 * (self.index(highest_us) + 1)))
+        self.reset()
+
+    def reset(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        self.count = 0
+        self.total_us = 0
+        self.min_us = None
+        self.max_us = 0
+
+    @staticmethod
+    def index(value_us):
+        if value_us < SUB_BUCKETS:
+            return value_us
+        shift = value_us.bit_length() - SUB_BUCKET_BITS
+        return SUB_BUCKETS + (shift - 1) * HALF_BUCKETS + (value_us >> shift) - HALF_BUCKETS
+
+    @staticmethod
+    def highest_equivalent(index):
+        """Largest value that lands in bucket `index`"""
+        if index < SUB_BUCKETS:
+            return index
+        shift = (index - SUB_BUCKETS) // HALF_BUCKETS + 1
+        sub = (index - SUB_BUCKETS) % HALF_BUCKETS + HALF_BUCKETS
+        return ((sub + 1) << shift) - 1
+
+    def record_ns(self, value_ns):
+        value_us = max(0, value_ns) // 1000
+        self.counts[self.index(min(value_us, self.highest_us))] += 1
+        self.count += 1
+        self.total_us += value_us
+        if self.min_us is None or value_us < self.min_us:
+            self.min_us = value_us
+        if value_us > self.max_us:
+            self.max_us = value_us
+
+    def percentile(self, percent):
+        """Value in µs that percent of the recordings are at or below"""
+        if not self.count:
+            return None
+        wanted = max(1, -(-self.count * percent // 100))
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= wanted:
+                return min(self.highest_equivalent(i), self.max_us)
+        return self.max_us
+
+    def count_at_or_below(self, value_us):
+        """Recordings whose bucket lies wholly at or below value_us"""
+        return sum(n for i, n in enumerate(self.counts[:self.index(value_us) + 1])
+                   if self.highest_equivalent(i) <= value_us)
+
+    def summary(self):
+        summary = {
+            'count': self.count,
+            'min_us': self.min_us,
+            'max_us': self.max_us,
+            'mean_us': self.total_us / self.count if self.count else None
+        }
+        for percent in PERCENTILES:
+            summary[f"p{percent:g}_us"] = self.percentile(percent)
+        return summary
+
+
+class _Span:
+    """Times one phase with perf_counter_ns; reused, so it allocates nothing"""
+
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.started = 0
+
+    def __enter__(self):
+        self.started = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.record_ns(time.perf_counter_ns() - self.started)
+        return False
+
+
+class LatencyMonitor:
+    """Latency and jitter histograms for every task and phase of the control path
+
+    The scheduler records each task's run time and how late it started
+    ('duration', 'lateness'); control steps time their own sensor reads,
+    computation and actuator writes with span(). Each (task, phase) pair
+    has its own histogram, so one span is only ever entered from the
+    thread running that task.
+    """
+
+    def __init__(self, highest_us=10_000_000):
+        self.highest_us = highest_us
+        self.histograms = {}
+        self.spans = {}
+        self.started_ns = time.monotonic_ns()
+        self._lock = threading.Lock()
+
+    def histogram(self, task, phase):
+        key = (task, phase)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(key, LatencyHistogram(self.highest_us))
+        return histogram
+
+    def record(self, task, phase, value_ns):
+        self.histogram(task, phase).record_ns(value_ns)
+
+    def span(self, task, phase):
+        """Context manager timing one phase of a step"""
+        span = self.spans.get((task, phase))
+        if span is None:
+            span = self.spans[(task, phase)] = _Span(self.histogram(task, phase))
+        return span
+
+    def reset(self):
+        """Start a fresh measurement, e.g. before and after a change"""
+        with self._lock:
+            for histogram in self.histograms.values():
+                histogram.reset()
+            self.started_ns = time.monotonic_ns()
+
+    def snapshot(self, task_stats=None):
+        """JSON-ready latency summaries, plus the scheduler's overrun counters"""
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+        tasks = {}
+        for (task, phase), histogram in histograms:
+            tasks.setdefault(task, {})[phase] = histogram.summary()
+        for task, stats in (task_stats or {}).items():
+            entry = tasks.setdefault(task, {})
+            for key in ('period', 'runs', 'overruns', 'missed_periods', 'failures'):
+                entry[key] = stats[key]
+        return {'window_s': (time.monotonic_ns() - self.started_ns) / 1e9, 'tasks': tasks}
+
+    def to_json(self, task_stats=None):
+        return json.dumps(self.snapshot(task_stats), indent=2)
+
+    def to_prometheus(self, task_stats=None, prefix='coffee_machine'):
+        """Prometheus text exposition: one histogram family, max gauges, task counters"""
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+        name = f"{prefix}_latency_seconds"
+        lines = [f"# HELP {name} Control path latency by task and phase",
+                 f"# TYPE {name} histogram"]
+        for (task, phase), histogram in histograms:
+            labels = f'task="{task}",phase="{phase}"'
+            for bound in PROMETHEUS_BUCKETS:
+                count = histogram.count_at_or_below(int(bound * 1e6))
+                lines.append(f'{name}_bucket{{{labels},le="{bound:g}"}} {count}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f"{name}_sum{{{labels}}} {histogram.total_us / 1e6:.6f}")
+            lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+
+        name = f"{prefix}_latency_max_seconds"
+        lines += [f"# HELP {name} Longest latency seen by task and phase",
+                  f"# TYPE {name} gauge"]
+        for (task, phase), histogram in histograms:
+            lines.append(f'{name}{{task="{task}",phase="{phase}"}} {histogram.max_us / 1e6:.6f}')
+
+        for key in ('runs', 'overruns', 'missed_periods', 'failures'):
+            name = f"{prefix}_task_{key}_total"
+            lines += [f"# HELP {name} Scheduled task {key.replace('_', ' ')}",
+                      f"# TYPE {name} counter"]
+            for task, stats in sorted((task_stats or {}).items()):
+                lines.append(f'{name}{{task="{task}"}} {stats[key]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, task_stats=None):
+        """Replace path atomically: JSON for *.json, Prometheus text otherwise
+
+        A .prom file in node_exporter's textfile directory is scraped as is.
+        """
+        text = self.to_json(task_stats) if path.endswith('.json') else \
+            self.to_prometheus(task_stats)
+        partial = path + '.tmp'
+        with open(partial, 'w') as f:
+            f.write(text)
+        os.replace(partial, path)
+
+
+def print_report(snapshot, out=sys.stdout):
+    out.write(f"{'task':<26}{'phase':<16}{'count':>8}{'p50 µs':>10}{'p99 µs':>10}"
+              f"{'max µs':>10}{'overruns':>10}\n")
+    for task, phases in sorted(snapshot['tasks'].items()):
+        for phase, summary in sorted(phases.items()):
+            if not isinstance(summary, dict):
+                continue
+            out.write(f"{task:<26}{phase:<16}{summary['count']:>8}"
+                      f"{summary['p50_us'] or 0:>10}{summary['p99_us'] or 0:>10}"
+                      f"{summary['max_us']:>10}{phases.get('overruns', 0):>10}\n")
+
+
+if __name__ == "__main__":
+    # latency.py [SECONDS] [OUT.json]: time the control path on the simulated machine,
+    # e.g. before and after a change, and compare the JSON reports
+    from coffee_machine_control import CoffeeMachineController
+    from simulator import SimulatedBackend
+
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 300.0
+    io = SimulatedBackend()
+    io.model.outlet_temp = 52.5
+    controller = CoffeeMachineController(io)
+    controller.start_process({'target_temp': 52.5, 'powder_rate': 50})
+    controller.scheduler.run_for(seconds)
+
+    snapshot = controller.latency_report()
+    print_report(snapshot)
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], 'w') as f:
+            json.dump(snapshot, f, indent=2)
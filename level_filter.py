@@ -0,0 +1,65 @@
+def median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2
+
+
+class LevelKalman:
+    """1D Kalman filter on water height (cm) with a drain model
+
+    predict() lowers the estimate by the drain the pump flow implies, so
+    the filter can trust each measurement less without lagging the real
+    level. update() gates measurements more than `gate` standard
+    deviations from the prediction (splashes, multipath); after
+    `max_rejects` in a row the level is assumed to have really jumped,
+    as on a refill, and the filter restarts from the measurement.
+    """
+
+    def __init__(self, process_noise=0.01, measurement_noise=0.1, gate=4.0, max_rejects=5):
+        self.process_noise = process_noise          # cm²/s of unmodelled level change
+        self.measurement_noise = measurement_noise  # cm² per burst median
+        self.gate = gate
+        self.max_rejects = max_rejects
+        self.reset()
+
+    def reset(self):
+        self.height = None
+        self.variance = 0.0
+        self.rejects = 0
+        self.rejected = 0
+
+    @property
+    def initialized(self):
+        return self.height is not None
+
+    def predict(self, dt, drain_cm_s=0.0):
+        if self.height is None:
+            return
+        self.height -= drain_cm_s * dt
+        self.variance += self.process_noise * dt
+
+    def update(self, measured):
+        """Fuse one height measurement; returns False if it was gated out"""
+        if self.height is None:
+            self.height = measured
+            self.variance = self.measurement_noise
+            return True
+
+        innovation = measured - self.height
+        spread = self.variance + self.measurement_noise
+        if innovation * innovation > self.gate * self.gate * spread:
+            self.rejects += 1
+            self.rejected += 1
+            if self.rejects >= self.max_rejects:
+                self.height = measured
+                self.variance = self.measurement_noise
+                self.rejects = 0
+            return False
+
+        gain = self.variance / spread
+        self.height += gain * innovation
+        self.variance *= 1 - gain
+        self.rejects = 0
+        return True
@@ -1,4 +1,5 @@
 const { app, BrowserWindow } = require('electron');
+const fs = require('fs');
 const path = require('path');
 
 // Handle creating/removing shortcuts on Windows when installing/uninstalling
@@ -6,6 +7,21 @@ if (require('electron-squirrel-startup')) {
   app.quit();
 }
 
+// Token the controller daemon requires on commands: COFFEE_MACHINE_TOKEN, or
+// the owner-only file the daemon writes at launch
+function apiToken() {
+  if (process.env.COFFEE_MACHINE_TOKEN) {
+    return process.env.COFFEE_MACHINE_TOKEN;
+  }
+  const tokenFile = process.env.COFFEE_MACHINE_TOKEN_FILE ||
+    path.join(__dirname, 'coffee_machine.token');
+  try {
+    return fs.readFileSync(tokenFile, 'utf8').trim();
+  } catch (err) {
+    return '';
+  }
+}
+
 function createWindow() {
   // Create the browser window with Raspberry Pi 7-inch dimensions
   // Screen Dimensions: 194mm x 110mm x 20mm
@@ -17,7 +33,10 @@ function createWindow() {
     minHeight: 480,
     webPreferences: {
       nodeIntegration: true,
-      contextIsolation: false
+      contextIsolation: false,
+      // Exposes window.coffeeMachine, the client for the controller daemon's API
+      preload: path.join(__dirname, 'preload.js'),
+      additionalArguments: [`--coffee-machine-token=${apiToken()}`]
     },
     frame: true,  // Enable window frame for controls
     resizable: true,  // Allow resizing
@@ -0,0 +1,54 @@
+from temperature_control import clamp
+
+
+class TrapezoidProfile:
+    """Constant-acceleration ramp: speed moves at most `accel` %/s"""
+
+    def __init__(self, accel):
+        self.accel = accel
+
+    def reset(self):
+        pass
+
+    def step(self, speed, target, dt):
+        limit = self.accel * dt
+        return speed + clamp(target - speed, -limit, limit)
+
+
+class SCurveProfile:
+    """Jerk-limited ramp
+
+    Acceleration itself ramps at `jerk` %/s² up to `max_accel` %/s and is
+    wound back down early enough to arrive on the target with zero
+    acceleration, so the motor never sees a torque step.
+    """
+
+    def __init__(self, max_accel, jerk):
+        self.max_accel = max_accel
+        self.jerk = jerk
+        self.accel = 0.0
+
+    def reset(self):
+        self.accel = 0.0
+
+    def step(self, speed, target, dt):
+        error = target - speed
+        if error == 0:
+            self.accel = 0.0
+            return speed
+
+        direction = 1.0 if error > 0 else -1.0
+        # Speed still gained while winding the current acceleration back to zero
+        settling = self.accel * abs(self.accel) / (2 * self.jerk)
+        if self.accel * direction > 0 and abs(settling) >= abs(error):
+            self.accel -= direction * min(self.jerk * dt, abs(self.accel))
+        else:
+            self.accel = clamp(self.accel + direction * self.jerk * dt,
+                               -self.max_accel, self.max_accel)
+
+        new_speed = speed + self.accel * dt
+        if (target - new_speed) * direction <= 0 or \
+                (abs(target - new_speed) < 1e-3 and abs(self.accel) <= self.jerk * dt):
+            self.accel = 0.0
+            return target
+        return new_speed
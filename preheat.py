@@ -0,0 +1,113 @@
+from temperature_control import PIDController, TemperatureCommand
+
+# Warm-up phases
+COLD = 'cold'
+PREHEATING = 'preheating'
+READY = 'ready'
+
+
+def parse_time_of_day(text):
+    """'HH:MM' to seconds after midnight"""
+    hours, minutes = text.split(':')
+    seconds = int(hours) * 3600 + int(minutes) * 60
+    if not 0 <= seconds < 24 * 3600:
+        raise ValueError(f"Time of day out of range: {text}")
+    return seconds
+
+
+class KeepWarmSchedule:
+    """Idle holding temperatures by time of day
+
+    periods: [('HH:MM', 'HH:MM', temp), ...]. A period whose end is before
+    its start runs over midnight.
+    """
+
+    def __init__(self, periods=()):
+        self.periods = [(parse_time_of_day(start), parse_time_of_day(end), float(temp))
+                        for start, end, temp in periods]
+
+    def target(self, seconds_of_day):
+        """Holding temperature now, or None outside every period"""
+        for start, end, temp in self.periods:
+            if start <= end:
+                inside = start <= seconds_of_day < end
+            else:
+                inside = seconds_of_day >= start or seconds_of_day < end
+            if inside:
+                return temp
+        return None
+
+
+class Preheater:
+    """Full-power warm-up and idle keep-warm
+
+    While preheating the heater runs at 100% with the pump at min_flow and
+    the valve circulating, so the boiler heats evenly without sending cold
+    water out, until temp_out is within `margin` of the target. Time to
+    ready is extrapolated from the smoothed rate of rise.
+    """
+
+    def __init__(self, min_flow=10.0, margin=1.0, smoothing=0.3):
+        self.min_flow = min_flow
+        self.margin = margin
+        self.smoothing = smoothing
+        self.pid = PIDController(6.0, 0.1, 4.0)  # keep-warm only
+        self.phase = COLD
+        self.target = None
+        self.started = None
+        self.ready_at = None
+        self.rise_rate = None
+        self.last = None
+
+    @property
+    def active(self):
+        return self.phase == PREHEATING
+
+    def is_hot(self, temp, target):
+        return temp >= target - self.margin
+
+    def start(self, t, temp, target):
+        """Begin warming up; returns False if temp is already there"""
+        self.target = target
+        self.started = t
+        self.rise_rate = None
+        self.last = (t, temp)
+        if self.is_hot(temp, target):
+            self.phase = READY
+            self.ready_at = t
+            return False
+        self.phase = PREHEATING
+        self.ready_at = None
+        return True
+
+    def stop(self):
+        self.phase = COLD
+        self.pid.reset()
+
+    def update(self, t, temp):
+        """One preheat tick; the phase turns READY once the band is reached"""
+        last_t, last_temp = self.last
+        if t > last_t:
+            rate = (temp - last_temp) / (t - last_t)
+            if self.rise_rate is None:
+                self.rise_rate = rate
+            else:
+                self.rise_rate += self.smoothing * (rate - self.rise_rate)
+        self.last = (t, temp)
+
+        if self.is_hot(temp, self.target):
+            self.phase = READY
+            self.ready_at = t
+        return TemperatureCommand(100.0, self.min_flow, True)
+
+    def time_to_ready(self, temp):
+        """Seconds until the band is reached, None while unknown"""
+        if self.phase == READY:
+            return 0.0
+        if self.phase != PREHEATING or not self.rise_rate or self.rise_rate <= 0:
+            return None
+        return max(0.0, (self.target - self.margin - temp) / self.rise_rate)
+
+    def keep_warm(self, target, temp, dt):
+        """Hold an idle boiler at target with the water circulating"""
+        return TemperatureCommand(self.pid.update(target, temp, dt), self.min_flow, True)
@@ -0,0 +1,55 @@
+// Client for the headless controller (python3 coffee_machine_control.py --headless).
+// The page gets window.coffeeMachine; rendering never runs in the control process.
+const API_URL = process.env.COFFEE_MACHINE_API || 'http://127.0.0.1:8765';
+// Per-launch token from main.js; the daemon refuses commands without it
+const TOKEN_ARG = '--coffee-machine-token=';
+const API_TOKEN = (process.argv.find((arg) => arg.startsWith(TOKEN_ARG)) || TOKEN_ARG)
+  .slice(TOKEN_ARG.length);
+
+async function request(method, endpoint, body) {
+  const response = await fetch(API_URL + endpoint, {
+    method,
+    headers: body === undefined ? {} : {
+      'Content-Type': 'application/json',
+      'X-Coffee-Machine-Token': API_TOKEN
+    },
+    body: body === undefined ? undefined : JSON.stringify(body)
+  });
+  const payload = await response.json();
+  if (!response.ok) {
+    throw new Error(payload.error || `HTTP ${response.status}`);
+  }
+  return payload;
+}
+
+window.coffeeMachine = {
+  getState: () => request('GET', '/state'),
+  getSummary: () => request('GET', '/summary'),
+  start: (recipe) => request('POST', '/start', recipe),
+  stop: () => request('POST', '/stop', {}),
+  emergencyStop: () => request('POST', '/emergency-stop', {}),
+  preheat: (targetTemp) => request('POST', '/preheat', { target_temp: targetTemp }),
+
+  // Calls onState(snapshot) for every pushed state change; returns an unsubscribe function.
+  // EventSource reconnects by itself if the daemon restarts.
+  subscribe(onState) {
+    const events = new EventSource(API_URL + '/events');
+    events.onmessage = (event) => onState(JSON.parse(event.data));
+    return () => events.close();
+  },
+
+  // Delta-encoded WebSocket telemetry capped at rateHz frames/s. Calls
+  // onState(state) with the full state rebuilt from the changed fields. WebSockets
+  // cannot carry custom headers, so the token is offered as a subprotocol.
+  stream(onState, rateHz = 10) {
+    const socket = new WebSocket(API_URL.replace(/^http/, 'ws') + `/stream?rate=${rateHz}`,
+                                 ['coffee-machine', API_TOKEN]);
+    let state = {};
+    socket.onmessage = (event) => {
+      const frame = JSON.parse(event.data);
+      state = frame.key ? frame.s : { ...state, ...frame.s };
+      onState(state);
+    };
+    return () => socket.close();
+  }
+};
@@ -0,0 +1,177 @@
+import json
+from bisect import bisect_right
+from collections import namedtuple
+
+# Stage kinds, in the order a recipe may use them
+PREHEAT = 'preheat'
+DOSE = 'dose'
+BREW = 'brew'
+HOLD = 'hold'
+STAGE_KINDS = (PREHEAT, DOSE, BREW, HOLD)
+
+MAX_STAGE_DURATION = 24 * 3600.0  # s; longer stages are rejected as malformed
+
+RECIPE_KEYS = {'name', 'target_temp', 'flow_rate', 'powder_rate', 'powder_g_s',
+               'powder_grams', 'batch_ml', 'stages'}
+STAGE_KEYS = {'stage', 'duration', 'target_temp', 'flow_rate', 'powder_rate', 'powder_g_s',
+              'powder_grams'}
+
+# One step of the plan; start/end are seconds after the boiler is ready
+# (end is None for an open-ended last stage) and powder_g_s is 0 for no dosing
+Stage = namedtuple('Stage', ['index', 'kind', 'start', 'end', 'target_temp', 'flow_rate',
+                             'powder_g_s', 'powder_grams'])
+
+
+class RecipePlan:
+    """Compiled, immutable execution plan for one recipe
+
+    stage_at() is what the control loop calls each tick: the stage for an
+    elapsed time is a bisection of the precomputed stage end ticks, so the
+    plan's size depends on the number of stages, not on how long they run.
+    """
+
+    __slots__ = ('name', 'stages', 'tick', 'duration', 'preheat_temp', 'batch_ml', '_ends')
+
+    def __init__(self, name, stages, tick=1.0, preheat_temp=None, batch_ml=None):
+        set_field = object.__setattr__
+        set_field(self, 'name', name)
+        set_field(self, 'stages', tuple(stages))
+        set_field(self, 'tick', tick)
+        set_field(self, 'duration', self.stages[-1].end)
+        set_field(self, 'preheat_temp', preheat_temp if preheat_temp is not None
+                  else self.stages[0].target_temp)
+        set_field(self, 'batch_ml', batch_ml)
+
+        # Tick at which each timed stage ends, in order
+        set_field(self, '_ends', tuple(round(stage.end / tick) for stage in self.stages
+                                       if stage.end is not None))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RecipePlan is immutable; compile a new one")
+
+    def stage_at(self, elapsed):
+        """Stage running elapsed seconds into the plan, None once it has finished"""
+        i = bisect_right(self._ends, int(elapsed / self.tick))
+        if i < len(self._ends):
+            return self.stages[i]
+        return self.stages[-1] if self.duration is None else None
+
+    def __repr__(self):
+        return f"RecipePlan({self.name!r}, {[s.kind for s in self.stages]})"
+
+
+def _number(data, key, where, low=None, high=None, default=None):
+    value = data.get(key, default)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"{where}.{key} must be a number")
+    if (low is not None and value < low) or (high is not None and value > high):
+        raise ValueError(f"{where}.{key} must be between {low} and {high}")
+    return float(value)
+
+
+def compile_recipe(recipe, default_temp, default_flow, max_feed_g_s, temp_range=(45.0, 60.0),
+                   tick=1.0):
+    """Validate a recipe dict and compile it into a RecipePlan
+
+    Top-level target_temp, flow_rate and powder_rate/powder_g_s are the
+    defaults for every stage except hold, which defaults to no flow and no
+    powder. Without `stages` the recipe is a single open-ended brew stage.
+    powder_rate is a percentage of max_feed_g_s; powder_g_s overrides it.
+    Raises ValueError naming the offending key.
+    """
+    if not isinstance(recipe, dict):
+        raise ValueError("Recipe must be a JSON object")
+    name = recipe.get('name', 'custom')
+    unknown = set(recipe) - RECIPE_KEYS
+    if unknown:
+        raise ValueError(f"{name}: unknown recipe keys {sorted(unknown)}")
+
+    low, high = temp_range
+    defaults = {
+        'target_temp': _number(recipe, 'target_temp', name, low, high, default_temp),
+        'flow_rate': _number(recipe, 'flow_rate', name, 0, 100, default_flow),
+        'powder_g_s': _powder_rate(recipe, name, max_feed_g_s, 0.0)
+    }
+    batch_ml = _number(recipe, 'batch_ml', name, low=0)
+
+    stage_list = recipe.get('stages')
+    if stage_list is None:
+        stage_list = [{'stage': BREW, 'powder_grams': recipe.get('powder_grams')}]
+    if not isinstance(stage_list, list) or not stage_list:
+        raise ValueError(f"{name}.stages must be a non-empty list")
+
+    stages = []
+    preheat_temp = None
+    start = 0.0
+    timed = [s for s in stage_list if not (isinstance(s, dict) and s.get('stage') == PREHEAT)]
+    for i, data in enumerate(stage_list):
+        where = f"{name}.stages[{i}]"
+        if not isinstance(data, dict):
+            raise ValueError(f"{where} must be an object")
+        unknown = set(data) - STAGE_KEYS
+        if unknown:
+            raise ValueError(f"{where}: unknown stage keys {sorted(unknown)}")
+        kind = data.get('stage')
+        if kind not in STAGE_KINDS:
+            raise ValueError(f"{where}.stage must be one of {', '.join(STAGE_KINDS)}")
+
+        target = _number(data, 'target_temp', where, low, high, defaults['target_temp'])
+        if kind == PREHEAT:
+            # Runs until the boiler is ready, before the timed stages
+            if i != 0:
+                raise ValueError(f"{where}: preheat must be the first stage")
+            preheat_temp = target
+            continue
+
+        hold = kind == HOLD
+        flow = _number(data, 'flow_rate', where, 0, 100, 0.0 if hold else defaults['flow_rate'])
+        powder = _powder_rate(data, where, max_feed_g_s, 0.0 if hold else defaults['powder_g_s'])
+        duration = _number(data, 'duration', where, low=0, high=MAX_STAGE_DURATION)
+        last = data is timed[-1]
+        if duration is None and not last:
+            raise ValueError(f"{where}.duration is required except on the last stage")
+        if duration is not None and duration < tick:
+            raise ValueError(f"{where}.duration must be at least {tick} s")
+        end = None if duration is None else start + duration
+        stages.append(Stage(len(stages), kind, start, end, target, flow, powder,
+                            _number(data, 'powder_grams', where, low=0)))
+        start = end
+
+    if not stages:
+        raise ValueError(f"{name}: needs at least one stage after preheat")
+    return RecipePlan(name, stages, tick, preheat_temp, batch_ml)
+
+
+def _powder_rate(data, where, max_feed_g_s, default):
+    rate = _number(data, 'powder_g_s', where, 0, max_feed_g_s)
+    if rate is not None:
+        return rate
+    percent = _number(data, 'powder_rate', where, 0, 100)
+    return default if percent is None else percent / 100 * max_feed_g_s
+
+
+def load_recipes(path, default_temp, default_flow, max_feed_g_s, temp_range=(45.0, 60.0),
+                 tick=1.0):
+    """Compile every recipe in a JSON file: {name: RecipePlan}
+
+    The file is either config.json with a "recipes" object of named
+    recipes (other sections are ignored) or a single recipe with a "name".
+    """
+    with open(path) as f:
+        data = json.load(f)
+    if 'recipes' in data:
+        entries = data['recipes']
+        if not isinstance(entries, dict):
+            raise ValueError(f"{path}: recipes must be an object of named recipes")
+    else:
+        entries = {data.get('name', 'custom'): data}
+
+    plans = {}
+    for name, recipe in entries.items():
+        if isinstance(recipe, dict):
+            recipe = dict(recipe, name=name)
+        plans[name] = compile_recipe(recipe, default_temp, default_flow, max_feed_g_s,
+                                     temp_range, tick)
+    return plans
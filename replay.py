@@ -0,0 +1,230 @@
+import gzip
+import json
+import re
+import sys
+import time
+from datetime import datetime
+
+from telemetry import MAGIC, read_capture, resample
+from temperature_control import PIDTemperatureController
+from thermal_model import MPCTemperatureController, ThermalModel, fit_thermal_model
+
+# The control loop's log line, as written by temperature_control_step (with
+# a FleetSupervisor the message starts with the machine name)
+LOG_LINE = re.compile(r'^(\S+ \S+) - \w+ - (?:\[[^\]]*\] )?Temp: ([-\d.]+)°C, '
+                      r'Power: ([-\d.]+)%, Flow: ([-\d.]+)%, Circulating: (True|False)')
+LOG_TIME_FORMAT = '%Y-%m-%d %H:%M:%S,%f'
+
+POWER_STEP = 0.5  # % change in heater power that counts as a move
+
+# Scores regressions() compares, by which way is better. Lower-is-better
+# scores carry an absolute slack in their own units, so a baseline of 0
+# (no overshoot, no valve toggles) still leaves the tolerance some room
+HIGHER_IS_BETTER = ('steps_per_s', 'time_in_band')
+LOWER_IS_BETTER = {
+    'settling_time_s': 2.0,
+    'overshoot_c': 0.1,
+    'rms_error_c': 0.05,
+    'valve_toggles': 1,
+    'power_changes': 1,
+    'power_travel': 5.0
+}
+
+# Temperature strategies to compare: factory(model, temp_min, temp_max, flow_rate)
+STRATEGIES = {
+    'pid': lambda model, low, high, flow: PIDTemperatureController(low, high, flow),
+    'mpc': lambda model, low, high, flow: MPCTemperatureController(model, low, high, flow)
+}
+
+
+def load_trace(path, dt=1.0, inlet_temp=20.0):
+    """A recorded run resampled onto a dt grid
+
+    path is a telemetry capture or a controller log (optionally .gz); logs
+    carry no inlet temperature, so inlet_temp stands in for it. Returns a
+    dict of equal-length lists: time, temp_in, temp_out, heater_power,
+    flow_rate (pump %) and valve.
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        binary = f.read(len(MAGIC)) == MAGIC
+    if binary:
+        columns = read_capture(path, opener)
+    else:
+        columns = {name: [] for name in ('time', 'temp_in', 'temp_out', 'heater_power',
+                                         'flow_rate', 'valve')}
+        with opener(path, 'rt', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                match = LOG_LINE.match(line)
+                if not match:
+                    continue
+                stamp, temp, power, flow, valve = match.groups()
+                columns['time'].append(datetime.strptime(stamp, LOG_TIME_FORMAT).timestamp())
+                columns['temp_in'].append(inlet_temp)
+                columns['temp_out'].append(float(temp))
+                columns['heater_power'].append(float(power))
+                columns['flow_rate'].append(float(flow))
+                columns['valve'].append(valve == 'True')
+
+    times = columns['time']
+    if len(times) < 2:
+        raise ValueError(f"Recording too short to replay: {path}")
+    trace = resample(columns, dt)
+    trace['valve'] = [bool(valve) for valve in trace['valve']]
+    return trace
+
+
+def fit_trace(trace, max_flow_ml_s=20.0, dt=1.0):
+    """ThermalModel of the boiler the trace was recorded on"""
+    flows = [0.0 if valve else speed / 100 * max_flow_ml_s
+             for speed, valve in zip(trace['flow_rate'], trace['valve'])]
+    return fit_thermal_model(trace['temp_in'], trace['temp_out'], trace['heater_power'],
+                             flows, dt)
+
+
+def replay(trace, controller, plant, target_temp, max_flow_ml_s=20.0):
+    """Run a temperature strategy in closed loop against the fitted boiler
+
+    The recorded inlet temperature and pump speed are the disturbances; the
+    heater power and circulation are the strategy's own. Only the
+    controller's update() is timed. Returns (temps, powers, circulating,
+    compute_ns).
+    """
+    dt = plant.dt
+    temp = trace['temp_out'][0]
+    element = trace['heater_power'][0]
+    controller.reset()
+    temps, powers, circulating = [], [], []
+    compute_ns = 0
+    for temp_in, speed in zip(trace['temp_in'], trace['flow_rate']):
+        controller.flow_rate = speed
+        flow = speed / 100 * max_flow_ml_s
+        started = time.perf_counter_ns()
+        command = controller.update(target_temp, temp_in, temp, flow, dt)
+        compute_ns += time.perf_counter_ns() - started
+
+        temps.append(temp)
+        powers.append(command.heater_power)
+        circulating.append(command.circulate)
+        temp, element = plant.step(temp, element, command.heater_power,
+                                   0.0 if command.circulate else flow, temp_in)
+    return temps, powers, circulating, compute_ns
+
+
+def score(temps, powers, circulating, target_temp, dt=1.0, band=1.0):
+    """Control quality and actuator wear of one run
+
+    Settling time is when temp_out last entered target ± band for good
+    (None if it ends outside); overshoot is the furthest it rose above the
+    target after first reaching it.
+    """
+    errors = [temp - target_temp for temp in temps]
+    inside = [abs(error) <= band for error in errors]
+    if inside[-1]:
+        last_outside = max((i for i, ok in enumerate(inside) if not ok), default=-1)
+        settling = (last_outside + 1) * dt
+    else:
+        settling = None
+    reached = next((i for i, error in enumerate(errors) if error >= 0), None)
+    overshoot = max(0.0, max(errors[reached:])) if reached is not None else 0.0
+    moves = [abs(b - a) for a, b in zip(powers, powers[1:])]
+    return {
+        'time_in_band': sum(inside) / len(inside),
+        'settling_time_s': settling,
+        'overshoot_c': overshoot,
+        'rms_error_c': (sum(error * error for error in errors) / len(errors)) ** 0.5,
+        'valve_toggles': sum(1 for a, b in zip(circulating, circulating[1:]) if a != b),
+        'power_changes': sum(1 for move in moves if move > POWER_STEP),
+        'power_travel': sum(moves)
+    }
+
+
+def benchmark(trace, plant, target_temp, strategies=('pid', 'mpc'), temp_range=(45.0, 60.0),
+              max_flow_ml_s=20.0, band=1.0):
+    """Score the recorded run and each strategy replayed on it: {name: metrics}"""
+    dt = plant.dt
+    results = {'recorded': score(trace['temp_out'], trace['heater_power'], trace['valve'],
+                                 target_temp, dt, band)}
+    low, high = temp_range
+    for name in strategies:
+        controller = STRATEGIES[name](plant, low, high, trace['flow_rate'][0])
+        temps, powers, circulating, compute_ns = replay(trace, controller, plant, target_temp,
+                                                        max_flow_ml_s)
+        metrics = score(temps, powers, circulating, target_temp, dt, band)
+        metrics['steps_per_s'] = len(temps) / (compute_ns / 1e9) if compute_ns else None
+        results[name] = metrics
+    return results
+
+
+def regressions(results, baseline, tolerance=0.1):
+    """Where results are more than tolerance (a fraction) worse than a baseline run
+
+    Speed and time in band must not fall; settling time, overshoot, error
+    and actuator wear must not rise past the tolerance or their absolute
+    slack, whichever is larger. A run that no longer settles at all is a
+    regression whatever the tolerance.
+    """
+    found = []
+    for name, metrics in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        for key in HIGHER_IS_BETTER:
+            old, new = before.get(key), metrics.get(key)
+            if old and new is not None and new < old * (1 - tolerance):
+                found.append(f"{name}.{key} fell from {old:.4g} to {new:.4g}")
+        for key, slack in LOWER_IS_BETTER.items():
+            if key not in before or key not in metrics:
+                continue
+            old, new = before[key], metrics[key]
+            if old is None:
+                continue
+            if new is None:
+                found.append(f"{name}.{key} was {old:.4g}, now never reached")
+            elif new > max(old * (1 + tolerance), old + slack):
+                found.append(f"{name}.{key} rose from {old:.4g} to {new:.4g}")
+    return found
+
+
+def print_results(results, out=sys.stdout):
+    columns = ('time_in_band', 'settling_time_s', 'overshoot_c', 'rms_error_c',
+               'valve_toggles', 'power_changes', 'power_travel', 'steps_per_s')
+    out.write(f"{'':<10}" + ''.join(f"{column:>16}" for column in columns) + '\n')
+    for name, metrics in results.items():
+        cells = []
+        for column in columns:
+            value = metrics.get(column)
+            cells.append(f"{'-':>16}" if value is None else f"{value:>16.4g}")
+        out.write(f"{name:<10}" + ''.join(cells) + '\n')
+
+
+if __name__ == "__main__":
+    # replay.py RECORDING [--target 52.5] [--model thermal_model.json] [--strategies pid,mpc]
+    #                     [--json results.json] [--baseline results.json] [--tolerance 0.1]
+    if len(sys.argv) < 2:
+        print("Usage: python3 replay.py RECORDING [--target 52.5] [--model FILE] "
+              "[--strategies pid,mpc] [--json OUT] [--baseline FILE] [--tolerance 0.1]")
+        sys.exit(2)
+
+    def option(name, default=None):
+        return sys.argv[sys.argv.index(name) + 1] if name in sys.argv else default
+
+    trace = load_trace(sys.argv[1])
+    if option('--model'):
+        plant = ThermalModel.load(option('--model'))
+    else:
+        plant, rms = fit_trace(trace)
+        print(f"Fitted boiler model to the recording, one-step RMS error {rms:.3f}°C")
+    results = benchmark(trace, plant, float(option('--target', 52.5)),
+                        option('--strategies', 'pid,mpc').split(','))
+    print_results(results)
+
+    if option('--json'):
+        with open(option('--json'), 'w') as f:
+            json.dump(results, f, indent=2)
+    if option('--baseline'):
+        with open(option('--baseline')) as f:
+            found = regressions(results, json.load(f), float(option('--tolerance', 0.1)))
+        for line in found:
+            print(f"REGRESSION {line}")
+        sys.exit(1 if found else 0)
@@ -0,0 +1,157 @@
+import logging
+import threading
+import time
+
+
+class PeriodicTask:
+    """One periodic job and its timing statistics"""
+
+    def __init__(self, name, period, callback, first_deadline_ns):
+        self.name = name
+        self.period_ns = int(period * 1e9)
+        self.callback = callback
+        self.next_deadline_ns = first_deadline_ns
+
+        self.runs = 0
+        self.overruns = 0          # runs that finished after the next deadline
+        self.missed_periods = 0    # deadlines skipped because of overruns
+        self.failures = 0          # runs that raised
+        self.last_duration_ns = 0
+        self.max_duration_ns = 0
+        self.max_lateness_ns = 0   # how late a run started after its deadline
+
+    def finish(self, start_ns, end_ns):
+        """Account for one run and move to the next deadline on the grid"""
+        deadline = self.next_deadline_ns
+        self.max_lateness_ns = max(self.max_lateness_ns, start_ns - deadline)
+        self.runs += 1
+        self.last_duration_ns = end_ns - start_ns
+        self.max_duration_ns = max(self.max_duration_ns, self.last_duration_ns)
+
+        # Stay on the original grid; skip deadlines we have already blown
+        next_deadline = deadline + self.period_ns
+        if end_ns > next_deadline:
+            self.overruns += 1
+            missed = (end_ns - next_deadline) // self.period_ns + 1
+            self.missed_periods += missed
+            next_deadline += missed * self.period_ns
+        self.next_deadline_ns = next_deadline
+
+    def stats(self):
+        return {
+            'period': self.period_ns / 1e9,
+            'runs': self.runs,
+            'overruns': self.overruns,
+            'missed_periods': self.missed_periods,
+            'failures': self.failures,
+            'last_duration_ms': self.last_duration_ns / 1e6,
+            'max_duration_ms': self.max_duration_ns / 1e6,
+            'max_lateness_ms': self.max_lateness_ns / 1e6
+        }
+
+
+class ControlScheduler:
+    """Deterministic scheduler for the controller's periodic tasks
+
+    Deadlines advance on a fixed grid (deadline += period) so loops do not
+    drift by however long each iteration took. With a real clock start()
+    runs the tasks on one thread; with a virtual clock tests call run_for()
+    and time only moves as far as they ask. A LatencyMonitor, if given,
+    gets every run's lateness and perf_counter_ns duration.
+    """
+
+    def __init__(self, clock_ns, sleep, monitor=None):
+        self.clock_ns = clock_ns
+        self.sleep = sleep
+        self.monitor = monitor
+        self.tasks = []
+
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def add_task(self, name, period, callback, phase=0.0):
+        """Schedule callback every period seconds, first run after phase"""
+        task = PeriodicTask(name, period, callback,
+                            self.clock_ns() + int(phase * 1e9))
+        with self._lock:
+            self.tasks.append(task)
+        return task
+
+    def next_deadline_ns(self):
+        with self._lock:
+            return min((task.next_deadline_ns for task in self.tasks), default=None)
+
+    def run_pending(self):
+        """Run every task whose deadline has passed, earliest first"""
+        while True:
+            now = self.clock_ns()
+            with self._lock:
+                due = [task for task in self.tasks if task.next_deadline_ns <= now]
+            if not due:
+                return
+            task = min(due, key=lambda t: t.next_deadline_ns)
+            self._run_task(task, now)
+
+    def _run_task(self, task, start_ns):
+        started = time.perf_counter_ns()
+        try:
+            task.callback()
+        except Exception as e:
+            task.failures += 1
+            logging.error("Scheduled task %s failed: %s", task.name, e)
+        self.finish_run(task, start_ns, started)
+
+    def finish_run(self, task, start_ns, started_perf_ns):
+        """Record one run's latency and move the task to its next deadline"""
+        if self.monitor is not None:
+            self.monitor.record(task.name, 'lateness', start_ns - task.next_deadline_ns)
+            self.monitor.record(task.name, 'duration', time.perf_counter_ns() - started_perf_ns)
+        task.finish(start_ns, self.clock_ns())
+
+    def run_for(self, seconds):
+        """Advance the clock by seconds, running tasks as they fall due"""
+        end_ns = self.clock_ns() + int(round(seconds * 1e9))
+        while True:
+            self.run_pending()
+            now = self.clock_ns()
+            deadline = self.next_deadline_ns()
+            if deadline is None or deadline > end_ns:
+                if end_ns > now:
+                    self.sleep((end_ns - now) / 1e9)
+                return
+            if deadline > now:
+                self.sleep((deadline - now) / 1e9)
+
+    def _run_forever(self):
+        while not self._stop_event.is_set():
+            self.run_pending()
+            deadline = self.next_deadline_ns()
+            if deadline is None:
+                self._stop_event.wait(0.1)
+                continue
+            delay = (deadline - self.clock_ns()) / 1e9
+            if delay > 0:
+                self._stop_event.wait(delay)
+
+    def start(self):
+        """Run the tasks on a background thread against a real clock"""
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run_forever,
+                                        name="control-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self._thread = None
+
+    def stats(self):
+        return {task.name: task.stats() for task in self.tasks}
+
+    def failures(self):
+        """Total task runs that raised"""
+        with self._lock:
+            return sum(task.failures for task in self.tasks)
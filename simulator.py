@@ -0,0 +1,322 @@
+import random
+import threading
+import time
+
+from hal import IOBackend, HARDWARE_PWM_CHANNELS
+from hx711 import HX711Emulator, DEFAULT_SCALE
+from ultrasonic import speed_of_sound_cm_s
+
+# Same BCM assignments as the controller and HardwareTest.PINS
+DEFAULT_PINS = {
+    'PUMP_PWM': 18,
+    'PUMP_DIR1': 23,
+    'PUMP_DIR2': 24,
+    'POWDER_PWM': 19,
+    'POWDER_DIR1': 25,
+    'POWDER_DIR2': 26,
+    'HEATER': 12,
+    'WATER_TRIGGER': 16,
+    'WATER_ECHO': 17,
+    'VALVE': 22,
+    'POWDER_WEIGHT': 27,  # HX711 DOUT
+    'POWDER_CLOCK': 5     # HX711 SCK
+}
+
+WATER_HEAT_CAPACITY = 4.186  # J/(g*K), 1 mL ~ 1 g
+
+
+def encode_max31855(temp, cold_junction=25.0, faults=0):
+    """Build the 4-byte MAX31855 frame for a thermocouple reading"""
+    tc = int(round(temp / 0.25)) & 0x3FFF
+    cj = int(round(cold_junction / 0.0625)) & 0xFFF
+    word = (tc << 18) | (cj << 4) | (faults & 0x7)
+    if faults:
+        word |= 1 << 16
+    return list(word.to_bytes(4, 'big'))
+
+
+class MachineModel:
+    """Lumped physical model of boiler, tank and powder hopper"""
+
+    def __init__(self, seed=0, temp_noise=0.0):
+        self.rng = random.Random(seed)
+        self.temp_noise = temp_noise  # std dev in °C added to SPI readings
+        self.thermocouple_faults = [0, 0]  # MAX31855 fault bits per device
+
+        # Boiler: one thermal mass heated by the SSR and cooled by fresh water
+        self.ambient_temp = 20.0
+        self.inlet_temp = 20.0
+        self.outlet_temp = 20.0
+        self.heater_watts = 2000.0
+        self.boiler_heat_capacity = 500 * WATER_HEAT_CAPACITY  # J/K
+        self.boiler_loss = 2.0  # W/K to ambient
+        self.heater_lag = 0.0   # s, element time constant (0 = heat goes straight into the water)
+        self.element_watts = 0.0
+
+        # Pump and tank
+        self.max_flow_ml_s = 20.0
+        self.tank_height = 30.0  # cm
+        self.tank_area = 300.0   # cm^2
+        self.water_height = 27.0  # cm
+        self.echo_spike_rate = 0.0  # fraction of pings answered by a splash or multipath echo
+
+        # Powder hopper on the load cell
+        self.powder_g = 800.0
+        self.max_powder_feed_g_s = 2.0
+        self.load_cell_offset = 0.0           # raw counts with an empty hopper
+        self.load_cell_scale = DEFAULT_SCALE  # counts per gram
+        self.load_cell_noise = 0.0            # std dev in counts
+
+        # Actuator inputs, refreshed from pin state before every step
+        self.heater_duty = 0.0
+        self.pump_duty = 0.0
+        self.pump_forward = False
+        self.powder_duty = 0.0
+        self.powder_forward = False
+        self.circulating = False
+
+        self.dispensed_ml = 0.0
+        self.dispensed_powder_g = 0.0
+
+    def flow_ml_s(self):
+        if not self.pump_forward or self.water_height <= 0:
+            return 0.0
+        return self.max_flow_ml_s * self.pump_duty / 100
+
+    def step(self, dt):
+        """Integrate the model forward by dt seconds"""
+        flow = self.flow_ml_s()
+        # With the valve in circulation the boiler output loops back
+        fresh = 0.0 if self.circulating else flow
+
+        heat_in = self.heater_watts * self.heater_duty / 100
+        if self.heater_lag > 0:
+            self.element_watts += (heat_in - self.element_watts) * min(1.0, dt / self.heater_lag)
+            heat_in = self.element_watts
+        heat_loss = self.boiler_loss * (self.outlet_temp - self.ambient_temp)
+        heat_flow = fresh * WATER_HEAT_CAPACITY * (self.outlet_temp - self.inlet_temp)
+        self.outlet_temp += (heat_in - heat_loss - heat_flow) / self.boiler_heat_capacity * dt
+
+        drawn = min(fresh * dt, self.water_height * self.tank_area)
+        self.water_height -= drawn / self.tank_area
+        self.dispensed_ml += drawn
+
+        if self.powder_forward:
+            fed = min(self.max_powder_feed_g_s * self.powder_duty / 100 * dt, self.powder_g)
+            self.powder_g -= fed
+            self.dispensed_powder_g += fed
+
+    def read_temp(self, device):
+        """Thermocouple reading for SPI device 0 (inlet) or 1 (outlet)"""
+        temp = self.inlet_temp if device == 0 else self.outlet_temp
+        if self.temp_noise:
+            temp += self.rng.gauss(0, self.temp_noise)
+        return temp
+
+    def load_cell_counts(self):
+        counts = self.load_cell_offset + self.powder_g * self.load_cell_scale
+        if self.load_cell_noise:
+            counts += self.rng.gauss(0, self.load_cell_noise)
+        return counts
+
+    def echo_pulse_ns(self):
+        distance = self.tank_height - self.water_height
+        if self.echo_spike_rate and self.rng.random() < self.echo_spike_rate:
+            distance = self.rng.uniform(0.5 * distance, 1.5 * self.tank_height)
+        # The air above the water sits at roughly the tank water temperature
+        return int(2 * distance / speed_of_sound_cm_s(self.inlet_temp) * 1e9)
+
+
+class SimulatedPWM:
+    def __init__(self, backend, pin, frequency, hardware=False):
+        self.backend = backend
+        self.pin = pin
+        self.frequency = frequency
+        self.hardware = hardware
+        self.duty = 0.0
+        self.running = False
+
+    def start(self, duty):
+        self.running = True
+        self.duty = duty
+
+    def ChangeDutyCycle(self, duty):
+        self.duty = duty
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+
+    def stop(self):
+        self.running = False
+        self.duty = 0.0
+
+
+class SimulatedMAX31855:
+    def __init__(self, backend, bus, device):
+        self.backend = backend
+        self.bus = bus
+        self.device = device
+        self.max_speed_hz = 5000000
+        self.mode = 0
+        self.transfers = 0
+
+    def readbytes(self, n):
+        self.transfers += 1
+        temp = self.backend.model.read_temp(self.device)
+        frame = encode_max31855(temp, self.backend.model.ambient_temp,
+                                self.backend.model.thermocouple_faults[self.device])
+        return (frame * ((n + 3) // 4))[:n]
+
+    def xfer2(self, data):
+        return self.readbytes(len(data))
+
+    def close(self):
+        pass
+
+
+class SimulatedBackend(IOBackend):
+    """In-process machine simulator running on a virtual clock
+
+    Time only moves when sleep()/advance() is called, so a control run can
+    be replayed deterministically and far faster than wall clock. With
+    realtime=True the model instead keeps pace with the wall clock, for
+    running simulated machines under a real-time scheduler.
+    """
+
+    def __init__(self, model=None, pins=None, step=0.05, realtime=False):
+        self.realtime = realtime
+        self.model = model or MachineModel()
+        self.pins = dict(DEFAULT_PINS, **(pins or {}))
+        self.step = step  # integration step in seconds
+
+        self.now_ns = 0
+        self.wall_start_ns = time.monotonic_ns()
+        self.levels = {}
+        self.callbacks = {}
+        self.pwms = {}
+        self.shoot_through = 0  # times both DIR inputs of one H-bridge were high
+        self.load_cell = HX711Emulator(self.model.load_cell_counts)
+        self._lock = threading.RLock()
+
+        pins = self.pins
+        self._dir_partners = {}
+        for dir1, dir2 in (('PUMP_DIR1', 'PUMP_DIR2'), ('POWDER_DIR1', 'POWDER_DIR2')):
+            self._dir_partners[pins[dir1]] = pins[dir2]
+            self._dir_partners[pins[dir2]] = pins[dir1]
+
+    # Clock
+
+    def clock_ns(self):
+        if self.realtime:
+            with self._lock:
+                behind = time.monotonic_ns() - self.wall_start_ns - self.now_ns
+                if behind > 0:
+                    self.advance(behind / 1e9)
+        return self.now_ns
+
+    def advance(self, seconds):
+        """Move virtual time forward, integrating the model as we go"""
+        with self._lock:
+            remaining = seconds
+            while remaining > 1e-12:
+                dt = min(self.step, remaining)
+                self._apply_actuators()
+                self.model.step(dt)
+                remaining -= dt
+            self.now_ns += int(round(seconds * 1e9))
+
+    def sleep(self, seconds):
+        if self.realtime:
+            time.sleep(seconds)
+        else:
+            self.advance(seconds)
+
+    def _apply_actuators(self):
+        pins = self.pins
+        self.model.heater_duty = self._duty(pins['HEATER'])
+        self.model.pump_duty = self._duty(pins['PUMP_PWM'])
+        self.model.pump_forward = (self.levels.get(pins['PUMP_DIR1']) == self.HIGH and
+                                   self.levels.get(pins['PUMP_DIR2']) != self.HIGH)
+        self.model.powder_duty = self._duty(pins['POWDER_PWM'])
+        self.model.powder_forward = (self.levels.get(pins['POWDER_DIR1']) == self.HIGH and
+                                     self.levels.get(pins['POWDER_DIR2']) != self.HIGH)
+        self.model.circulating = self.levels.get(pins['VALVE']) == self.HIGH
+
+    def _duty(self, pin):
+        pwm = self.pwms.get(pin)
+        if pwm is not None and pwm.running:
+            return pwm.duty
+        return 100.0 if self.levels.get(pin) == self.HIGH else 0.0
+
+    # GPIO
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction):
+        with self._lock:
+            self.levels.setdefault(pin, self.LOW)
+
+    def input(self, pin):
+        if pin == self.pins['POWDER_WEIGHT']:
+            return self.load_cell.data()
+        return self.levels.get(pin, self.LOW)
+
+    def output(self, pin, value):
+        with self._lock:
+            previous = self.levels.get(pin, self.LOW)
+            self.levels[pin] = value
+        if pin == self.pins['POWDER_CLOCK']:
+            self.load_cell.clock(value)
+        if value == self.HIGH and pin in self._dir_partners:
+            if self.levels.get(self._dir_partners[pin]) == self.HIGH:
+                self.shoot_through += 1
+        if pin == self.pins['WATER_TRIGGER'] and previous == self.HIGH and value == self.LOW:
+            self._play_echo()
+
+    def PWM(self, pin, frequency):
+        pwm = SimulatedPWM(self, pin, frequency)
+        self.pwms[pin] = pwm
+        return pwm
+
+    def hardware_pwm(self, pin, frequency):
+        if pin not in HARDWARE_PWM_CHANNELS:
+            return None
+        pwm = SimulatedPWM(self, pin, frequency, hardware=True)
+        self.pwms[pin] = pwm
+        return pwm
+
+    def add_event_detect(self, pin, edge, callback=None):
+        self.callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def _play_echo(self):
+        """Raise and drop the echo pin as the tank level dictates"""
+        pin = self.pins['WATER_ECHO']
+        callback = self.callbacks.get(pin)
+        self.advance(0.0005)  # transducer burst before the echo line rises
+        self.levels[pin] = self.HIGH
+        if callback:
+            callback(pin)
+        self.advance(self.model.echo_pulse_ns() / 1e9)
+        self.levels[pin] = self.LOW
+        if callback:
+            callback(pin)
+
+    # SPI
+
+    def spi(self, bus, device):
+        return SimulatedMAX31855(self, bus, device)
+
+    def cleanup(self):
+        with self._lock:
+            self.callbacks.clear()
+            for pwm in self.pwms.values():
+                pwm.stop()
+            for pin in self.levels:
+                self.levels[pin] = self.LOW
@@ -0,0 +1,124 @@
+import logging
+import threading
+
+STATE_FIELDS = ('water_level', 'powder_level', 'current_temp', 'inlet_temp',
+                'is_circulating', 'heater_power', 'flow_rate',
+                'powder_feed_rate', 'powder_dispensed', 'flow_ml_s', 'dispensed_ml',
+                'water_time_to_empty', 'powder_time_to_empty', 'batch_will_finish',
+                'recipe', 'stage', 'preheating', 'ready', 'time_to_ready')
+ALERT_FIELDS = ('low_water', 'low_powder', 'temp_out_of_range', 'refill_soon')
+
+
+class MachineState:
+    """Immutable snapshot of controller state and alerts
+
+    Snapshots are never modified after construction; the controller
+    publishes a new one per tick, so a reader holding one always sees a
+    consistent combination of values.
+    """
+
+    __slots__ = ('version', 'timestamp_ns', 'running', 'emergency_stop') + STATE_FIELDS + ALERT_FIELDS
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            object.__setattr__(self, name, fields.pop(name, None))
+        if fields:
+            raise TypeError(f"Unknown state fields: {', '.join(fields)}")
+
+    def __setattr__(self, name, value):
+        raise AttributeError("MachineState is immutable; publish a new snapshot")
+
+    def replace(self, **changes):
+        fields = {name: getattr(self, name) for name in self.__slots__}
+        fields.update(changes)
+        return MachineState(**fields)
+
+    def state_dict(self):
+        return {name: getattr(self, name) for name in STATE_FIELDS}
+
+    def alerts_dict(self):
+        return {name: getattr(self, name) for name in ALERT_FIELDS}
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"MachineState(version={self.version}, {self.state_dict()}, {self.alerts_dict()})"
+
+
+class StatePublisher:
+    """Versioned single-slot publication of MachineState snapshots
+
+    Writers serialise on a lock and swap in a new snapshot with a single
+    reference assignment; readers just read `current` and never block.
+    """
+
+    def __init__(self, initial, clock_ns):
+        self.clock_ns = clock_ns
+        self._write_lock = threading.Lock()
+        self._current = initial.replace(version=0, timestamp_ns=clock_ns())
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        """Call callback(snapshot) after every publish, on the writer's thread"""
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+    @property
+    def current(self):
+        return self._current
+
+    def publish(self, **changes):
+        """Publish a snapshot with changes applied to the latest one"""
+        with self._write_lock:
+            previous = self._current
+            snapshot = previous.replace(version=previous.version + 1,
+                                        timestamp_ns=self.clock_ns(), **changes)
+            self._current = snapshot
+        for callback in list(self._subscribers):
+            # A broken reader must never take down the control tick
+            try:
+                callback(snapshot)
+            except Exception as e:
+                logging.error("State subscriber failed: %s", e)
+        return snapshot
+
+
+class StateChannel:
+    """Coalescing hand-off of snapshots to one consumer on another thread
+
+    Only the newest snapshot is kept. wakeup() is called once when the
+    channel goes from empty to pending and not again until the consumer
+    calls take(), so a slow consumer sees one notification however many
+    ticks were published meanwhile.
+    """
+
+    def __init__(self, publisher, wakeup):
+        self.publisher = publisher
+        self.wakeup = wakeup
+        self._lock = threading.Lock()
+        self._latest = publisher.current
+        self._pending = False
+        self.coalesced = 0
+        publisher.subscribe(self._on_publish)
+
+    def _on_publish(self, snapshot):
+        with self._lock:
+            if self._pending:
+                self.coalesced += 1
+            self._latest = snapshot
+            notify = not self._pending
+            self._pending = True
+        if notify:
+            self.wakeup()
+
+    def take(self):
+        """Latest snapshot; re-arms the wakeup"""
+        with self._lock:
+            self._pending = False
+            return self._latest
+
+    def close(self):
+        self.publisher.unsubscribe(self._on_publish)
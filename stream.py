@@ -0,0 +1,220 @@
+import base64
+import hashlib
+import json
+import struct
+import threading
+import time
+
+from state import STATE_FIELDS, ALERT_FIELDS, StateChannel
+
+# Snapshot fields a stream carries, in binary field-index order
+STREAM_FIELDS = ('running', 'emergency_stop') + STATE_FIELDS + ALERT_FIELDS
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+# WebSocket opcodes
+TEXT = 0x1
+BINARY = 0x2
+CLOSE = 0x8
+PING = 0x9
+PONG = 0xA
+
+# Close codes (RFC 6455 section 7.4.1)
+PROTOCOL_ERROR = 1002
+MESSAGE_TOO_BIG = 1009
+
+# Clients only send control frames (pings, pongs, closes), at most 125 bytes each
+MAX_CLIENT_PAYLOAD = 4096
+
+# Binary frame layout: header, then per changed field an index, a type and the value
+BINARY_HEADER = struct.Struct('<BIqB')  # flags, version, timestamp_ns, field count
+KEYFRAME = 0x01
+NONE, FALSE, TRUE, FLOAT, STRING = range(5)
+FLOAT_VALUE = struct.Struct('<f')
+
+
+class FrameError(Exception):
+    """A frame the connection must be closed over, with close code `code`"""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+def websocket_accept(key):
+    """Sec-WebSocket-Accept for a client's Sec-WebSocket-Key"""
+    digest = hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()
+    return base64.b64encode(digest).decode()
+
+
+def encode_ws_frame(opcode, payload, mask=None):
+    """One final WebSocket frame; clients must pass a 4-byte mask"""
+    if isinstance(payload, str):
+        payload = payload.encode()
+    length = len(payload)
+    mask_bit = 0x80 if mask else 0
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, mask_bit | length)
+    elif length < 1 << 16:
+        header = struct.pack('!BBH', 0x80 | opcode, mask_bit | 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, mask_bit | 127, length)
+    if mask:
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        header += mask
+    return header + payload
+
+
+def read_ws_frame(read, max_length=None, require_mask=False):
+    """(opcode, payload) of the next frame; read(n) returns up to n bytes
+
+    A server reading a client passes require_mask (RFC 6455 requires every
+    client frame to be masked) and a max_length, which is checked before
+    the payload is read. Raises FrameError for a frame to refuse and
+    EOFError if the connection ends mid-frame.
+    """
+    def read_exactly(n):
+        data = read(n)
+        if len(data) < n:
+            raise EOFError("Connection closed mid-frame")
+        return data
+
+    first, second = read_exactly(2)
+    opcode = first & 0x0F
+    length = second & 0x7F
+    if length == 126:
+        length = struct.unpack('!H', read_exactly(2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', read_exactly(8))[0]
+    if require_mask and not second & 0x80:
+        raise FrameError(PROTOCOL_ERROR, "Client frame is not masked")
+    if max_length is not None and length > max_length:
+        raise FrameError(MESSAGE_TOO_BIG, f"Frame of {length} bytes exceeds {max_length}")
+    mask = read_exactly(4) if second & 0x80 else None
+    payload = read_exactly(length)
+    if mask:
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    return opcode, payload
+
+
+class DeltaEncoder:
+    """Changed fields since the last frame sent to one client
+
+    The first frame (and any after reset()) is a keyframe carrying every
+    field. Deltas are taken against what was last sent, not the previous
+    snapshot, so coalesced snapshots in between never lose a change.
+    """
+
+    def __init__(self, fields=STREAM_FIELDS):
+        self.fields = fields
+        self.index = {name: i for i, name in enumerate(fields)}
+        self.reset()
+
+    def reset(self):
+        self.sent = None
+
+    def delta(self, snapshot):
+        """(keyframe, {field: value}) to bring the client up to snapshot"""
+        keyframe = self.sent is None
+        values = {name: getattr(snapshot, name) for name in self.fields}
+        if keyframe:
+            changes = values
+        else:
+            changes = {name: value for name, value in values.items()
+                       if self.sent[name] != value}
+        self.sent = values
+        return keyframe, changes
+
+    def to_json(self, snapshot, keyframe, changes):
+        return json.dumps({'v': snapshot.version, 't': snapshot.timestamp_ns,
+                           'key': keyframe, 's': changes})
+
+    def to_binary(self, snapshot, keyframe, changes):
+        parts = [BINARY_HEADER.pack(KEYFRAME if keyframe else 0, snapshot.version,
+                                    snapshot.timestamp_ns, len(changes))]
+        for name, value in changes.items():
+            if value is None:
+                parts.append(bytes((self.index[name], NONE)))
+            elif isinstance(value, bool):
+                parts.append(bytes((self.index[name], TRUE if value else FALSE)))
+            elif isinstance(value, str):
+                text = value.encode()[:255]
+                parts.append(bytes((self.index[name], STRING, len(text))) + text)
+            else:
+                parts.append(bytes((self.index[name], FLOAT)) + FLOAT_VALUE.pack(value))
+        return b''.join(parts)
+
+    def from_binary(self, data):
+        """Decode a binary frame: (version, timestamp_ns, keyframe, changes)"""
+        flags, version, timestamp_ns, count = BINARY_HEADER.unpack_from(data)
+        offset = BINARY_HEADER.size
+        changes = {}
+        for _ in range(count):
+            index, kind = data[offset], data[offset + 1]
+            offset += 2
+            if kind == FLOAT:
+                value = FLOAT_VALUE.unpack_from(data, offset)[0]
+                offset += FLOAT_VALUE.size
+            elif kind == STRING:
+                length = data[offset]
+                value = data[offset + 1:offset + 1 + length].decode()
+                offset += 1 + length
+            else:
+                value = {NONE: None, FALSE: False, TRUE: True}[kind]
+            changes[self.fields[index]] = value
+        return version, timestamp_ns, bool(flags & KEYFRAME), changes
+
+
+class StreamClient:
+    """One subscriber's rate-capped, coalescing feed of delta frames
+
+    Snapshots land in a single-slot StateChannel, so however slow the
+    client is only the newest state is held and intermediate ones are
+    dropped. Frames go out at most max_rate times a second.
+    """
+
+    def __init__(self, publisher, max_rate=10.0, binary=False, clock=time.monotonic):
+        self.min_interval = 1.0 / max_rate if max_rate else 0.0
+        self.binary = binary
+        self.clock = clock
+        self.encoder = DeltaEncoder()
+        self.closed = threading.Event()
+        self._close_lock = threading.Lock()
+        self._wake = threading.Event()
+        self.channel = StateChannel(publisher, self._wake.set)
+        self.last_sent = None
+        self.frames_sent = 0
+        self._wake.set()  # the keyframe goes out straight away
+
+    @property
+    def dropped(self):
+        """Snapshots superseded before this client could be sent them"""
+        return self.channel.coalesced
+
+    def next_frame(self, timeout=None):
+        """Next encoded frame, or None on timeout, close or no field change"""
+        if not self._wake.wait(timeout) or self.closed.is_set():
+            return None
+        if self.last_sent is not None:
+            delay = self.last_sent + self.min_interval - self.clock()
+            if delay > 0 and self.closed.wait(delay):
+                return None
+        self._wake.clear()
+        snapshot = self.channel.take()
+        keyframe, changes = self.encoder.delta(snapshot)
+        if not changes:
+            return None
+        self.last_sent = self.clock()
+        self.frames_sent += 1
+        if self.binary:
+            return self.encoder.to_binary(snapshot, keyframe, changes)
+        return self.encoder.to_json(snapshot, keyframe, changes)
+
+    def close(self):
+        """Safe to call from both the reader and the sender"""
+        with self._close_lock:
+            if self.closed.is_set():
+                return
+            self.closed.set()
+        self._wake.set()
+        self.channel.close()
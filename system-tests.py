@@ -1,6 +1,17 @@
-import unittest
-from unittest.mock import Mock, patch
+import asyncio
+import glob
+import gzip
+import http.client
+import io
+import json
+import os
+import random
+import socket
+import tempfile
+import threading
 import time
+import unittest
+from unittest.mock import Mock
 import logging
 from coffee_machine_control import (
     CoffeeMachineController, 
@@ -11,16 +22,39 @@ from coffee_machine_control import (
     MotorController,
     HeaterController
 )
+from async_core import AsyncControlCore
+from async_log import AsyncLogPipeline, BackgroundWriter, RepeatLimiter
+from daemon import ControlServer, TOKEN_HEADER
+from dosing import FeedRateEstimator, DONE
+from fleet import FleetSupervisor
+from forecast import DepletionForecast
+from hx711 import HX711, FakeHX711GPIO, decode_24bit
+from latency import LatencyHistogram
+from level_filter import LevelKalman
+from motion import SCurveProfile, TrapezoidProfile
+from preheat import KeepWarmSchedule
+from recipe import compile_recipe
+from replay import load_trace, fit_trace, benchmark, regressions, score
+from scheduler import ControlScheduler
+from state import MachineState, StatePublisher, StateChannel
+from stream import DeltaEncoder, StreamClient, FrameError, STREAM_FIELDS, BINARY, CLOSE, PING, \
+    MAX_CLIENT_PAYLOAD, encode_ws_frame, read_ws_frame
+from telemetry import TelemetryRecorder, read_capture
+from simulator import SimulatedBackend, MachineModel, encode_max31855
+from temperature_control import PIDController
+from thermal_model import ThermalModel, fit_thermal_model
+from throughput import FlowModel, RunMetrics
+from thermocouple import TemperatureAcquisition, decode_max31855, FAULT_OPEN
+from ultrasonic import EchoTimer, FakeEchoGPIO
 
 class TestCoffeeMachine(unittest.TestCase):
     def setUp(self):
         """Setup test environment with mocked hardware"""
-        # Mock GPIO and SPI
-        self.gpio_mock = patch('RPi.GPIO').start()
-        self.spi_mock = patch('spidev.SpiDev').start()
+        # Simulated GPIO and SPI
+        self.io = SimulatedBackend()
         
         # Create controller instance
-        self.controller = CoffeeMachineController()
+        self.controller = CoffeeMachineController(self.io)
         
         # Mock sensor readings
         self.controller.temp_in.read_temp = Mock(return_value=25.0)
@@ -30,7 +64,6 @@ class TestCoffeeMachine(unittest.TestCase):
 
     def tearDown(self):
         """Cleanup after tests"""
-        patch.stopall()
         self.controller.stop_process()
 
     def test_1_initial_conditions(self):
@@ -54,7 +87,7 @@ class TestCoffeeMachine(unittest.TestCase):
         print("Testing cold temperature response...")
         self.controller.temp_out.read_temp = Mock(return_value=40.0)  # Below minimum
         self.controller.start_process({'target_temp': 52.5})
-        time.sleep(2)  # Allow control loop to respond
+        self.controller.scheduler.run_for(1)  # Allow control loop to respond
         
         self.assertTrue(self.controller.system_state['is_circulating'])
         self.assertTrue(self.controller.system_state['heater_power'] > self.controller.INITIAL_HEATER_POWER)
@@ -63,7 +96,7 @@ class TestCoffeeMachine(unittest.TestCase):
         # Test hot temperature response
         print("Testing hot temperature response...")
         self.controller.temp_out.read_temp = Mock(return_value=65.0)  # Above maximum
-        time.sleep(2)  # Allow control loop to respond
+        self.controller.scheduler.run_for(3)  # Allow control loop to respond
         
         self.assertTrue(self.controller.system_state['is_circulating'])
         self.assertTrue(self.controller.system_state['heater_power'] < self.controller.INITIAL_HEATER_POWER)
@@ -72,7 +105,7 @@ class TestCoffeeMachine(unittest.TestCase):
         # Test normal temperature
         print("Testing normal temperature response...")
         self.controller.temp_out.read_temp = Mock(return_value=52.5)  # Within range
-        time.sleep(2)  # Allow control loop to respond
+        self.controller.scheduler.run_for(2)  # Allow control loop to respond
         
         self.assertFalse(self.controller.system_state['is_circulating'])
         print("✓ Normal temperature response correct")
@@ -85,7 +118,7 @@ class TestCoffeeMachine(unittest.TestCase):
         print("Testing normal water level...")
         self.controller.water_sensor.get_water_percentage = Mock(return_value=50.0)
         self.controller.start_process({'target_temp': 52.5})
-        time.sleep(1)
+        self.controller.scheduler.run_for(1)
         
         self.assertFalse(self.controller.alerts['low_water'])
         print("✓ Normal water level correct")
@@ -93,7 +126,7 @@ class TestCoffeeMachine(unittest.TestCase):
         # Test low water warning
         print("Testing low water warning...")
         self.controller.water_sensor.get_water_percentage = Mock(return_value=9.0)
-        time.sleep(6)  # Allow monitoring loop to update
+        self.controller.scheduler.run_for(6)  # Allow monitoring loop to update
         
         self.assertTrue(self.controller.alerts['low_water'])
         print("✓ Low water warning correct")
@@ -101,7 +134,7 @@ class TestCoffeeMachine(unittest.TestCase):
         # Test critical water level
         print("Testing critical water level...")
         self.controller.water_sensor.get_water_percentage = Mock(return_value=4.0)
-        time.sleep(6)  # Allow monitoring loop to update
+        self.controller.scheduler.run_for(6)  # Allow monitoring loop to update
         
         self.assertFalse(self.controller.running)  # Should stop process
         print("✓ Critical water level response correct")
@@ -114,7 +147,7 @@ class TestCoffeeMachine(unittest.TestCase):
         print("Testing normal powder level...")
         self.controller.powder_sensor.get_powder_percentage = Mock(return_value=50.0)
         self.controller.start_process({'target_temp': 52.5})
-        time.sleep(1)
+        self.controller.scheduler.run_for(1)
         
         self.assertFalse(self.controller.alerts['low_powder'])
         print("✓ Normal powder level correct")
@@ -122,7 +155,7 @@ class TestCoffeeMachine(unittest.TestCase):
         # Test low powder warning
         print("Testing low powder warning...")
         self.controller.powder_sensor.get_powder_percentage = Mock(return_value=19.0)
-        time.sleep(6)  # Allow monitoring loop to update
+        self.controller.scheduler.run_for(6)  # Allow monitoring loop to update
         
         self.assertTrue(self.controller.alerts['low_powder'])
         print("✓ Low powder warning correct")
@@ -130,7 +163,7 @@ class TestCoffeeMachine(unittest.TestCase):
         # Test critical powder level
         print("Testing critical powder level...")
         self.controller.powder_sensor.get_powder_percentage = Mock(return_value=9.0)
-        time.sleep(6)  # Allow monitoring loop to update
+        self.controller.scheduler.run_for(6)  # Allow monitoring loop to update
         
         self.assertFalse(self.controller.running)  # Should stop process
         print("✓ Critical powder level response correct")
@@ -162,7 +195,7 @@ class TestCoffeeMachine(unittest.TestCase):
         print("Testing circulation on low temperature...")
         self.controller.temp_out.read_temp = Mock(return_value=40.0)
         self.controller.start_process({'target_temp': 52.5})
-        time.sleep(2)
+        self.controller.scheduler.run_for(2)
         
         self.assertTrue(self.controller.system_state['is_circulating'])
         print("✓ Circulation activation on low temperature correct")
@@ -170,11 +203,1581 @@ class TestCoffeeMachine(unittest.TestCase):
         # Test circulation deactivation on normal temperature
         print("Testing circulation on normal temperature...")
         self.controller.temp_out.read_temp = Mock(return_value=52.5)
-        time.sleep(2)
+        self.controller.scheduler.run_for(2)
         
         self.assertFalse(self.controller.system_state['is_circulating'])
         print("✓ Circulation deactivation on normal temperature correct")
 
+class TestWaterLevelEcho(unittest.TestCase):
+    def test_edge_timed_distance(self):
+        """Test echo timing from injected edges"""
+        print("\nTesting edge-timed echo measurement...")
+        
+        # 1749 us round trip is ~30 cm
+        gpio = FakeEchoGPIO(echoes=[(100000, 1749271)] * 4)  # one ping, then a burst of 3
+        sensor = WaterLevelSensor(16, 17, gpio)
+        
+        self.assertAlmostEqual(sensor.measure_distance(), 30.0, places=2)
+        self.assertAlmostEqual(sensor.get_water_percentage(), 0.0, places=1)
+        print("✓ Echo distance correct")
+
+    def test_no_echo_timeout(self):
+        """Test missing echo returns NoEcho instead of hanging"""
+        print("\nTesting missing echo...")
+        
+        gpio = FakeEchoGPIO(echoes=[None, (1000, None)])
+        timer = EchoTimer(gpio, 16, 17, timeout=0.01, clock=gpio.clock_ns)
+        
+        result = timer.measure()
+        self.assertFalse(result)
+        self.assertEqual(result.reason, 'no_rising_edge')
+        self.assertEqual(timer.measure().reason, 'no_falling_edge')
+        print("✓ Missing echo reported")
+
+    def test_retries_then_fails(self):
+        """Test sensor gives up after repeated missing echoes"""
+        gpio = FakeEchoGPIO(echoes=[None, None, None])
+        sensor = WaterLevelSensor(16, 17, gpio)
+        sensor.echo_timer.timeout = 0.01
+        
+        with self.assertRaises(Exception):
+            sensor.measure_distance()
+        self.assertEqual(gpio.trigger_count, 3)
+
+class TestWaterLevelFilter(unittest.TestCase):
+    def test_kalman_gates_spikes(self):
+        """Test outliers are gated and a drain is followed without lag"""
+        print("\nTesting level Kalman filter...")
+        
+        level = LevelKalman()
+        height = 20.0
+        for i in range(100):
+            level.predict(0.2, 0.05)
+            height -= 0.05 * 0.2
+            level.update(0.0 if i % 10 == 5 else height)
+        
+        self.assertAlmostEqual(level.height, height, delta=0.05)
+        self.assertEqual(level.rejected, 10)
+        
+        for _ in range(level.max_rejects):
+            level.update(28.0)  # tank refilled
+        self.assertEqual(level.height, 28.0)
+        print("✓ Spikes gated, drain tracked")
+
+    def test_no_false_stop_on_bad_echoes(self):
+        """Test multipath echoes neither raise low_water nor stop the run"""
+        print("\nTesting water level under bad echoes...")
+        
+        io = SimulatedBackend()
+        io.model.outlet_temp = 52.5
+        io.model.water_height = 4.5  # 15%, above the alarm level
+        io.model.echo_spike_rate = 0.3
+        controller = CoffeeMachineController(io)
+        controller.start_process({'target_temp': 52.5})
+        controller.scheduler.run_for(30)
+        
+        truth = io.model.water_height / io.model.tank_height * 100
+        self.assertTrue(controller.running)
+        self.assertFalse(controller.alerts['low_water'])
+        self.assertAlmostEqual(controller.system_state['water_level'], truth, delta=1.0)
+        print("✓ No false stop")
+
+    def test_speed_of_sound_compensation(self):
+        """Test the distance is corrected for a warm tank"""
+        print("\nTesting speed of sound compensation...")
+        
+        io = SimulatedBackend()
+        io.model.inlet_temp = 60.0
+        sensor = WaterLevelSensor(16, 17, io)
+        uncorrected = sensor.measure_distance()
+        sensor.set_air_temperature(60.0)
+        
+        self.assertGreater(abs(uncorrected - 3.0), 0.15)
+        self.assertAlmostEqual(sensor.measure_distance(), 3.0, places=2)
+        print("✓ Distance compensated")
+
+class TestSimulatedBackend(unittest.TestCase):
+    def setUp(self):
+        self.io = SimulatedBackend(MachineModel())
+        self.heater = HeaterController(12, self.io)
+        self.pump = MotorController(18, 23, 24, self.io)
+        self.temp_out = TemperatureSensor(TemperatureAcquisition(self.io), 1)
+        self.water_sensor = WaterLevelSensor(16, 17, self.io)
+
+    def test_heater_warms_boiler(self):
+        """Test heater power raises the outlet temperature"""
+        print("\nTesting simulated boiler heating...")
+        
+        start = self.temp_out.read_temp()
+        self.heater.set_power(100)
+        self.io.sleep(60)
+        self.temp_out.acquisition.sample()
+        
+        self.assertGreater(self.temp_out.read_temp(), start + 20)
+        self.assertEqual(self.io.clock_ns(), 60 * 10**9)
+        print("✓ Boiler heats on virtual clock")
+
+    def test_pump_drains_tank(self):
+        """Test pumping lowers the measured water level"""
+        print("\nTesting simulated tank drain...")
+        
+        start = self.water_sensor.get_water_percentage()
+        self.pump.set_speed(100)
+        self.io.sleep(300)
+        
+        self.assertLess(self.water_sensor.get_water_percentage(), start - 5)
+        self.assertAlmostEqual(self.io.model.dispensed_ml, 6000, delta=1)
+        print("✓ Tank level follows pump flow")
+
+class TestTemperatureAcquisition(unittest.TestCase):
+    def test_decode_full_frame(self):
+        """Test sign bits, cold junction and fault flags are decoded"""
+        print("\nTesting MAX31855 frame decoding...")
+        
+        temp, cold_junction, faults = decode_max31855(encode_max31855(-12.25, -3.5))
+        self.assertEqual((temp, cold_junction, faults), (-12.25, -3.5, 0))
+        
+        temp, cold_junction, faults = decode_max31855(encode_max31855(0, 25.0, FAULT_OPEN))
+        self.assertEqual(faults, FAULT_OPEN)
+        print("✓ Frame decoding correct")
+
+    def test_median_rejects_spike(self):
+        """Test a single noisy sample does not move the reading"""
+        print("\nTesting median filtering...")
+        
+        io = SimulatedBackend()
+        acquisition = TemperatureAcquisition(io, window=5)
+        io.model.outlet_temp = 50.0
+        for _ in range(4):
+            acquisition.sample()
+        io.model.outlet_temp = 95.0
+        acquisition.sample()
+        
+        self.assertEqual(acquisition.read_temp(1), 50.0)
+        self.assertEqual(acquisition.samples, 5)
+        print("✓ Spike rejected")
+
+    def test_fault_stops_controller(self):
+        """Test an open thermocouple triggers an emergency stop"""
+        print("\nTesting thermocouple fault handling...")
+        
+        io = SimulatedBackend()
+        controller = CoffeeMachineController(io)
+        controller.start_process({'target_temp': 52.5})
+        io.model.thermocouple_faults[1] = FAULT_OPEN
+        controller.scheduler.run_for(2)
+        
+        self.assertTrue(controller.emergency_stop)
+        print("✓ Fault stops the process")
+
+class TestLoadCell(unittest.TestCase):
+    def make_load_cell(self, readings, **kwargs):
+        readings = iter(readings)
+        io = FakeHX711GPIO(27, 5, lambda: next(readings))
+        return io, HX711(io, 27, 5, **kwargs)
+
+    def test_read_signed_conversion(self):
+        """Test 24-bit conversions are clocked out and sign-extended"""
+        print("\nTesting HX711 conversion readout...")
+        
+        self.assertEqual(decode_24bit(0xFFFFFF), -1)
+        io, load_cell = self.make_load_cell([-1234, 420000], gain=64)
+        
+        self.assertTrue(load_cell.is_ready())
+        self.assertEqual(load_cell.read_raw(), -1234)
+        self.assertTrue(load_cell.is_ready())
+        self.assertEqual(io.emulator.last_gain_pulses, 3)
+        self.assertEqual(load_cell.read_raw(), 420000)
+        print("✓ Conversions decoded")
+
+    def test_outlier_rejected(self):
+        """Test a knock on the hopper does not change the weight"""
+        print("\nTesting load cell outlier rejection...")
+        
+        _, load_cell = self.make_load_cell([42000 + i % 3 for i in range(15)] + [4000000])
+        for _ in range(16):
+            load_cell.sample()
+        
+        self.assertAlmostEqual(load_cell.weight_grams(), 100.0, delta=0.01)
+        print("✓ Outlier rejected")
+
+    def test_calibration_persisted(self):
+        """Test tare and span calibration survive a restart"""
+        print("\nTesting load cell calibration...")
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'load_cell.json')
+            _, load_cell = self.make_load_cell([1000] * 20 + [51000] * 20, calibration_path=path)
+            load_cell.tare()
+            load_cell.calibrate(100.0)
+            self.assertEqual(load_cell.scale, 500.0)
+            
+            _, restarted = self.make_load_cell([26000], calibration_path=path)
+            self.assertEqual((restarted.offset, restarted.scale), (1000.0, 500.0))
+            self.assertEqual(restarted.weight_grams(), 50.0)
+        print("✓ Calibration persisted")
+
+    def test_hopper_weight_drives_alert(self):
+        """Test the controller reads the simulated hopper through the HX711"""
+        print("\nTesting powder level from load cell...")
+        
+        io = SimulatedBackend()
+        controller = CoffeeMachineController(io)
+        controller.start_process({'target_temp': 52.5})
+        controller.scheduler.run_for(1)
+        self.assertFalse(controller.alerts['low_powder'])
+        
+        io.model.powder_g = 150.0
+        controller.scheduler.run_for(5)
+        
+        self.assertAlmostEqual(controller.system_state['powder_level'], 15.0, delta=0.5)
+        self.assertTrue(controller.alerts['low_powder'])
+        print("✓ Low powder detected from load cell")
+
+class TestPowderDosing(unittest.TestCase):
+    def run_dose(self, recipe, auger_g_s=2.0, seconds=60):
+        io = SimulatedBackend()
+        io.model.max_powder_feed_g_s = auger_g_s
+        io.model.outlet_temp = 52.5
+        controller = CoffeeMachineController(io)
+        controller.start_process(dict(target_temp=52.5, **recipe))
+        controller.scheduler.run_for(seconds)
+        return io, controller
+
+    def test_estimator_slope(self):
+        """Test the loss-in-weight rate is the slope of a noisy ramp"""
+        print("\nTesting feed rate estimation...")
+        
+        estimator = FeedRateEstimator(window=2.0)
+        self.assertIsNone(estimator.rate())
+        for i in range(40):
+            estimator.add(i * 0.1, 500.0 - 1.5 * i * 0.1 + (0.2 if i % 2 else -0.2))
+        
+        self.assertAlmostEqual(estimator.rate(), 1.5, delta=0.05)
+        print("✓ Feed rate estimated")
+
+    def test_tracks_rate_with_weak_auger(self):
+        """Test the measured feed rate reaches target despite a weaker motor"""
+        print("\nTesting feed rate tracking...")
+        
+        io, controller = self.run_dose({'powder_g_s': 1.0}, auger_g_s=1.5)
+        
+        self.assertAlmostEqual(controller.system_state['powder_feed_rate'], 1.0, delta=0.05)
+        self.assertAlmostEqual(io.model.dispensed_powder_g, 60.0, delta=3.0)
+        self.assertGreater(controller.powder_motor.speed, 60)
+        print("✓ Feed rate tracked")
+
+    def test_batch_total(self):
+        """Test a batch dose slows down near the end and stops on target"""
+        print("\nTesting batch dosing...")
+        
+        io, controller = self.run_dose({'powder_rate': 75.0, 'powder_grams': 20.0})
+        
+        self.assertEqual(controller.doser.phase, DONE)
+        self.assertEqual(controller.powder_motor.speed, 0)
+        self.assertAlmostEqual(io.model.dispensed_powder_g, 20.0, delta=0.5)
+        self.assertTrue(controller.running)
+        print("✓ Batch dosed to target")
+
+class TestMotorControl(unittest.TestCase):
+    def test_s_curve_limits(self):
+        """Test the S-curve respects acceleration and jerk limits"""
+        print("\nTesting S-curve ramp...")
+        
+        profile = SCurveProfile(max_accel=50.0, jerk=200.0)
+        speeds = [0.0]
+        for _ in range(100):
+            speeds.append(profile.step(speeds[-1], 100.0, 0.05))
+        accels = [(b - a) / 0.05 for a, b in zip(speeds, speeds[1:])]
+        
+        self.assertEqual(speeds[-1], 100.0)
+        self.assertTrue(all(b >= a for a, b in zip(speeds, speeds[1:])))
+        self.assertLessEqual(max(accels), 50.0 + 1e-9)
+        self.assertLessEqual(max(abs(b - a) for a, b in zip(accels, accels[1:])),
+                             200.0 * 0.05 + 1e-6)
+        print("✓ Ramp within limits")
+
+    def test_reversal_interlock(self):
+        """Test reversing ramps through a dead stop without shoot-through"""
+        print("\nTesting direction reversal...")
+        
+        io = SimulatedBackend()
+        pins = io.pins
+        motor = MotorController(pins['PUMP_PWM'], pins['PUMP_DIR1'], pins['PUMP_DIR2'], io,
+                                profile=TrapezoidProfile(accel=100.0), reversal_delay=0.2)
+        motor.set_speed(50)
+        speeds = []
+        for _ in range(20):
+            motor.update(0.05)
+        motor.set_speed(-50)
+        for _ in range(40):
+            motor.update(0.05)
+            speeds.append(motor.speed)
+        
+        self.assertEqual(motor.speed, -50)
+        self.assertEqual(io.levels[pins['PUMP_DIR2']], io.HIGH)
+        self.assertEqual(io.levels[pins['PUMP_DIR1']], io.LOW)
+        self.assertGreaterEqual(speeds.count(0), 4)
+        self.assertEqual(io.shoot_through, 0)
+        print("✓ Reversal interlocked")
+
+    def test_hardware_pwm_fallback(self):
+        """Test hardware PWM is used where available, software otherwise"""
+        print("\nTesting PWM backend selection...")
+        
+        io = SimulatedBackend()
+        io.setup = Mock(wraps=io.setup)
+        pump = MotorController(18, 23, 24, io, frequency=20000)
+        other = MotorController(20, 21, 6, io, frequency=20000)
+        
+        # Making the hardware PWM pin a GPIO output would take it off the PWM peripheral
+        configured = [call.args[0] for call in io.setup.call_args_list]
+        self.assertNotIn(18, configured)
+        self.assertIn(20, configured)
+        self.assertTrue(pump.hardware_timed)
+        self.assertEqual(pump.frequency, 20000)
+        self.assertFalse(other.hardware_timed)
+        self.assertEqual(other.frequency, MotorController.SOFTWARE_PWM_MAX_HZ)
+        print("✓ PWM backend selected")
+
+class TestThroughput(unittest.TestCase):
+    def test_flow_gain_learned(self):
+        """Test the flow gain converges on the measured level drop"""
+        print("\nTesting flow calibration...")
+        
+        model = FlowModel(20.0)
+        tank = 8000.0
+        model.calibrate(tank)
+        for _ in range(10):
+            for _ in range(50):
+                model.integrate(50, False, 0.1)
+            tank -= 0.8 * 50.0  # the pump really delivers 8 mL/s at 50%
+            model.calibrate(tank)
+        
+        self.assertAlmostEqual(model.gain, 0.8, places=3)
+        self.assertAlmostEqual(model.flow_ml_s(50), 8.0, places=2)
+        self.assertEqual(model.flow_ml_s(50, circulating=True), 0.0)
+        
+        model.calibrate(tank + 2000)  # refill must not look like negative flow
+        self.assertAlmostEqual(model.gain, 0.8, places=3)
+        print("✓ Flow gain learned")
+
+    def test_run_metrics(self):
+        """Test cups/hour and heater energy from the run counters"""
+        print("\nTesting run metrics...")
+        
+        metrics = RunMetrics(cup_ml=200.0, heater_watts=2000.0)
+        metrics.start(100.0)
+        for _ in range(600):
+            metrics.add(1.0, 10.0, 50.0)
+        metrics.stop(700.0)
+        summary = metrics.summary(900.0)
+        
+        self.assertEqual(summary['duration_s'], 600.0)
+        self.assertEqual(summary['cups'], 30.0)
+        self.assertEqual(summary['cups_per_hour'], 180.0)
+        self.assertAlmostEqual(summary['heater_kwh'], 2000 * 300 / 3.6e6)
+        print("✓ Run metrics correct")
+
+    def test_controller_measures_throughput(self):
+        """Test a simulated run reports the volume the tank really lost"""
+        print("\nTesting throughput measurement...")
+        
+        io = SimulatedBackend()
+        io.model.max_flow_ml_s = 15.0  # worn pump tube
+        io.model.outlet_temp = 52.5
+        controller = CoffeeMachineController(io)
+        controller.start_process({'target_temp': 52.5})
+        controller.scheduler.run_for(120)
+        controller.stop_process()
+        summary = controller.run_summary()
+        
+        self.assertAlmostEqual(controller.flow_model.gain, 0.75, delta=0.02)
+        self.assertAlmostEqual(summary['dispensed_ml'], io.model.dispensed_ml,
+                               delta=0.05 * io.model.dispensed_ml)
+        self.assertGreater(summary['cups_per_hour'], 0)
+        self.assertGreater(summary['heater_on_s'], 0)
+        print("✓ Throughput measured")
+
+class TestDepletionForecast(unittest.TestCase):
+    def run_batch(self, water_height, batch_ml, seconds):
+        io = SimulatedBackend()
+        io.model.outlet_temp = 52.5
+        io.model.water_height = water_height
+        controller = CoffeeMachineController(io)
+        controller.start_process({'target_temp': 52.5, 'batch_ml': batch_ml})
+        controller.scheduler.run_for(seconds)
+        return io, controller
+
+    def test_fit_time_to_stop(self):
+        """Test time to the stop level from a falling history"""
+        print("\nTesting depletion fit...")
+        
+        forecast = DepletionForecast(stop_level=5.0, window=300.0, min_span=30.0)
+        times = [float(t) for t in range(0, 61, 5)]
+        self.assertIsNone(forecast.update(times[:5], [50.0] * 5))
+        self.assertFalse(forecast.known)
+        
+        levels = [50.0 - 0.1 * t for t in times]
+        self.assertAlmostEqual(forecast.update(times, levels), 390.0)
+        self.assertAlmostEqual(forecast.rate, 0.1)
+        self.assertIsNone(forecast.update(times, [50.0] * len(times)))
+        self.assertTrue(forecast.known)
+        print("✓ Depletion fit correct")
+
+    def test_warns_before_forced_stop(self):
+        """Test a batch that will run dry is flagged before the stop"""
+        print("\nTesting pre-emptive refill alert...")
+        
+        io, controller = self.run_batch(water_height=4.5, batch_ml=2000, seconds=45)
+        state = controller.state.current
+        truth = (state.water_level - 5.0) / (io.model.flow_ml_s() / 90.0)
+        
+        self.assertTrue(controller.running)
+        self.assertFalse(state.low_water)
+        self.assertTrue(state.refill_soon)
+        self.assertIs(state.batch_will_finish, False)
+        self.assertAlmostEqual(state.water_time_to_empty, truth, delta=5.0)
+        print("✓ Refill flagged before the stop")
+
+    def test_batch_completes(self):
+        """Test a batch with enough water is forecast to finish and ends itself"""
+        print("\nTesting batch completion...")
+        
+        io, controller = self.run_batch(water_height=27.0, batch_ml=600, seconds=45)
+        self.assertIs(controller.state.current.batch_will_finish, True)
+        self.assertFalse(controller.alerts['refill_soon'])
+        
+        controller.scheduler.run_for(30)
+        self.assertFalse(controller.running)
+        self.assertAlmostEqual(controller.run_summary()['dispensed_ml'], 600, delta=5)
+        print("✓ Batch finished")
+
+class TestThermalModel(unittest.TestCase):
+    def excite(self, heater_lag=0.0, seconds=1800):
+        """Random heater and pump steps on the simulator, sampled once a second"""
+        model = MachineModel()
+        model.heater_lag = heater_lag
+        model.pump_forward = True
+        rng = random.Random(1)
+        temp_in, temp_out, power, flow = [], [], [], []
+        for k in range(seconds):
+            if k % 60 == 0:
+                model.heater_duty = rng.choice([0, 30, 60, 100])
+                model.pump_duty = rng.choice([0, 25, 50, 75])
+            temp_in.append(model.inlet_temp)
+            temp_out.append(model.outlet_temp)
+            power.append(model.heater_duty)
+            flow.append(model.flow_ml_s())
+            for _ in range(20):
+                model.step(0.05)
+        return temp_in, temp_out, power, flow
+
+    def test_fit_recovers_physics(self):
+        """Test identification from excitation data matches the boiler physics"""
+        print("\nTesting thermal model fit...")
+        
+        model, rms = fit_thermal_model(*self.excite())
+        sim = MachineModel()
+        physics = ThermalModel.from_physics(sim.heater_watts, sim.boiler_heat_capacity,
+                                            sim.boiler_loss)
+        
+        self.assertLess(rms, 0.01)
+        self.assertEqual(model.tau, 0.0)
+        self.assertAlmostEqual(model.a, physics.a, delta=0.1 * physics.a)
+        self.assertAlmostEqual(model.c, physics.c, delta=0.1 * physics.c)
+        self.assertAlmostEqual(model.ambient, sim.ambient_temp, delta=2.0)
+        print("✓ Fitted model matches physics")
+
+    def test_save_load(self):
+        """Test a fitted model survives a save/load round trip"""
+        print("\nTesting thermal model persistence...")
+        
+        model = ThermalModel(0.01, 0.001, 0.002, tau=20.0, ambient=21.0)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'thermal_model.json')
+            model.save(path)
+            self.assertEqual(ThermalModel.load(path).as_dict(), model.as_dict())
+        print("✓ Model round trip")
+
+    def test_mpc_anticipates_flow_step(self):
+        """Test MPC heats ahead of a scheduled flow increase on a lagging element"""
+        print("\nTesting MPC heater scheduling...")
+        
+        model, _ = fit_thermal_model(*self.excite(heater_lag=30.0))
+        self.assertGreater(model.tau, 0.0)
+        
+        worst = {}
+        for name, thermal_model in (('pid', None), ('mpc', model)):
+            io = SimulatedBackend()
+            io.model.outlet_temp = 52.5
+            io.model.water_height = 29
+            io.model.heater_lag = 30.0
+            controller = CoffeeMachineController(io, thermal_model=thermal_model)
+            controller.start_process({'target_temp': 52.5, 'flow_rate': 20})
+            controller.scheduler.run_for(180)
+            controller.schedule_flow(30, 60)
+            
+            worst[name] = 0.0
+            for _ in range(200):
+                controller.scheduler.run_for(1)
+                worst[name] = max(worst[name], abs(io.model.outlet_temp - 52.5))
+        
+        self.assertLess(worst['mpc'], 3.0)
+        self.assertLess(worst['mpc'], worst['pid'] / 2)
+        print(f"✓ MPC worst error {worst['mpc']:.1f}°C vs PID {worst['pid']:.1f}°C")
+
+class TestPreheat(unittest.TestCase):
+    def test_cold_start_preheats(self):
+        """Test a cold start heats on circulation before dispensing"""
+        print("\nTesting preheat from cold...")
+        
+        io = SimulatedBackend()
+        io.model.outlet_temp = 20.0
+        controller = CoffeeMachineController(io)
+        controller.start_process({'target_temp': 52.5, 'powder_rate': 50})
+        controller.scheduler.run_for(10)
+        
+        state = controller.state.current
+        self.assertTrue(state.preheating)
+        self.assertFalse(state.ready)
+        self.assertTrue(state.is_circulating)
+        self.assertEqual(state.heater_power, 100)
+        self.assertEqual(state.dispensed_ml, 0.0)
+        self.assertEqual(state.powder_dispensed, 0.0)
+        self.assertGreater(state.time_to_ready, 0)
+        
+        temps = []
+        for _ in range(60):
+            controller.scheduler.run_for(1)
+            temps.append(io.model.outlet_temp)
+        
+        state = controller.state.current
+        self.assertTrue(state.ready)
+        self.assertFalse(state.is_circulating)
+        self.assertGreater(state.dispensed_ml, 0.0)
+        self.assertGreater(state.powder_dispensed, 0.0)
+        self.assertLess(max(temps), 53.5)
+        self.assertLess(controller.run_summary()['time_to_ready_s'], 45)
+        print("✓ Preheated, then handed over")
+
+    def test_preheat_holds_until_start(self):
+        """Test a power-on preheat holds the target and a start skips warm-up"""
+        print("\nTesting power-on preheat...")
+        
+        io = SimulatedBackend()
+        io.model.outlet_temp = 20.0
+        controller = CoffeeMachineController(io)
+        controller.preheat(52.5)
+        controller.scheduler.run_for(120)
+        
+        self.assertFalse(controller.running)
+        self.assertTrue(controller.state.current.ready)
+        self.assertAlmostEqual(io.model.outlet_temp, 52.5, delta=1.0)
+        
+        controller.start_process({'target_temp': 52.5})
+        self.assertFalse(controller.state.current.preheating)
+        self.assertEqual(controller.run_summary()['time_to_ready_s'], 0.0)
+        print("✓ Held hot and ready")
+
+    def test_preheat_rejects_bad_target(self):
+        """Test an out-of-range or non-numeric preheat target leaves the target alone"""
+        print("\nTesting preheat target validation...")
+        
+        io = SimulatedBackend()
+        io.model.outlet_temp = 20.0
+        controller = CoffeeMachineController(io)
+        target = controller.target_temp
+        for bad in (95, 'hot', True):
+            with self.assertRaises(ValueError):
+                controller.preheat(bad)
+        self.assertEqual(controller.target_temp, target)
+        self.assertFalse(controller.preheater.active)
+        print("✓ Bad targets rejected")
+
+    def test_keep_warm_schedule(self):
+        """Test the idle keep-warm schedule, including a period over midnight"""
+        print("\nTesting keep-warm schedule...")
+        
+        schedule = KeepWarmSchedule([('06:30', '09:00', 50.0), ('22:00', '02:00', 40.0)])
+        self.assertEqual(schedule.target(7 * 3600), 50.0)
+        self.assertEqual(schedule.target(23 * 3600), 40.0)
+        self.assertEqual(schedule.target(3600), 40.0)
+        self.assertIsNone(schedule.target(12 * 3600))
+        
+        io = SimulatedBackend()
+        io.model.outlet_temp = 20.0
+        controller = CoffeeMachineController(io)
+        controller.set_keep_warm([('06:30', '09:00', 45.0)])
+        controller.time_of_day = Mock(return_value=7 * 3600)
+        controller.scheduler.run_for(300)
+        self.assertAlmostEqual(io.model.outlet_temp, 45.0, delta=1.0)
+        self.assertTrue(controller.state.current.is_circulating)
+        
+        controller.time_of_day = Mock(return_value=10 * 3600)
+        controller.scheduler.run_for(2)
+        self.assertEqual(controller.heater.power, 0)
+        self.assertFalse(controller.state.current.is_circulating)
+        print("✓ Keep-warm follows the schedule")
+
+class TestControlServer(unittest.TestCase):
+    def setUp(self):
+        io = SimulatedBackend()
+        io.model.outlet_temp = 52.5
+        self.controller = CoffeeMachineController(io)
+        self.server = ControlServer(self.controller, port=0)
+        self.server.start()
+        self.token = {TOKEN_HEADER: self.server.token}
+        self.conn = http.client.HTTPConnection(*self.server.address, timeout=5)
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.stop()
+
+    def call(self, method, path, body=None, headers=None):
+        self.conn.request(method, path, None if body is None else json.dumps(body),
+                          headers or {})
+        response = self.conn.getresponse()
+        return response.status, json.loads(response.read())
+
+    def test_commands_and_state(self):
+        """Test start/stop and state over the HTTP API"""
+        print("\nTesting controller API...")
+        
+        status, state = self.call('GET', '/state')
+        self.assertEqual(status, 200)
+        self.assertFalse(state['running'])
+        
+        status, state = self.call('POST', '/start', {'target_temp': 52.5, 'batch_ml': 500},
+                                  self.token)
+        self.assertEqual(status, 200)
+        self.assertTrue(state['running'])
+        self.assertEqual(self.controller.batch_ml, 500)
+        
+        status, error = self.call('POST', '/stop', {},
+                                  dict(self.token, Origin='http://example.com'))
+        self.assertEqual(status, 403)
+        self.assertTrue(self.controller.running)
+        
+        # A file:// or sandboxed page sends Origin: null but cannot know the token
+        status, error = self.call('POST', '/stop', {}, {'Origin': 'null'})
+        self.assertEqual(status, 401)
+        status, error = self.call('POST', '/stop', {}, {'Origin': 'null',
+                                                        TOKEN_HEADER: 'guess'})
+        self.assertEqual(status, 401)
+        self.assertTrue(self.controller.running)
+        
+        status, state = self.call('POST', '/stop', {}, dict(self.token, Origin='null'))
+        self.assertEqual(status, 200)
+        self.assertFalse(state['running'])
+        self.assertEqual(self.call('GET', '/nowhere')[0], 404)
+        print("✓ API commands applied")
+
+    def test_preheat_body_validated(self):
+        """Test /preheat refuses a bad target with 400 and leaves the controller alone"""
+        print("\nTesting preheat request validation...")
+        
+        target = self.controller.target_temp
+        for body in ({'target_temp': 95}, {'target_temp': 'hot'}, {'target_temp': True},
+                     {'temp': 50}):
+            status, error = self.call('POST', '/preheat', body, self.token)
+            self.assertEqual(status, 400, body)
+        self.assertEqual(self.controller.target_temp, target)
+        
+        status, state = self.call('POST', '/preheat', {'target_temp': 50}, self.token)
+        self.assertEqual(status, 200)
+        self.assertEqual(self.controller.target_temp, 50.0)
+        print("✓ Bad preheat requests rejected")
+
+    def test_pushes_state_changes(self):
+        """Test /events pushes a snapshot per state change"""
+        print("\nTesting state push...")
+        
+        self.conn.request('GET', '/events')
+        response = self.conn.getresponse()
+        self.assertEqual(response.getheader('Content-Type'), 'text/event-stream')
+        
+        def next_event():
+            line = response.fp.readline()
+            response.fp.readline()  # blank line ends the event
+            return json.loads(line[len(b'data: '):])
+        
+        first = next_event()
+        self.controller.start_process({'target_temp': 52.5})
+        pushed = next_event()
+        self.assertGreater(pushed['version'], first['version'])
+        self.assertTrue(pushed['running'])
+        print("✓ State pushed to subscriber")
+
+    def test_unix_socket(self):
+        """Test the API over a Unix socket"""
+        print("\nTesting Unix socket API...")
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'api.sock')
+            server = ControlServer(self.controller, unix_path=path)
+            server.start()
+            try:
+                client = socket.socket(socket.AF_UNIX)
+                client.connect(path)
+                client.sendall(b'GET /state HTTP/1.1\r\nHost: localhost\r\n\r\n')
+                response = http.client.HTTPResponse(client)
+                response.begin()
+                self.assertEqual(response.status, 200)
+                self.assertIn('running', json.loads(response.read()))
+                client.close()
+            finally:
+                server.stop()
+            self.assertFalse(os.path.exists(path))
+        print("✓ Unix socket served")
+
+class TestTelemetryStream(unittest.TestCase):
+    def test_delta_encoding(self):
+        """Test keyframe, changed-field deltas and the binary round trip"""
+        print("\nTesting delta encoding...")
+        
+        publisher = StatePublisher(MachineState(current_temp=20.0, heater_power=0,
+                                                running=False), lambda: 0)
+        encoder = DeltaEncoder()
+        keyframe, changes = encoder.delta(publisher.current)
+        self.assertTrue(keyframe)
+        self.assertEqual(set(changes), set(STREAM_FIELDS))
+        
+        publisher.publish(current_temp=20.0)
+        self.assertEqual(encoder.delta(publisher.current), (False, {}))
+        
+        snapshot = publisher.publish(current_temp=50.25, heater_power=80, running=True)
+        keyframe, changes = encoder.delta(snapshot)
+        self.assertEqual(changes, {'current_temp': 50.25, 'heater_power': 80, 'running': True})
+        
+        frame = encoder.to_binary(snapshot, keyframe, changes)
+        self.assertLess(len(frame), len(encoder.to_json(snapshot, keyframe, changes)))
+        self.assertEqual(encoder.from_binary(frame), (snapshot.version, 0, False, changes))
+        print("✓ Only changed fields sent")
+
+    def test_slow_client_coalesces(self):
+        """Test a client that falls behind gets the newest state, not a backlog"""
+        print("\nTesting stream backpressure...")
+        
+        publisher = StatePublisher(MachineState(current_temp=20.0), lambda: 0)
+        client = StreamClient(publisher, max_rate=20.0)
+        self.assertIsNotNone(client.next_frame(1.0))  # keyframe
+        
+        for i in range(100):
+            publisher.publish(current_temp=20.0 + i)
+        start = time.monotonic()
+        frame = json.loads(client.next_frame(1.0))
+        
+        self.assertEqual(frame['s'], {'current_temp': 119.0})
+        self.assertGreaterEqual(client.dropped, 99)
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)  # rate cap
+        self.assertIsNone(client.next_frame(0.05))
+        client.close()
+        print("✓ Intermediate frames dropped")
+
+    def test_websocket_stream(self):
+        """Test the daemon streams binary deltas over a WebSocket"""
+        print("\nTesting WebSocket telemetry...")
+        
+        io = SimulatedBackend()
+        io.model.outlet_temp = 52.5
+        controller = CoffeeMachineController(io)
+        server = ControlServer(controller, port=0)
+        server.start()
+        sock = socket.create_connection(server.address, timeout=5)
+        reader = sock.makefile('rb')
+        def upgrade(protocols):
+            sock.sendall(b'GET /stream?rate=50&format=binary HTTP/1.1\r\nHost: localhost\r\n'
+                         b'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+                         b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+                         b'Sec-WebSocket-Protocol: ' + protocols.encode() + b'\r\n'
+                         b'Sec-WebSocket-Version: 13\r\n\r\n')
+            response = b''
+            while not response.endswith(b'\r\n\r\n'):
+                response += reader.readline()
+            return response
+        
+        try:
+            response = upgrade('coffee-machine, wrong')
+            self.assertIn(b'401', response.split(b'\r\n')[0])
+            length = int(response.split(b'Content-Length: ')[1].split(b'\r\n')[0])
+            reader.read(length)
+            
+            response = upgrade(f'coffee-machine, {server.token}')
+            self.assertIn(b'101', response.split(b'\r\n')[0])
+            self.assertIn(b's3pPLMBiTxaQ9kYGzzhZRbK+xOo=', response)
+            self.assertIn(b'Sec-WebSocket-Protocol: coffee-machine\r\n', response)
+            
+            opcode, payload = read_ws_frame(reader.read)
+            self.assertEqual(json.loads(payload)['fields'], list(STREAM_FIELDS))
+            encoder = DeltaEncoder()
+            opcode, payload = read_ws_frame(reader.read)
+            self.assertEqual(opcode, BINARY)
+            self.assertTrue(encoder.from_binary(payload)[2])
+            
+            controller.start_process({'target_temp': 52.5})
+            _, _, keyframe, changes = encoder.from_binary(read_ws_frame(reader.read)[1])
+            self.assertFalse(keyframe)
+            self.assertIs(changes['running'], True)
+            self.assertNotIn('current_temp', changes)
+            
+            sock.sendall(encode_ws_frame(CLOSE, b'\x03\xe8', mask=b'abcd'))
+            while True:
+                opcode, _ = read_ws_frame(reader.read)
+                if opcode == CLOSE:
+                    break
+        finally:
+            reader.close()
+            sock.close()
+            server.stop()
+        print("✓ Binary deltas streamed")
+
+    def test_client_frames_checked(self):
+        """Test unmasked, oversized and truncated client frames are refused"""
+        print("\nTesting WebSocket frame limits...")
+        
+        frame = io.BytesIO(encode_ws_frame(PING, b'hi'))
+        with self.assertRaises(FrameError) as refused:
+            read_ws_frame(frame.read, MAX_CLIENT_PAYLOAD, require_mask=True)
+        self.assertEqual(refused.exception.code, 1002)
+        
+        # A 1 TiB length is refused from the header, before any payload is read
+        frame = io.BytesIO(bytes((0x82, 0xFF)) + (1 << 40).to_bytes(8, 'big') + b'abcd')
+        with self.assertRaises(FrameError) as refused:
+            read_ws_frame(frame.read, MAX_CLIENT_PAYLOAD, require_mask=True)
+        self.assertEqual(refused.exception.code, 1009)
+        self.assertEqual(frame.tell(), 10)
+        
+        with self.assertRaises(EOFError):
+            read_ws_frame(io.BytesIO(encode_ws_frame(PING, b'hello', mask=b'abcd')[:8]).read)
+        
+        server = ControlServer(CoffeeMachineController(SimulatedBackend()), port=0)
+        server.start()
+        sock = socket.create_connection(server.address, timeout=5)
+        reader = sock.makefile('rb')
+        try:
+            sock.sendall(b'GET /stream HTTP/1.1\r\nHost: localhost\r\n'
+                         b'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+                         b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+                         b'X-Coffee-Machine-Token: ' + server.token.encode() + b'\r\n'
+                         b'Sec-WebSocket-Version: 13\r\n\r\n')
+            while reader.readline() != b'\r\n':
+                pass
+            sock.sendall(encode_ws_frame(PING, b'x' * (MAX_CLIENT_PAYLOAD + 1), mask=b'abcd'))
+            while True:
+                opcode, payload = read_ws_frame(reader.read)
+                if opcode == CLOSE:
+                    break
+            self.assertEqual(int.from_bytes(payload, 'big'), 1009)
+        finally:
+            reader.close()
+            sock.close()
+            server.stop()
+        print("✓ Bad client frames refused")
+
+class TestRecipes(unittest.TestCase):
+    STAGED = {
+        'name': 'staged',
+        'target_temp': 52.5,
+        'flow_rate': 50,
+        'stages': [
+            {'stage': 'preheat', 'target_temp': 53.0},
+            {'stage': 'dose', 'duration': 20, 'flow_rate': 30, 'powder_g_s': 1.0},
+            {'stage': 'brew', 'duration': 30},
+            {'stage': 'hold', 'target_temp': 50.0, 'duration': 10}
+        ]
+    }
+
+    def compile(self, recipe):
+        return compile_recipe(recipe, 52.5, 50, 2.0, (45.0, 60.0))
+
+    def test_compiled_plan(self):
+        """Test stage timing, inherited setpoints and stage lookup"""
+        print("\nTesting recipe compilation...")
+        
+        plan = self.compile(self.STAGED)
+        self.assertEqual([stage.kind for stage in plan.stages], ['dose', 'brew', 'hold'])
+        self.assertEqual(plan.preheat_temp, 53.0)
+        self.assertEqual(plan.duration, 60.0)
+        self.assertEqual(plan.stage_at(0).kind, 'dose')
+        self.assertEqual(plan.stage_at(19.9).kind, 'dose')
+        
+        brew = plan.stage_at(20.0)
+        self.assertEqual((brew.kind, brew.target_temp, brew.flow_rate, brew.powder_g_s),
+                         ('brew', 52.5, 50.0, 0.0))
+        hold = plan.stage_at(55.0)
+        self.assertEqual((hold.flow_rate, hold.powder_g_s), (0.0, 0.0))
+        self.assertIsNone(plan.stage_at(60.0))
+        
+        single = self.compile({'target_temp': 50.0, 'powder_rate': 50})
+        self.assertEqual(single.stage_at(1e6).powder_g_s, 1.0)
+        
+        # A day-long hold costs no more memory than a second-long one
+        long_hold = self.compile({'stages': [{'stage': 'brew', 'duration': 10},
+                                             {'stage': 'hold', 'duration': 86400}]})
+        self.assertEqual(long_hold.stage_at(86000).kind, 'hold')
+        self.assertIsNone(long_hold.stage_at(86410))
+        self.assertEqual(len(long_hold._ends), 2)
+        with self.assertRaises(AttributeError):
+            plan.name = 'other'
+        print("✓ Plan compiled")
+
+    def test_validation(self):
+        """Test bad recipes are rejected with the offending key named"""
+        print("\nTesting recipe validation...")
+        
+        bad = [
+            ({'target_temp': 52.5, 'flow': 50}, 'flow'),
+            ({'target_temp': 70.0}, 'target_temp'),
+            ({'stages': [{'stage': 'brew'}, {'stage': 'hold'}]}, 'duration'),
+            ({'stages': [{'stage': 'brew', 'duration': 10}, {'stage': 'preheat'}]}, 'preheat'),
+            ({'stages': [{'stage': 'steep'}]}, 'stage'),
+            ({'powder_rate': 'lots'}, 'powder_rate'),
+            ({'stages': [{'stage': 'brew', 'duration': 1e12}]}, 'duration')
+        ]
+        for recipe, key in bad:
+            with self.assertRaises(ValueError) as raised:
+                self.compile(recipe)
+            self.assertIn(key, str(raised.exception))
+        print("✓ Bad recipes rejected")
+
+    def test_controller_runs_stages(self):
+        """Test the controller steps through a loaded plan and stops at its end"""
+        print("\nTesting staged recipe run...")
+        
+        io = SimulatedBackend()
+        io.model.outlet_temp = 53.0
+        controller = CoffeeMachineController(io)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'config.json')
+            with open(path, 'w') as f:
+                json.dump({'temperature': {'min': 45.0}, 'recipes': {'staged': self.STAGED}}, f)
+            controller.load_recipes(path)
+        
+        with self.assertRaises(ValueError):
+            controller.start_process({'target_temp': 52.5, 'stages': []})
+        self.assertFalse(controller.emergency_stop)
+        
+        controller.start_process('staged')
+        controller.scheduler.run_for(10)
+        state = controller.state.current
+        self.assertEqual((state.recipe, state.stage), ('staged', 'dose'))
+        self.assertEqual(controller.pump_motor.target, 30)
+        self.assertTrue(controller.doser.active)
+        
+        controller.scheduler.run_for(20)
+        self.assertEqual(controller.state.current.stage, 'brew')
+        self.assertEqual(controller.pump_motor.target, 50)
+        self.assertFalse(controller.doser.active)
+        self.assertEqual(controller.state.current.powder_feed_rate, 0.0)
+        
+        controller.scheduler.run_for(25)
+        self.assertEqual((controller.state.current.stage, controller.target_temp), ('hold', 50.0))
+        controller.scheduler.run_for(10)
+        self.assertFalse(controller.running)
+        self.assertEqual(controller.state.current.powder_feed_rate, 0.0)
+        print("✓ Stages run in order")
+
+class TestFleetSupervisor(unittest.TestCase):
+    def make_fleet(self, count, realtime=False):
+        supervisor = FleetSupervisor(workers=3)
+        for i in range(count):
+            io = SimulatedBackend(realtime=realtime)
+            io.model.outlet_temp = 52.5
+            controller = CoffeeMachineController(io, own_threads=False)
+            controller.start_process({'target_temp': 52.5})
+            supervisor.add(f"sim-{i}", controller)
+        return supervisor
+
+    def test_faulty_machine_isolated(self):
+        """Test a machine with failing tasks is quarantined and the rest run on"""
+        print("\nTesting fleet fault isolation...")
+        
+        supervisor = self.make_fleet(8)
+        broken = supervisor.machines['sim-3'].controller
+        broken.motor_ramp_step = Mock(side_effect=RuntimeError("driver fault"))
+        broken.scheduler.tasks = [task for task in broken.scheduler.tasks
+                                  if task.name != 'motor_ramp']
+        broken.scheduler.add_task('motor_ramp', broken.MOTOR_RAMP_PERIOD,
+                                  broken.motor_ramp_step)
+        
+        with self.assertLogs(level='CRITICAL') as logs:
+            supervisor.run_for(20)
+        self.assertTrue(any('[sim-3]' in line and 'quarantined' in line for line in logs.output))
+        
+        status = supervisor.status()
+        self.assertIsNotNone(status['sim-3']['fault'])
+        self.assertTrue(status['sim-3']['emergency_stop'])
+        for name, machine in status.items():
+            if name != 'sim-3':
+                self.assertIsNone(machine['fault'])
+                self.assertTrue(machine['running'])
+                self.assertAlmostEqual(supervisor.machines[name].controller.io.model.outlet_temp,
+                                       52.5, delta=1.0)
+        print("✓ Fault contained to one machine")
+
+    def test_shared_pool_real_time(self):
+        """Test real-time machines share the pool instead of owning threads"""
+        print("\nTesting fleet real-time dispatch...")
+        
+        threads_before = threading.active_count()
+        supervisor = self.make_fleet(5, realtime=True)
+        supervisor.start()
+        try:
+            time.sleep(1.5)
+            self.assertLessEqual(threading.active_count() - threads_before,
+                                 supervisor.workers + 1)
+        finally:
+            supervisor.stop()
+        
+        for machine in supervisor.machines.values():
+            stats = machine.controller.scheduler.stats()
+            self.assertGreaterEqual(stats['temperature_control']['runs'], 1)
+            self.assertGreaterEqual(stats['temperature_acquisition']['runs'], 10)
+            self.assertEqual(stats['temperature_control']['failures'], 0)
+        print("✓ Machines ticked on the shared pool")
+
+class TestAsyncControlCore(unittest.TestCase):
+    def test_tasks_keep_their_deadlines(self):
+        """Test the coroutine core runs every task on its period"""
+        print("\nTesting asyncio control core...")
+        
+        io = SimulatedBackend(realtime=True)
+        io.model.outlet_temp = 52.5
+        controller = CoffeeMachineController(io, own_threads=False)
+        controller.start_process({'target_temp': 52.5})
+        core = AsyncControlCore(controller)
+        
+        async def run():
+            asyncio.get_running_loop().call_later(1.5, core.stop)
+            await core.run()
+        asyncio.run(run())
+        
+        stats = controller.scheduler.stats()
+        self.assertGreaterEqual(stats['temperature_control']['runs'], 1)
+        self.assertGreaterEqual(stats['temperature_acquisition']['runs'], 10)
+        self.assertGreaterEqual(stats['motor_ramp']['runs'], 20)
+        self.assertEqual(controller.scheduler.failures(), 0)
+        self.assertEqual(core.timeouts, 0)
+        print("✓ Coroutines ticked on their deadlines")
+
+    def test_stop_interrupts_hung_echo(self):
+        """Test a hung echo wait is cut short instead of waiting out its timeout"""
+        print("\nTesting cancellation of a hung echo wait...")
+        
+        io = SimulatedBackend(realtime=True)
+        controller = CoffeeMachineController(io, own_threads=False)
+        timer = EchoTimer(FakeEchoGPIO(echoes=[None] * 10), 16, 17, timeout=5.0)
+        results = []
+        controller.scheduler.add_task('hung_echo', 0.2, lambda: results.append(timer.measure()))
+        core = AsyncControlCore(controller, blocking={'hung_echo': ('ultrasonic', None)})
+        core.interrupts['hung_echo'] = timer
+        
+        async def run():
+            asyncio.get_running_loop().call_later(0.5, core.stop)
+            await core.run()
+        started = time.monotonic()
+        with self.assertLogs(level='ERROR'):
+            asyncio.run(run())
+        
+        self.assertLess(time.monotonic() - started, 2.0)
+        self.assertGreaterEqual(core.timeouts, 1)
+        self.assertTrue(results and all(r.reason == 'cancelled' for r in results))
+        timer.timeout = 0.01  # resumed once the worker came back
+        self.assertEqual(timer.measure().reason, 'no_rising_edge')
+        print("✓ Echo wait cancelled at its deadline")
+
+    def test_only_reads_leave_the_loop(self):
+        """Test the water level burst is offloaded but its filter step is not"""
+        print("\nTesting sensor reads offloaded from the loop...")
+        
+        io = SimulatedBackend(realtime=True)
+        controller = CoffeeMachineController(io, own_threads=False)
+        sensor = controller.water_sensor
+        threads = {'burst': set(), 'sample': set()}
+        burst, sample = sensor.timed_burst, sensor.sample
+        
+        def timed_burst():
+            threads['burst'].add(threading.current_thread().name)
+            return burst()
+        
+        def sample_on(drain_ml_s=0.0, reading=None):
+            threads['sample'].add(threading.current_thread().name)
+            return sample(drain_ml_s, reading)
+        sensor.timed_burst, sensor.sample = timed_burst, sample_on
+        core = AsyncControlCore(controller)
+        
+        async def run():
+            asyncio.get_running_loop().call_later(1.0, core.stop)
+            await core.run()
+        asyncio.run(run())
+        
+        self.assertTrue(threads['burst'])
+        self.assertTrue(all(name.startswith('control-io') for name in threads['burst']))
+        self.assertEqual(threads['sample'], {threading.current_thread().name})
+        self.assertEqual(controller.scheduler.stats()['water_level']['failures'], 0)
+        print("✓ Filter and alert logic stayed on the loop")
+
+
+class TestTemperatureController(unittest.TestCase):
+    def test_anti_windup(self):
+        """Test the integral does not wind up while saturated"""
+        print("\nTesting PID anti-windup...")
+        
+        pid = PIDController(5.0, 0.5, 0.0)
+        for _ in range(200):
+            self.assertEqual(pid.update(52.5, 20.0, 1.0), 100.0)
+        self.assertLessEqual(pid.integral, 100.0)
+        
+        # Output must come off the rail as soon as the error changes sign
+        self.assertLess(pid.update(52.5, 60.0, 1.0), 100.0)
+        print("✓ Anti-windup correct")
+
+    def test_state_stays_clamped(self):
+        """Test heater power in system state stays within 0-100"""
+        print("\nTesting clamped heater state...")
+        
+        controller = CoffeeMachineController(SimulatedBackend())
+        controller.temp_out.read_temp = Mock(return_value=10.0)
+        controller.start_process({'target_temp': 52.5})
+        controller.scheduler.run_for(30)
+        self.assertEqual(controller.system_state['heater_power'], 100)
+        
+        controller.temp_out.read_temp = Mock(return_value=90.0)
+        controller.scheduler.run_for(30)
+        self.assertEqual(controller.system_state['heater_power'], 0)
+        print("✓ Heater state clamped")
+
+    def test_settles_without_hunting(self):
+        """Test the simulated boiler settles on target with one circulation cycle"""
+        print("\nTesting closed-loop settling...")
+        
+        io = SimulatedBackend()
+        io.model.outlet_temp = 20.0
+        controller = CoffeeMachineController(io)
+        controller.start_process({'target_temp': 52.5})
+        
+        toggles = 0
+        circulating = False
+        temps = []
+        for _ in range(600):
+            controller.scheduler.run_for(1)
+            temps.append(io.model.outlet_temp)
+            if controller.system_state['is_circulating'] != circulating:
+                circulating = not circulating
+                toggles += 1
+        
+        self.assertLessEqual(toggles, 2)
+        self.assertLess(max(temps), controller.TEMP_MAX)
+        self.assertAlmostEqual(temps[-1], 52.5, delta=0.5)
+        print("✓ Settles in band without hunting")
+
+class TestStateSnapshots(unittest.TestCase):
+    def test_snapshot_immutable(self):
+        """Test snapshots cannot be modified in place"""
+        print("\nTesting immutable state snapshots...")
+        
+        state = MachineState(current_temp=50.0)
+        with self.assertRaises(AttributeError):
+            state.current_temp = 60.0
+        with self.assertRaises(AttributeError):
+            state.extra = 1
+        print("✓ Snapshots immutable")
+
+    def test_publish_versions(self):
+        """Test publishing creates a new version and leaves old ones intact"""
+        print("\nTesting versioned publication...")
+        
+        publisher = StatePublisher(MachineState(current_temp=20.0, heater_power=0), lambda: 0)
+        before = publisher.current
+        after = publisher.publish(current_temp=50.0, heater_power=80)
+        
+        self.assertEqual(before.version + 1, after.version)
+        self.assertEqual((before.current_temp, before.heater_power), (20.0, 0))
+        self.assertIs(publisher.current, after)
+        print("✓ Versions published atomically")
+
+    def test_one_snapshot_per_tick(self):
+        """Test a control tick publishes temperature and power together"""
+        print("\nTesting per-tick publication...")
+        
+        controller = CoffeeMachineController(SimulatedBackend())
+        controller.temp_out.read_temp = Mock(return_value=40.0)
+        controller.start_process({'target_temp': 52.5})
+        controller.scheduler.run_for(0)  # level check shares the first deadline
+        version = controller.state.current.version
+        controller.scheduler.run_for(1)
+        
+        state = controller.state.current
+        self.assertEqual(state.version, version + 1)
+        self.assertEqual(state.current_temp, 40.0)
+        self.assertEqual(state.heater_power, controller.heater.power)
+        self.assertTrue(state.is_circulating)
+        self.assertTrue(state.temp_out_of_range)
+        self.assertTrue(state.running)
+        print("✓ One consistent snapshot per tick")
+
+class TestStateChannel(unittest.TestCase):
+    def test_coalesces_until_taken(self):
+        """Test many publishes produce one wakeup and the newest snapshot"""
+        print("\nTesting coalescing change channel...")
+        
+        publisher = StatePublisher(MachineState(current_temp=20.0), lambda: 0)
+        wakeups = []
+        channel = StateChannel(publisher, lambda: wakeups.append(1))
+        
+        for temp in (40.0, 45.0, 50.0):
+            publisher.publish(current_temp=temp)
+        self.assertEqual(len(wakeups), 1)
+        self.assertEqual(channel.coalesced, 2)
+        self.assertEqual(channel.take().current_temp, 50.0)
+        
+        publisher.publish(current_temp=51.0)
+        self.assertEqual(len(wakeups), 2)
+        print("✓ Updates coalesced")
+
+    def test_failing_subscriber_isolated(self):
+        """Test a broken subscriber does not break publishing"""
+        publisher = StatePublisher(MachineState(), lambda: 0)
+        publisher.subscribe(lambda snapshot: 1 / 0)
+        
+        self.assertEqual(publisher.publish(current_temp=50.0).version, 1)
+
+class TestTelemetryRecorder(unittest.TestCase):
+    def record(self, recorder, n):
+        for i in range(n):
+            recorder.record(i * 0.1, 20.0, 50.0 + i, 70.0, 50.0, 90.0, 80.0, i % 2)
+
+    def test_ring_buffer_wraps(self):
+        """Test the ring keeps the newest samples in order"""
+        print("\nTesting telemetry ring buffer...")
+        
+        recorder = TelemetryRecorder(capacity=5)
+        self.record(recorder, 8)
+        
+        self.assertEqual(len(recorder), 5)
+        self.assertEqual(list(recorder.channel('temp_out')), [53.0, 54.0, 55.0, 56.0, 57.0])
+        self.assertEqual(list(recorder.channel('valve')), [1, 0, 1, 0, 1])
+        print("✓ Ring buffer order correct")
+
+    def test_flush_round_trip(self):
+        """Test flushed records read back from the binary capture"""
+        print("\nTesting binary capture flush...")
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'capture.tlm')
+            recorder = TelemetryRecorder(capacity=4, path=path)
+            self.record(recorder, 3)
+            self.assertEqual(recorder.flush(), 3)
+            self.record(recorder, 6)  # 2 of these are overwritten unflushed
+            self.assertEqual(recorder.flush(), 4)
+            self.assertEqual(recorder.dropped, 2)
+            
+            capture = read_capture(path)
+            self.assertEqual(len(capture['time']), 7)
+            self.assertEqual(list(capture['temp_out'][:3]), [50.0, 51.0, 52.0])
+            self.assertEqual(capture['temp_out'][-1], 55.0)
+        print("✓ Capture round trip correct")
+
+    def test_controller_records_samples(self):
+        """Test the controller records telemetry at the sample rate"""
+        controller = CoffeeMachineController(SimulatedBackend())
+        controller.scheduler.run_for(10)
+        
+        self.assertEqual(len(controller.telemetry), 101)
+
+class TestAsyncLogging(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'test.log')
+        self.logger = logging.getLogger('async-log-test')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        self.logger.handlers.clear()
+        self.tmp.cleanup()
+
+    def attach(self, pipeline):
+        self.logger.addHandler(pipeline.handler)
+        return pipeline
+
+    def test_records_queued_unformatted(self):
+        """Test records are queued as template and args"""
+        print("\nTesting non-blocking log enqueue...")
+        
+        pipeline = self.attach(AsyncLogPipeline(self.path))
+        self.logger.info("Temp: %.1f°C", 52.25)
+        
+        record = pipeline.queue.get_nowait()
+        self.assertEqual(record.msg, "Temp: %.1f°C")
+        self.assertEqual(record.args, (52.25,))
+        self.assertFalse(hasattr(record, 'message'))
+        print("✓ Records enqueued without formatting")
+
+    def test_writer_and_repeat_limit(self):
+        """Test the writer thread writes batches and collapses repeats"""
+        print("\nTesting background writer...")
+        
+        pipeline = self.attach(AsyncLogPipeline(self.path, repeat_window=60.0))
+        pipeline.start()
+        self.logger.info("Water Level: %.1f%%", 50.0)
+        for _ in range(100):
+            self.logger.error("Sensor timeout")
+        pipeline.stop()
+        
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertIn("Water Level: 50.0%", lines[0])
+        self.assertIn("Sensor timeout (repeated 99 times)", lines[2])  # reported at stop
+        self.assertEqual(pipeline.suppressed, 99)
+        print("✓ Writer output correct")
+
+    def test_repeat_count_reported_when_window_closes(self):
+        """Test suppressed repeats are summarised even if the message never recurs"""
+        limiter = RepeatLimiter(window=10.0)
+        record = logging.LogRecord('test', logging.ERROR, __file__, 1, "Sensor timeout", (), None)
+        for created in (100.0, 101.0, 102.0):
+            repeat = logging.makeLogRecord(record.__dict__)
+            repeat.created = created
+            limiter.check(repeat)
+        
+        self.assertEqual(limiter.expired(105.0), [])
+        summaries = limiter.expired(110.0)
+        self.assertEqual([summary.getMessage() for summary in summaries],
+                         ["Sensor timeout (repeated 2 times)"])
+        self.assertEqual(limiter.expired(200.0, everything=True), [])
+
+    def test_rotation_compresses(self):
+        """Test rotated log files are gzipped"""
+        pipeline = self.attach(AsyncLogPipeline(self.path, max_bytes=2000, backup_count=2))
+        for i in range(200):
+            self.logger.info("Sample %d", i)
+        pipeline.stop()
+        
+        self.assertTrue(glob.glob(self.path + '.1.gz'))
+
+class TestBackgroundWriter(unittest.TestCase):
+    def test_stalled_write_never_blocks(self):
+        """Test a stalled write neither blocks the submitter nor piles up jobs"""
+        print("\nTesting background file writer...")
+        
+        writer = BackgroundWriter()
+        writer.start()
+        stalled, flushed = threading.Event(), []
+        writer.submit(stalled.wait)
+        
+        def flush():
+            flushed.append(threading.current_thread().name)
+        started = time.monotonic()
+        self.assertTrue(writer.submit(flush))
+        self.assertFalse(writer.submit(flush))  # still waiting behind the stalled write
+        self.assertLess(time.monotonic() - started, 0.1)
+        
+        stalled.set()
+        writer.stop()
+        self.assertEqual(flushed, ['file-writer'])
+        print("✓ Writes queued, deduplicated and run off the caller's thread")
+
+class TestControlScheduler(unittest.TestCase):
+    def setUp(self):
+        self.io = SimulatedBackend()
+        self.scheduler = ControlScheduler(self.io.clock_ns, self.io.sleep)
+
+    def test_periodic_rates(self):
+        """Test tasks run at their own rates on the virtual clock"""
+        print("\nTesting scheduler task rates...")
+        
+        fast, slow = [], []
+        self.scheduler.add_task('fast', 1.0, lambda: fast.append(self.io.clock_ns()))
+        self.scheduler.add_task('slow', 5.0, lambda: slow.append(self.io.clock_ns()))
+        self.scheduler.run_for(10)
+        
+        self.assertEqual(len(fast), 11)
+        self.assertEqual(slow, [0, 5 * 10**9, 10 * 10**9])
+        print("✓ Task rates correct")
+
+    def test_deadlines_do_not_drift(self):
+        """Test slow iterations do not push later deadlines back"""
+        print("\nTesting drift-free deadlines...")
+        
+        starts = []
+        def work():
+            starts.append(self.io.clock_ns())
+            self.io.advance(0.3)  # 300 ms of work inside a 1 s period
+        self.scheduler.add_task('work', 1.0, work)
+        self.scheduler.run_for(5)
+        
+        self.assertEqual(starts, [i * 10**9 for i in range(6)])
+        self.assertEqual(self.scheduler.tasks[0].overruns, 0)
+        print("✓ Deadlines stay on the period grid")
+
+    def test_overrun_accounting(self):
+        """Test overruns skip missed deadlines and are counted"""
+        print("\nTesting overrun accounting...")
+        
+        task = self.scheduler.add_task('late', 1.0, lambda: self.io.advance(2.5))
+        self.scheduler.run_for(5)
+        
+        self.assertEqual(task.runs, 2)
+        self.assertEqual(task.overruns, 2)
+        self.assertEqual(task.missed_periods, 4)
+        print("✓ Overruns counted")
+
+class TestReplay(unittest.TestCase):
+    def test_strategies_on_recorded_capture(self):
+        """Test a recorded run replays through both strategies and is scored"""
+        print("\nTesting replay benchmark...")
+        
+        path = os.path.join(tempfile.mkdtemp(), 'run.tlm')
+        controller = CoffeeMachineController(SimulatedBackend(), telemetry_path=path)
+        controller.start_process({'target_temp': 52.5})
+        controller.scheduler.run_for(300)
+        controller.schedule_flow(0, 80)
+        controller.scheduler.run_for(200)
+        controller.telemetry.flush()
+        
+        trace = load_trace(path)
+        self.assertEqual(len(trace['time']), 500)
+        with open(path, 'rb') as f_in, gzip.open(path + '.gz', 'wb') as f_out:
+            f_out.write(f_in.read())
+        self.assertEqual(load_trace(path + '.gz'), trace)
+        plant, _ = fit_trace(trace)
+        results = benchmark(trace, plant, 52.5)
+        
+        self.assertEqual(set(results), {'recorded', 'pid', 'mpc'})
+        for name in ('pid', 'mpc'):
+            self.assertGreater(results[name]['time_in_band'], 0.2)
+            self.assertGreater(results[name]['steps_per_s'], 100)
+        self.assertEqual(regressions(results, results), [])
+        slower = {'pid': dict(results['pid'], steps_per_s=results['pid']['steps_per_s'] * 2)}
+        self.assertEqual(len(regressions(results, slower)), 1)
+        calmer = {'mpc': dict(results['mpc'], power_travel=results['mpc']['power_travel'] / 2)}
+        found = regressions(results, calmer)
+        self.assertEqual(len(found), 1)
+        self.assertTrue(found[0].startswith('mpc.power_travel rose'))
+        self.assertEqual(len(regressions({'pid': {'settling_time_s': None}},
+                                         {'pid': {'settling_time_s': 40.0}})), 1)
+        # From a baseline of zero only a change past the absolute slack counts
+        self.assertEqual(regressions({'pid': {'overshoot_c': 0.05, 'valve_toggles': 1}},
+                                     {'pid': {'overshoot_c': 0.0, 'valve_toggles': 0}}), [])
+        self.assertEqual(len(regressions({'pid': {'overshoot_c': 0.5, 'valve_toggles': 2}},
+                                         {'pid': {'overshoot_c': 0.0, 'valve_toggles': 0}})), 2)
+        print("✓ Strategies replayed and scored")
+
+    def test_log_trace_and_scores(self):
+        """Test control-loop log lines load as a trace and score as expected"""
+        print("\nTesting log replay and scoring...")
+        
+        path = os.path.join(tempfile.mkdtemp(), 'coffee_machine.log')
+        with open(path, 'w', encoding='utf-8') as f:
+            for k, (temp, power, valve) in enumerate([(50.0, 80.0, False), (52.0, 60.0, False),
+                                                      (54.0, 30.0, True), (52.7, 40.0, True),
+                                                      (52.4, 40.0, False)]):
+                f.write(f"2026-10-17 12:00:0{k},000 - INFO - Temp: {temp:.1f}°C, "
+                        f"Power: {power:.1f}%, Flow: 50%, Circulating: {valve}\n")
+                f.write(f"2026-10-17 12:00:0{k},500 - INFO - Water Level: 80.0%, "
+                        f"Powder Level: 70.0%\n")
+        
+        trace = load_trace(path)
+        self.assertEqual(trace['time'], [0.0, 1.0, 2.0, 3.0, 4.0])
+        self.assertEqual(trace['valve'], [False, False, True, True, False])
+        
+        scores = score(trace['temp_out'], trace['heater_power'], trace['valve'], 52.5)
+        self.assertEqual(scores['time_in_band'], 0.6)
+        self.assertEqual(scores['settling_time_s'], 3.0)
+        self.assertAlmostEqual(scores['overshoot_c'], 1.5)
+        self.assertEqual(scores['valve_toggles'], 2)
+        self.assertEqual(scores['power_changes'], 3)
+        self.assertAlmostEqual(scores['power_travel'], 60.0)
+        print("✓ Log trace scored")
+
+    def test_jittered_trace_keeps_every_step(self):
+        """Test samples a little early or late still land on the fixed grid"""
+        print("\nTesting fixed-grid resampling...")
+        
+        path = os.path.join(tempfile.mkdtemp(), 'coffee_machine.log')
+        stamps = ['00,000', '00,999', '02,000', '02,998', '04,001', '05,002']
+        with open(path, 'w', encoding='utf-8') as f:
+            for k, stamp in enumerate(stamps):
+                f.write(f"2026-10-17 12:00:{stamp} - INFO - Temp: {50 + k:.1f}°C, "
+                        f"Power: 50.0%, Flow: 50%, Circulating: False\n")
+        
+        trace = load_trace(path)
+        self.assertEqual(trace['time'], [0.0, 1.0, 2.0, 3.0, 4.0, 5.0])
+        self.assertEqual(trace['temp_out'], [50.0, 51.0, 52.0, 53.0, 54.0, 55.0])
+        print("✓ No samples dropped")
+
+
+class TestLatencyMonitor(unittest.TestCase):
+    def test_histogram_precision(self):
+        """Test percentiles stay within the histogram's two significant digits"""
+        print("\nTesting latency histogram...")
+        
+        histogram = LatencyHistogram()
+        values = [random.randint(1, 5_000_000) for _ in range(5000)]
+        for value in values:
+            histogram.record_ns(value * 1000)
+        values.sort()
+        
+        for percent in (50.0, 99.0, 99.9):
+            exact = values[int(-(-len(values) * percent // 100)) - 1]
+            self.assertAlmostEqual(histogram.percentile(percent), exact, delta=exact / 100 + 1)
+        self.assertEqual(histogram.max_us, values[-1])
+        self.assertEqual(histogram.min_us, values[0])
+        print("✓ Percentiles within 1%")
+
+    def test_controller_export(self):
+        """Test every task and phase is timed and exported"""
+        print("\nTesting control-loop latency export...")
+        
+        path = os.path.join(tempfile.mkdtemp(), 'coffee_machine.prom')
+        io = SimulatedBackend()
+        io.model.outlet_temp = 52.5
+        controller = CoffeeMachineController(io, metrics_path=path)
+        controller.start_process({'target_temp': 52.5, 'powder_rate': 50})
+        controller.scheduler.run_for(20)
+        
+        tasks = controller.latency_report()['tasks']
+        control = tasks['temperature_control']
+        self.assertEqual(control['duration']['count'], control['runs'])
+        for phase in ('sensor_read', 'control', 'actuator_write'):
+            self.assertEqual(control[phase]['count'], control['runs'])
+        self.assertGreater(tasks['water_level']['sensor_read']['count'], 50)
+        self.assertIn('overruns', tasks['motor_ramp'])
+        
+        with open(path) as f:
+            text = f.read()
+        self.assertIn('# TYPE coffee_machine_latency_seconds histogram', text)
+        buckets = [int(line.rsplit(' ', 1)[1]) for line in text.splitlines()
+                   if line.startswith('coffee_machine_latency_seconds_bucket{task="water_level",'
+                                      'phase="duration"')]
+        self.assertEqual(buckets, sorted(buckets))
+        self.assertIn('coffee_machine_task_overruns_total{task="temperature_control"} 0', text)
+        print("✓ Latency histograms exported")
+
+    def test_export_leaves_the_control_thread(self):
+        """Test a real-time metrics export only queues the file write"""
+        print("\nTesting background metrics export...")
+        
+        path = os.path.join(tempfile.mkdtemp(), 'coffee_machine.json')
+        controller = CoffeeMachineController(SimulatedBackend(realtime=True), own_threads=False,
+                                             metrics_path=path)
+        writes, write = [], controller.latency.write
+        
+        def write_on(*args):
+            writes.append(threading.current_thread().name)
+            write(*args)
+        controller.latency.write = write_on
+        controller.export_metrics()
+        controller.writer.stop()
+        
+        self.assertEqual(writes, ['file-writer'])
+        with open(path) as f:
+            self.assertIn('temperature_control', json.load(f)['tasks'])
+        print("✓ Metrics written by the writer thread")
+
 def run_tests():
     """Run all system tests"""
     # Configure logging for tests
@@ -0,0 +1,150 @@
+import os
+import struct
+import threading
+from array import array
+
+MAGIC = b'CMTL'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sHH')  # magic, format version, record size
+
+# Channel name, array typecode, struct code
+CHANNELS = (
+    ('time', 'd', 'd'),          # seconds on the controller clock
+    ('temp_in', 'f', 'f'),
+    ('temp_out', 'f', 'f'),
+    ('heater_power', 'f', 'f'),
+    ('flow_rate', 'f', 'f'),
+    ('water_level', 'f', 'f'),
+    ('powder_level', 'f', 'f'),
+    ('valve', 'B', 'B')
+)
+CHANNEL_NAMES = tuple(name for name, _, _ in CHANNELS)
+RECORD = struct.Struct('<' + ''.join(code for _, _, code in CHANNELS))
+
+# Packed layout of one record, for numpy.fromfile(path, dtype=NUMPY_DTYPE, offset=HEADER.size)
+NUMPY_DTYPE = [(name, '<' + ('u1' if code == 'B' else 'f%d' % struct.calcsize(code)))
+               for name, _, code in CHANNELS]
+
+
+class TelemetryRecorder:
+    """Fixed-size in-memory history of every control sample
+
+    Each channel is a preallocated array.array, so numpy.frombuffer() can
+    wrap one without copying. flush() appends the records not yet written
+    to a packed binary capture file.
+    """
+
+    def __init__(self, capacity=30000, path=None):
+        self.capacity = capacity  # 30000 = 10 minutes at 50 Hz
+        self.path = path
+        self.buffers = {name: array(typecode, bytes(capacity * array(typecode).itemsize))
+                        for name, typecode, _ in CHANNELS}
+
+        self.index = 0       # next slot to write
+        self.total = 0       # records ever recorded
+        self.flushed = 0     # records already written to disk
+        self.dropped = 0     # records overwritten before they were flushed
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def record(self, time_s, temp_in, temp_out, heater_power, flow_rate,
+               water_level, powder_level, valve):
+        with self._lock:
+            i = self.index
+            buffers = self.buffers
+            buffers['time'][i] = time_s
+            buffers['temp_in'][i] = temp_in
+            buffers['temp_out'][i] = temp_out
+            buffers['heater_power'][i] = heater_power
+            buffers['flow_rate'][i] = flow_rate
+            buffers['water_level'][i] = water_level
+            buffers['powder_level'][i] = powder_level
+            buffers['valve'][i] = 1 if valve else 0
+            self.index = (i + 1) % self.capacity
+            self.total += 1
+
+    def _slots(self, first_record):
+        """Buffer indices from record number first_record up to the newest"""
+        return [n % self.capacity for n in range(first_record, self.total)]
+
+    def channel(self, name):
+        """One channel's history, oldest first, as a new array"""
+        with self._lock:
+            source = self.buffers[name]
+            return array(source.typecode, (source[i] for i in self._slots(self.total - len(self))))
+
+    def recent(self, name, count):
+        """The newest count samples of one channel, oldest first"""
+        with self._lock:
+            source = self.buffers[name]
+            first = self.total - min(count, len(self))
+            return array(source.typecode, (source[i] for i in self._slots(first)))
+
+    def history(self):
+        """All channels, oldest first"""
+        return {name: self.channel(name) for name in CHANNEL_NAMES}
+
+    def flush(self):
+        """Append unflushed records to the capture file; returns how many"""
+        if not self.path:
+            return 0
+
+        with self._lock:
+            oldest = self.total - len(self)
+            if self.flushed < oldest:
+                self.dropped += oldest - self.flushed
+                self.flushed = oldest
+            buffers = [self.buffers[name] for name in CHANNEL_NAMES]
+            payload = b''.join(RECORD.pack(*(buffer[i] for buffer in buffers))
+                               for i in self._slots(self.flushed))
+            count = self.total - self.flushed
+            self.flushed = self.total
+
+        if not count:
+            return 0
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, 'ab') as f:
+            if new_file:
+                f.write(HEADER.pack(MAGIC, FORMAT_VERSION, RECORD.size))
+            f.write(payload)
+        return count
+
+
+def read_capture(path, opener=open):
+    """Load a capture file into per-channel arrays; opener=gzip.open for a .gz"""
+    with opener(path, 'rb') as f:
+        data = f.read()
+
+    magic, version, record_size = HEADER.unpack_from(data)
+    if magic != MAGIC or record_size != RECORD.size:
+        raise Exception(f"Not a telemetry capture (version {version}): {path}")
+
+    columns = {name: array(typecode) for name, typecode, _ in CHANNELS}
+    body = memoryview(data)[HEADER.size:]
+    usable = len(body) - len(body) % RECORD.size
+    for values in RECORD.iter_unpack(body[:usable]):
+        for (name, _, _), value in zip(CHANNELS, values):
+            columns[name].append(value)
+    return columns
+
+
+def resample(columns, dt):
+    """Columns (as from read_capture) on the fixed grid start + k*dt
+
+    Each grid point takes the sample nearest to it, so jitter in the
+    recording neither drops nor shifts points. 'time' becomes seconds from
+    the first sample; times must be in order.
+    """
+    times = columns['time']
+    steps = int((times[-1] - times[0]) / dt + 1e-6)
+    picked, j = [], 0
+    for k in range(steps + 1):
+        target = times[0] + k * dt
+        while j + 1 < len(times) and abs(times[j + 1] - target) <= abs(times[j] - target):
+            j += 1
+        picked.append(j)
+    resampled = {name: [values[i] for i in picked] for name, values in columns.items()}
+    resampled['time'] = [k * dt for k in range(len(picked))]
+    return resampled
@@ -0,0 +1,156 @@
+from collections import namedtuple
+
+WATER_HEAT_CAPACITY = 4.186  # J/(g*K)
+
+# What a temperature controller asks the actuators to do this tick
+TemperatureCommand = namedtuple('TemperatureCommand', ['heater_power', 'flow_rate', 'circulate'])
+
+
+def clamp(value, low, high):
+    return max(low, min(high, value))
+
+
+class PIDController:
+    """PID with conditional-integration anti-windup and a filtered derivative
+
+    The derivative acts on the measurement (not the error) so setpoint
+    changes do not kick the output, and is low-pass filtered with time
+    constant derivative_tau seconds.
+    """
+
+    def __init__(self, kp, ki, kd, output_min=0.0, output_max=100.0, derivative_tau=2.0):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.output_min = output_min
+        self.output_max = output_max
+        self.derivative_tau = derivative_tau
+        self.reset()
+
+    def reset(self):
+        self.integral = 0.0
+        self.derivative = 0.0
+        self.last_measurement = None
+
+    def set_gains(self, kp, ki, kd):
+        self.kp, self.ki, self.kd = kp, ki, kd
+
+    def update(self, setpoint, measurement, dt, feed_forward=0.0):
+        error = setpoint - measurement
+
+        if self.last_measurement is not None and dt > 0:
+            raw = -(measurement - self.last_measurement) / dt
+            alpha = dt / (self.derivative_tau + dt)
+            self.derivative += alpha * (raw - self.derivative)
+        self.last_measurement = measurement
+
+        unsaturated = feed_forward + self.kp * error + self.integral + self.kd * self.derivative
+        output = clamp(unsaturated, self.output_min, self.output_max)
+
+        # Only integrate when it would not push further into saturation
+        winding_up = (unsaturated > self.output_max and error > 0) or \
+                     (unsaturated < self.output_min and error < 0)
+        if not winding_up:
+            self.integral += self.ki * error * dt
+            self.integral = clamp(self.integral, -self.output_max, self.output_max)
+
+        return output
+
+
+class GainSchedule:
+    """PID gains selected by flow rate (mL/s)
+
+    More flow means more heat carried away per degree, so the boiler needs
+    stronger action at high flow than when it is nearly still.
+    """
+
+    def __init__(self, bands):
+        # bands: [(max_flow_ml_s, (kp, ki, kd)), ...] in ascending flow order
+        self.bands = sorted(bands, key=lambda band: band[0])
+
+    def gains(self, flow_ml_s):
+        for max_flow, gains in self.bands:
+            if flow_ml_s <= max_flow:
+                return gains
+        return self.bands[-1][1]
+
+
+DEFAULT_GAIN_SCHEDULE = GainSchedule([
+    (4.0, (6.0, 0.10, 4.0)),
+    (12.0, (8.0, 0.15, 6.0)),
+    (float('inf'), (10.0, 0.25, 8.0))
+])
+
+
+class StepTemperatureController:
+    """Original ±5% per tick heater/flow stepping, kept for comparison"""
+
+    def __init__(self, temp_min, temp_max, initial_power, initial_flow):
+        self.temp_min = temp_min
+        self.temp_max = temp_max
+        self.initial_power = initial_power
+        self.initial_flow = initial_flow
+        self.reset()
+
+    def reset(self):
+        self.power = self.initial_power
+        self.flow = self.initial_flow
+
+    def update(self, target_temp, temp_in, temp_out, flow_ml_s, dt):
+        if temp_out < self.temp_min:
+            self.power = clamp(self.power + 5, 0, 100)
+            self.flow = clamp(self.flow - 5, 30, 100)
+            return TemperatureCommand(self.power, self.flow, True)
+        if temp_out > self.temp_max:
+            self.power = clamp(self.power - 5, 0, 100)
+            self.flow = clamp(self.flow + 5, 0, 100)
+            return TemperatureCommand(self.power, self.flow, True)
+        return TemperatureCommand(self.power, self.flow, False)
+
+
+class PIDTemperatureController:
+    """PID + feed-forward heater control with hysteretic circulation
+
+    Feed-forward supplies the power needed to lift the measured inflow from
+    temp_in to the target plus standing losses, so the PID only trims the
+    remainder. Circulation engages when temp_out leaves the band and only
+    releases once it is back inside by `hysteresis` degrees, which stops
+    the valve chattering at the band edges.
+    """
+
+    def __init__(self, temp_min, temp_max, flow_rate, heater_watts=2000.0,
+                 loss_w_per_k=2.0, hysteresis=2.0, schedule=DEFAULT_GAIN_SCHEDULE):
+        self.temp_min = temp_min
+        self.temp_max = temp_max
+        self.flow_rate = flow_rate  # pump speed %, left to the recipe
+        self.heater_watts = heater_watts
+        self.loss_w_per_k = loss_w_per_k
+        self.hysteresis = hysteresis
+        self.schedule = schedule
+        self.pid = PIDController(*schedule.gains(0.0))
+        self.circulating = False
+
+    def reset(self):
+        self.pid.reset()
+        self.circulating = False
+
+    def feed_forward(self, target_temp, temp_in, flow_ml_s):
+        """Heater % that holds target_temp at this inflow, ignoring dynamics"""
+        rise = max(0.0, target_temp - temp_in)
+        watts = flow_ml_s * WATER_HEAT_CAPACITY * rise + self.loss_w_per_k * rise
+        return clamp(watts / self.heater_watts * 100, 0, 100)
+
+    def update(self, target_temp, temp_in, temp_out, flow_ml_s, dt):
+        # Fresh water only enters the boiler while we dispense
+        through_flow = 0.0 if self.circulating else flow_ml_s
+        self.pid.set_gains(*self.schedule.gains(through_flow))
+        power = self.pid.update(target_temp, temp_out, dt,
+                                self.feed_forward(target_temp, temp_in, through_flow))
+        self.update_circulation(temp_out)
+        return TemperatureCommand(power, self.flow_rate, self.circulating)
+
+    def update_circulation(self, temp_out):
+        if temp_out < self.temp_min or temp_out > self.temp_max:
+            self.circulating = True
+        elif self.temp_min + self.hysteresis <= temp_out <= self.temp_max - self.hysteresis:
+            self.circulating = False
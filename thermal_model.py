@@ -0,0 +1,292 @@
+import json
+import os
+import sys
+
+from telemetry import read_capture, resample
+from temperature_control import PIDTemperatureController, TemperatureCommand, clamp, \
+    WATER_HEAT_CAPACITY
+
+# Heater element time constants (s) tried when fitting; 0 is first order
+ELEMENT_TAUS = (0.0, 2.0, 5.0, 10.0, 20.0, 40.0)
+
+
+class ThermalModel:
+    """Discrete boiler model identified from recorded runs
+
+    One step of dt seconds, with heater power u in %:
+        e' = e + (u - e) * dt / tau                  (element lag; tau = 0 skips it)
+        T' = T + a*e - b*(T - ambient) - c*flow*(T - temp_in)
+    a is °C per % per step, b the fraction of the excess over ambient lost
+    per step and c the fraction per mL/s of fresh water.
+    """
+
+    def __init__(self, a, b, c, tau=0.0, dt=1.0, ambient=20.0):
+        self.a = a
+        self.b = b
+        self.c = c
+        self.tau = tau
+        self.dt = dt
+        self.ambient = ambient
+
+    @classmethod
+    def from_physics(cls, heater_watts, heat_capacity, loss_w_per_k, dt=1.0, ambient=20.0):
+        """Model from nameplate values instead of a fit"""
+        return cls(heater_watts / 100 * dt / heat_capacity, loss_w_per_k * dt / heat_capacity,
+                   WATER_HEAT_CAPACITY * dt / heat_capacity, 0.0, dt, ambient)
+
+    def step(self, temp, element, power, flow_ml_s, temp_in):
+        """Advance one dt; returns (temp, element)"""
+        if self.tau > 0:
+            element += (power - element) * min(1.0, self.dt / self.tau)
+        else:
+            element = power
+        temp += (self.a * element - self.b * (temp - self.ambient)
+                 - self.c * flow_ml_s * (temp - temp_in))
+        return temp, element
+
+    def steady_power(self, target, flow_ml_s, temp_in):
+        """Heater % that holds target at this flow"""
+        return (self.b * (target - self.ambient) + self.c * flow_ml_s * (target - temp_in)) / self.a
+
+    def as_dict(self):
+        return {'a': self.a, 'b': self.b, 'c': self.c, 'tau': self.tau,
+                'dt': self.dt, 'ambient': self.ambient}
+
+    def save(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(**json.load(f))
+
+
+def solve(matrix, vector):
+    """Solve a small dense linear system by Gaussian elimination"""
+    n = len(vector)
+    rows = [list(matrix[i]) + [vector[i]] for i in range(n)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(rows[r][col]))
+        if abs(rows[pivot][col]) < 1e-15:
+            raise ValueError("Singular system")
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        for r in range(col + 1, n):
+            factor = rows[r][col] / rows[col][col]
+            for k in range(col, n + 1):
+                rows[r][k] -= factor * rows[col][k]
+    x = [0.0] * n
+    for r in range(n - 1, -1, -1):
+        x[r] = (rows[r][n] - sum(rows[r][k] * x[k] for k in range(r + 1, n))) / rows[r][r]
+    return x
+
+
+def least_squares(features, targets, ridge=1e-9):
+    n = len(features[0])
+    normal = [[sum(f[i] * f[j] for f in features) + (ridge if i == j else 0.0)
+               for j in range(n)] for i in range(n)]
+    rhs = [sum(f[i] * y for f, y in zip(features, targets)) for i in range(n)]
+    return solve(normal, rhs)
+
+
+def fit_thermal_model(temp_in, temp_out, power, flow_ml_s, dt=1.0, taus=ELEMENT_TAUS):
+    """Fit a ThermalModel to equally spaced samples
+
+    For each candidate element lag the one-step temperature change is
+    regressed on element power, boiler temperature, flow heat loss and a
+    constant (which gives the ambient). Returns (model, rms one-step error °C)
+    for the lag that fits best.
+    """
+    if len(temp_out) < 10:
+        raise ValueError("Need at least 10 samples to fit a thermal model")
+
+    best = None
+    for tau in taus:
+        element = power[0]
+        features, targets = [], []
+        for k in range(len(temp_out) - 1):
+            if tau > 0:
+                element += (power[k] - element) * min(1.0, dt / tau)
+            else:
+                element = power[k]
+            temp = temp_out[k]
+            features.append((element, -temp, -flow_ml_s[k] * (temp - temp_in[k]), 1.0))
+            targets.append(temp_out[k + 1] - temp)
+
+        try:
+            a, b, c, offset = least_squares(features, targets)
+        except ValueError:
+            continue
+        if a <= 0 or b <= 0:
+            continue
+        residual = sum((y - (a * f[0] + b * f[1] + c * f[2] + offset)) ** 2
+                       for f, y in zip(features, targets))
+        rms = (residual / len(targets)) ** 0.5
+        if best is None or rms < best[1] - 1e-9:
+            best = (ThermalModel(a, b, c, tau, dt, offset / b), rms)
+
+    if best is None:
+        raise ValueError("Recorded run does not excite the heater enough to fit a model")
+    return best
+
+
+def fit_capture(path, max_flow_ml_s=20.0, dt=1.0, taus=ELEMENT_TAUS):
+    """Fit a ThermalModel to a telemetry capture file
+
+    Flow is reconstructed from the recorded pump speed; while the valve
+    circulates no fresh water enters the boiler.
+    """
+    columns = read_capture(path)
+    if len(columns['time']) < 2:
+        raise ValueError(f"Capture too short: {path}")
+
+    # Resample onto the model's dt grid
+    columns = resample(columns, dt)
+    flows = [0.0 if valve else speed / 100 * max_flow_ml_s
+             for speed, valve in zip(columns['flow_rate'], columns['valve'])]
+    return fit_thermal_model(columns['temp_in'], columns['temp_out'], columns['heater_power'],
+                             flows, dt, taus)
+
+
+class MPCHeaterScheduler:
+    """Receding-horizon heater planning on a ThermalModel
+
+    Power is held constant over blocks of `block` steps so the plan has
+    only horizon/block unknowns. The plan minimises squared temperature
+    error over the horizon plus move_weight times squared power changes,
+    within 0-100%, by least squares with an active set for the limits.
+    Only the first move is applied each tick. A bias term learned from the
+    last prediction error absorbs model mismatch, so there is no steady
+    offset.
+    """
+
+    def __init__(self, model, horizon=30, block=5, move_weight=0.001, bias_gain=0.05):
+        self.model = model
+        self.horizon = horizon
+        self.block = block
+        self.move_weight = move_weight
+        self.bias_gain = bias_gain
+        self.reset()
+
+    def reset(self):
+        self.element = None
+        self.bias = 0.0
+        self.predicted = None
+        self.last_power = 0.0
+
+    def _simulate(self, temp, element, blocks, flows, temp_in):
+        temps = []
+        for k in range(self.horizon):
+            temp, element = self.model.step(temp, element, blocks[k // self.block],
+                                             flows[k], temp_in)
+            temp += self.bias
+            temps.append(temp)
+        return temps
+
+    def plan(self, target, temp, temp_in, flows):
+        """Power for each block of the horizon; flows are mL/s per step"""
+        if self.predicted is not None:
+            self.bias += self.bias_gain * (temp - self.predicted)
+        if self.element is None:
+            self.element = self.last_power
+
+        n = -(-self.horizon // self.block)
+        zero = [0.0] * n
+        free = self._simulate(temp, self.element, zero, flows, temp_in)
+        columns = []
+        for j in range(n):
+            unit = list(zero)
+            unit[j] = 1.0
+            response = self._simulate(temp, self.element, unit, flows, temp_in)
+            columns.append([r - f for r, f in zip(response, free)])
+
+        powers = self._solve(columns, [target - f for f in free], n)
+
+        # Remember what this first move should do, to learn the bias next tick
+        self.predicted, self.element = self.model.step(temp, self.element, powers[0],
+                                                       flows[0], temp_in)
+        self.predicted += self.bias
+        self.last_power = powers[0]
+        return powers
+
+    def _solve(self, columns, error, n):
+        # Normal equations of |G u - error|^2 + w |D u - d0|^2, where D takes
+        # differences between blocks and d0 carries the power applied now
+        w = self.move_weight
+        matrix = [[sum(g * h for g, h in zip(columns[i], columns[j])) for j in range(n)]
+                  for i in range(n)]
+        rhs = [sum(g * e for g, e in zip(columns[i], error)) for i in range(n)]
+        for j in range(n):
+            matrix[j][j] += w * (2.0 if j < n - 1 else 1.0)
+            if j:
+                matrix[j][j - 1] -= w
+                matrix[j - 1][j] -= w
+        rhs[0] += w * self.last_power
+
+        # Active set: pin blocks that leave 0-100% to the limit and re-solve
+        fixed = {}
+        while True:
+            free = [j for j in range(n) if j not in fixed]
+            if not free:
+                break
+            solution = solve([[matrix[i][j] for j in free] for i in free],
+                             [rhs[i] - sum(matrix[i][j] * v for j, v in fixed.items())
+                              for i in free])
+            violated = {j: clamp(u, 0.0, 100.0) for j, u in zip(free, solution)
+                        if u < 0.0 or u > 100.0}
+            if not violated:
+                fixed.update(zip(free, solution))
+                break
+            fixed.update(violated)
+        return [fixed[j] for j in range(n)]
+
+
+class MPCTemperatureController(PIDTemperatureController):
+    """Model-predictive heater power with the PID controller's circulation logic
+
+    flow_forecast(steps, dt) returns the fresh-water flow (mL/s) expected
+    for each of the next steps, so the heater can start on a flow increase
+    before temp_out falls. Without it the current flow is assumed to hold.
+    """
+
+    def __init__(self, model, temp_min, temp_max, flow_rate, hysteresis=2.0,
+                 horizon=30, flow_forecast=None):
+        super().__init__(temp_min, temp_max, flow_rate, hysteresis=hysteresis)
+        self.model = model
+        self.scheduler = MPCHeaterScheduler(model, horizon)
+        self.flow_forecast = flow_forecast
+
+    def reset(self):
+        super().reset()
+        self.scheduler.reset()
+
+    def update(self, target_temp, temp_in, temp_out, flow_ml_s, dt):
+        steps = self.scheduler.horizon
+        if self.circulating:
+            flows = [0.0] * steps
+        elif self.flow_forecast is not None:
+            flows = self.flow_forecast(steps, self.model.dt)
+        else:
+            flows = [flow_ml_s] * steps
+
+        power = self.scheduler.plan(target_temp, temp_out, temp_in, flows)[0]
+        self.update_circulation(temp_out)
+        return TemperatureCommand(power, self.flow_rate, self.circulating)
+
+
+if __name__ == "__main__":
+    # thermal_model.py CAPTURE [--out FILE] [--max-flow ML_S]
+    if len(sys.argv) < 2:
+        print("Usage: python3 thermal_model.py CAPTURE [--out thermal_model.json] [--max-flow 20]")
+        sys.exit(2)
+    out = sys.argv[sys.argv.index('--out') + 1] if '--out' in sys.argv else 'thermal_model.json'
+    max_flow = float(sys.argv[sys.argv.index('--max-flow') + 1]) if '--max-flow' in sys.argv else 20.0
+
+    model, rms = fit_capture(sys.argv[1], max_flow)
+    order = "second" if model.tau > 0 else "first"
+    print(f"Fitted {order}-order model, one-step RMS error {rms:.3f}°C")
+    print(json.dumps(model.as_dict(), indent=2))
+    model.save(out)
+    print(f"Saved to {out}")
@@ -0,0 +1,102 @@
+from array import array
+
+# MAX31855 fault bits (D2..D0), only meaningful when D16 is set
+FAULT_OPEN = 0x1
+FAULT_SHORT_GND = 0x2
+FAULT_SHORT_VCC = 0x4
+
+FAULT_NAMES = {
+    FAULT_OPEN: 'open circuit',
+    FAULT_SHORT_GND: 'short to GND',
+    FAULT_SHORT_VCC: 'short to VCC'
+}
+
+
+def decode_max31855(raw):
+    """Decode a 32-bit MAX31855 frame
+
+    Returns (thermocouple °C, cold junction °C, fault bits). Both
+    temperatures are two's complement: 14 bits at 0.25°C and 12 bits at
+    0.0625°C.
+    """
+    word = (raw[0] << 24) | (raw[1] << 16) | (raw[2] << 8) | raw[3]
+
+    tc = word >> 18
+    if tc & 0x2000:
+        tc -= 0x4000
+
+    cj = (word >> 4) & 0xFFF
+    if cj & 0x800:
+        cj -= 0x1000
+
+    faults = word & 0x7 if word & 0x10000 else 0
+    return tc * 0.25, cj * 0.0625, faults
+
+
+def describe_faults(faults):
+    return ", ".join(name for bit, name in FAULT_NAMES.items() if faults & bit)
+
+
+class TemperatureAcquisition:
+    """Burst acquisition of all MAX31855 channels into fixed ring buffers
+
+    sample() reads every chip back to back and is meant to be scheduled at
+    the acquisition rate; the control loop then reads a median of the last
+    `window` good samples instead of doing its own bus transaction.
+    """
+
+    def __init__(self, io, devices=((0, 0), (0, 1)), window=5):
+        self.spi = [io.spi(bus, device) for bus, device in devices]
+        self.window = window
+        channels = len(self.spi)
+
+        # Preallocated per-channel ring buffers
+        self.temps = [array('d', [0.0] * window) for _ in range(channels)]
+        self.cold_junction = [array('d', [0.0] * window) for _ in range(channels)]
+        self.faults = [array('B', [0] * window) for _ in range(channels)]
+        self.index = 0
+        self.count = 0
+        self.samples = 0
+
+    def sample(self):
+        """Read every chip once and store the decoded frames"""
+        i = self.index
+        for channel, spi in enumerate(self.spi):
+            tc, cj, faults = decode_max31855(spi.readbytes(4))
+            self.temps[channel][i] = tc
+            self.cold_junction[channel][i] = cj
+            self.faults[channel][i] = faults
+
+        self.index = (i + 1) % self.window
+        self.count = min(self.count + 1, self.window)
+        self.samples += 1
+
+    def latest_index(self):
+        return (self.index - 1) % self.window
+
+    def latest_faults(self, channel):
+        return self.faults[channel][self.latest_index()] if self.count else 0
+
+    def latest_temp(self, channel):
+        """Most recent unfiltered sample, for telemetry"""
+        return self.temps[channel][self.latest_index()] if self.count else None
+
+    def latest_cold_junction(self, channel):
+        return self.cold_junction[channel][self.latest_index()] if self.count else None
+
+    def read_temp(self, channel):
+        """Median of the buffered fault-free samples for one channel"""
+        if not self.count:
+            self.sample()
+
+        temps = self.temps[channel]
+        faults = self.faults[channel]
+        good = sorted(temps[i] for i in range(self.count) if not faults[i])
+        if not good:
+            raise Exception(f"Thermocouple fault on channel {channel}: "
+                            f"{describe_faults(self.latest_faults(channel))}")
+
+        middle = len(good) // 2
+        if len(good) % 2:
+            return good[middle]
+        return (good[middle - 1] + good[middle]) / 2
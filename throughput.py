@@ -0,0 +1,100 @@
+from temperature_control import clamp
+
+
+class FlowModel:
+    """Pump flow estimate (mL/s) from duty cycle, calibrated on tank level
+
+    The nominal flow is max_flow_ml_s scaled by pump speed. calibrate()
+    compares the volume the nominal model says left the tank with the
+    drop the level sensor actually saw and keeps `gain` as the ratio of
+    exponentially weighted sums, so tube wear and back-pressure are
+    learned while the machine runs.
+    """
+
+    def __init__(self, max_flow_ml_s, forgetting=0.8, min_volume_ml=100.0,
+                 gain_limits=(0.5, 1.5)):
+        self.max_flow_ml_s = max_flow_ml_s
+        self.forgetting = forgetting
+        self.min_volume_ml = min_volume_ml
+        self.gain_limits = gain_limits
+        self.gain = 1.0
+        self.measured_sum = 0.0
+        self.nominal_sum = 0.0
+        self.reference_ml = None   # tank volume at the start of the current interval
+        self.nominal_ml = 0.0      # nominal volume pumped since reference_ml
+
+    def flow_ml_s(self, pump_speed, circulating=False):
+        """Estimated flow out of the tank; circulation returns it to the boiler"""
+        if circulating or pump_speed <= 0:
+            return 0.0
+        return self.gain * self.max_flow_ml_s * pump_speed / 100
+
+    def integrate(self, pump_speed, circulating, dt):
+        """Account dt seconds of pumping; returns the estimated mL drawn"""
+        if circulating or pump_speed <= 0:
+            return 0.0
+        nominal = self.max_flow_ml_s * pump_speed / 100 * dt
+        self.nominal_ml += nominal
+        return self.gain * nominal
+
+    def calibrate(self, tank_ml):
+        """Update the gain from a new tank volume measurement"""
+        if self.reference_ml is None or tank_ml > self.reference_ml + self.min_volume_ml:
+            # First reading or the tank was refilled: start a fresh interval
+            self.reference_ml = tank_ml
+            self.nominal_ml = 0.0
+            return
+
+        if self.nominal_ml < self.min_volume_ml:
+            return  # too little pumped to rise above the level sensor's resolution
+
+        drawn = self.reference_ml - tank_ml
+        f = self.forgetting
+        self.measured_sum = f * self.measured_sum + drawn
+        self.nominal_sum = f * self.nominal_sum + self.nominal_ml
+        self.gain = clamp(self.measured_sum / self.nominal_sum, *self.gain_limits)
+        self.reference_ml = tank_ml
+        self.nominal_ml = 0.0
+
+
+class RunMetrics:
+    """Throughput counters for one process run"""
+
+    def __init__(self, cup_ml=200.0, heater_watts=2000.0):
+        self.cup_ml = cup_ml
+        self.heater_watts = heater_watts
+        self.start(0.0)
+
+    def start(self, t):
+        self.started = t
+        self.stopped = None
+        self.ready_at = None
+        self.dispensed_ml = 0.0
+        self.powder_g = 0.0
+        self.heater_on_s = 0.0  # seconds at full heater power
+
+    def ready(self, t):
+        """The boiler reached the band and dispensing began"""
+        self.ready_at = t
+
+    def stop(self, t):
+        self.stopped = t
+
+    def add(self, dt, drawn_ml, heater_power):
+        self.dispensed_ml += drawn_ml
+        self.heater_on_s += heater_power / 100 * dt
+
+    def summary(self, now):
+        end = self.stopped if self.stopped is not None else now
+        duration = max(0.0, end - self.started)
+        cups = self.dispensed_ml / self.cup_ml
+        return {
+            'duration_s': duration,
+            'time_to_ready_s': None if self.ready_at is None else self.ready_at - self.started,
+            'dispensed_ml': self.dispensed_ml,
+            'powder_g': self.powder_g,
+            'cups': cups,
+            'cups_per_hour': cups * 3600 / duration if duration else 0.0,
+            'heater_on_s': self.heater_on_s,
+            'heater_kwh': self.heater_on_s * self.heater_watts / 3.6e6
+        }
@@ -0,0 +1,187 @@
+import threading
+import time
+from collections import namedtuple
+
+SPEED_OF_SOUND_CM_S = 34300  # at ~20°C
+
+
+def speed_of_sound_cm_s(air_temp):
+    """Speed of sound in air at air_temp °C"""
+    return 33130 + 60.6 * air_temp
+
+# Successful measurement: echo pulse width and the one-way distance it implies
+Echo = namedtuple('Echo', ['pulse_ns', 'distance_cm'])
+
+
+class NoEcho:
+    """Result returned when the echo edges did not arrive before the timeout"""
+
+    def __init__(self, reason, waited_ns):
+        self.reason = reason        # 'no_rising_edge', 'no_falling_edge' or 'cancelled'
+        self.waited_ns = waited_ns
+
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return f"NoEcho(reason={self.reason!r}, waited_ns={self.waited_ns})"
+
+
+class EchoTimer:
+    """Edge-triggered HC-SR04 style echo timing
+
+    Instead of spinning on GPIO.input() the echo pin is watched with an edge
+    callback; the calling thread sleeps on an Event until the falling edge
+    arrives, the timeout expires or another thread calls cancel().
+    """
+
+    def __init__(self, gpio, trigger_pin, echo_pin, timeout=0.05,
+                 clock=time.perf_counter_ns):
+        self.gpio = gpio
+        self.trigger_pin = trigger_pin
+        self.echo_pin = echo_pin
+        self.timeout = timeout  # seconds; 50 ms covers ~8 m round trip
+        self.clock = clock
+        self.speed_of_sound = SPEED_OF_SOUND_CM_S
+
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._rise_ns = None
+        self._fall_ns = None
+        self._cancelled = False
+
+        gpio.setup(trigger_pin, gpio.OUT)
+        gpio.setup(echo_pin, gpio.IN)
+        gpio.output(trigger_pin, gpio.LOW)
+        gpio.add_event_detect(echo_pin, gpio.BOTH, callback=self._on_edge)
+
+    def _on_edge(self, channel):
+        """Record edge timestamps (runs on the GPIO callback thread)"""
+        now = self.clock()
+        level = self.gpio.input(channel)
+        with self._lock:
+            if level:
+                self._rise_ns = now
+                self._fall_ns = None
+            elif self._rise_ns is not None:
+                self._fall_ns = now
+                self._done.set()
+
+    def measure(self):
+        """Fire one ping and return an Echo or NoEcho"""
+        with self._lock:
+            if self._cancelled:
+                return NoEcho('cancelled', 0)
+            self._rise_ns = None
+            self._fall_ns = None
+            self._done.clear()
+
+        start = self.clock()
+        self.gpio.output(self.trigger_pin, self.gpio.HIGH)
+        time.sleep(0.00001)
+        self.gpio.output(self.trigger_pin, self.gpio.LOW)
+
+        self._done.wait(self.timeout)
+
+        with self._lock:
+            rise, fall = self._rise_ns, self._fall_ns
+            if self._cancelled:
+                return NoEcho('cancelled', self.clock() - start)
+        if rise is None:
+            return NoEcho('no_rising_edge', self.clock() - start)
+        if fall is None:
+            return NoEcho('no_falling_edge', self.clock() - start)
+
+        pulse_ns = fall - rise
+        distance = (pulse_ns / 1e9) * self.speed_of_sound / 2
+        return Echo(pulse_ns, distance)
+
+    def cancel(self):
+        """Wake a measure() in progress and fail any more until resume()"""
+        with self._lock:
+            self._cancelled = True
+            self._done.set()
+
+    def resume(self):
+        with self._lock:
+            self._cancelled = False
+
+    def close(self):
+        self.gpio.remove_event_detect(self.echo_pin)
+
+
+class FakeEchoGPIO:
+    """Off-Pi stand-in for the subset of RPi.GPIO used by EchoTimer
+
+    Each trigger pulse plays back the next (delay_ns, pulse_ns) pair from
+    `echoes` on a virtual nanosecond clock, firing the registered edge
+    callbacks synchronously. A pulse_ns of None produces a rising edge with
+    no falling edge; an entry of None produces no edges at all.
+    """
+
+    BCM = 11
+    IN = 1
+    OUT = 0
+    HIGH = 1
+    LOW = 0
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, echoes=None, default_echo=(100000, 1000000)):
+        self.echoes = list(echoes or [])
+        self.default_echo = default_echo
+        self.now_ns = 0
+        self.levels = {}
+        self.callbacks = {}
+        self.trigger_count = 0
+
+    def clock_ns(self):
+        return self.now_ns
+
+    def sleep(self, seconds):
+        self.now_ns += int(seconds * 1e9)
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction):
+        self.levels.setdefault(pin, self.LOW)
+
+    def input(self, pin):
+        return self.levels.get(pin, self.LOW)
+
+    def add_event_detect(self, pin, edge, callback=None):
+        self.callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def cleanup(self):
+        self.callbacks.clear()
+
+    def output(self, pin, value):
+        previous = self.levels.get(pin, self.LOW)
+        self.levels[pin] = value
+        if previous == self.HIGH and value == self.LOW:
+            self.trigger_count += 1
+            self._play_echo()
+
+    def _play_echo(self):
+        echo = self.echoes.pop(0) if self.echoes else self.default_echo
+        if echo is None or not self.callbacks:
+            return
+        delay_ns, pulse_ns = echo
+        pin, callback = next(iter(self.callbacks.items()))
+
+        self.now_ns += delay_ns
+        self.levels[pin] = self.HIGH
+        callback(pin)
+        if pulse_ns is None:
+            return
+        self.now_ns += pulse_ns
+        self.levels[pin] = self.LOW
+        callback(pin)